@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 from pyramid.config import Configurator
 from pyramid.settings import asbool
 
@@ -17,6 +20,9 @@ def main(global_config, **settings):
     settings['sparkpost_subject'] = settings.get('sparkpost.subject')
     settings['sparkpost_reply_to'] = settings.get('sparkpost.reply_to')
     settings['sparkpost_token'] = settings.get('sparkpost.token')
+    settings['jobs_db'] = settings.get('jobs.db', os.path.join(tempfile.gettempdir(), 's3_jobs.db'))
+    settings['jobs_workers'] = int(settings.get('jobs.workers', 2))
+    settings['jobs_project_limit'] = int(settings.get('jobs.project_limit', 1))
 
     configurator = Configurator(settings=settings)
 
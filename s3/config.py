@@ -16,3 +16,12 @@ def configure_project(config):
     from s3.routes import project_routes
     config.include(project_routes)
     config.add_tween('s3.tweens.timing_tween_factory')
+
+    from s3.utils.jobs import JobStore, JobScheduler
+    from s3.utils.runner import run_job
+    settings = config.registry.settings
+    config.registry.jobs = JobScheduler(
+        JobStore(settings['jobs_db']),
+        run_job,
+        workers=settings['jobs_workers'],
+        project_limit=settings['jobs_project_limit']).start()
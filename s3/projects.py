@@ -6,8 +6,64 @@ projects = {
         'bucket': 'debug.lime',
         'exclude_dirs': {},
         'only_dirs': {},
+        # store identical content once under .backup/blobs/, restore through .backup/manifest
+        'dedup': False,
+        # seconds before a file deleted from home_dir is deleted from the bucket,
+        # None never deletes. Guards against wiping the bucket on a mount failure.
+        'delete_grace': 7 * 24 * 3600,
+        # seconds to wait for a running backup of this project, 0 fails at once
+        'lock_timeout': 0,
         'commands': {
-            'pull', 'push', 'init', 'rebase_digest'
+            'pull', 'push', 'init', 'rebase_digest', 'verify'
+        },
+        'transfer': {
+            'workers': 8,
+            'multipart_threshold': 8 * 1024 * 1024,
+            'multipart_chunksize': 8 * 1024 * 1024,
+            'multipart_concurrency': 4,
+        },
+        'throttle': {
+            # bytes/s and requests/s outside of the windows, None is unlimited
+            'bytes_per_sec': None,
+            'requests_per_sec': None,
+            'windows': [
+                # business hours (local time, 0 = monday): leave the uplink to the site
+                {'days': [0, 1, 2, 3, 4], 'hours': [8, 20],
+                 'bytes_per_sec': 2 * 1024 * 1024, 'requests_per_sec': 50},
+            ],
+        },
+        # /zip_sql: *.sql files of home_dir, compressed in place
+        'compress': {
+            # deflate (.zip), gzip (.gz) or zstd (.zst, zstandard package)
+            'codec': 'deflate',
+            'level': 6,
+            'workers': 2,
+            # zstd threads per file
+            'threads': 0,
+        },
+        # /retention: push history, newest copy of the last 7 days, 4 weeks and 12 months
+        'retention': {
+            'daily': 7,
+            'weekly': 4,
+            'monthly': 12,
+            # older kept copies move to s3://<bucket>/.backup/archive/history/
+            'local_days': 14,
+            'storage_class': 'STANDARD_IA',
+            'compact_after': 2,
+        },
+        # /backup/test/verify: bucket listing against the indexes, report in <config_dir>/verify
+        'verify': {
+            # percent of the matching files downloaded and rehashed
+            'sample': 1,
+            'workers': 8,
+        },
+        'hashing': {
+            # md5 or blake2b, changing it rehashes the tree once and rewrites the digests of the S3 index
+            'algorithm': 'md5',
+            'read_size': 1024 * 1024,
+            # thread or process
+            'pool': 'thread',
+            'workers': None,
         }
     },
 }
@@ -19,7 +75,24 @@ databases = {
         'db_user_password': 'pass',
         'db_name': 'test',
         'backup_path': '/databases',
-        'perm_path': '/databases'
+        'perm_path': '/databases',
+        # several databases of one server are dumped concurrently
+        # 'db_names': ['test', 'test_stats'],
+        # upload straight to s3://<bucket>/<prefix><date>/<db>.sql.gz instead of backup_path
+        # 'bucket': 'debug.lime',
+        # 'prefix': 'databases/',
+        'dump': {
+            # gzip or zstd (zstandard package)
+            'codec': 'gzip',
+            'workers': 2,
+        },
+        # /retention: dated dump folders (or S3 prefixes) to keep
+        'retention': {
+            'daily': 7,
+            'weekly': 4,
+            'monthly': 6,
+            'local_days': None,
+        }
     }
 }
 
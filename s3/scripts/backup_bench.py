@@ -0,0 +1,140 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import uuid
+
+from s3.utils.bench import Benchmark, DEFAULT_TREE, compare
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='s3_backup_bench',
+        description='Time scan, hash, diff, upload and pull over a synthetic tree against a local S3 stand-in.')
+    parser.add_argument('-o', '--output', help='write the JSON results to this file (default: stdout)')
+    parser.add_argument('--compare', metavar='BASELINE', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown reported as a regression, 0.1 = 10%% (default: 0.1)')
+    parser.add_argument('--endpoint', help='S3 compatible endpoint (default: an in-process moto server)')
+    parser.add_argument('--bucket', help='existing bucket to use (default: a new bench-* bucket)')
+    parser.add_argument('--root', help='directory for the tree and the indexes (default: a temp dir)')
+    parser.add_argument('--keep', action='store_true', help='keep the tree and the bucket')
+
+    tree = parser.add_argument_group('tree')
+    tree.add_argument('--files', type=int, default=DEFAULT_TREE['files'])
+    tree.add_argument('--depth', type=int, default=DEFAULT_TREE['depth'])
+    tree.add_argument('--fanout', type=int, default=DEFAULT_TREE['fanout'])
+    tree.add_argument('--size', default=DEFAULT_TREE['size'], choices=('fixed', 'uniform', 'lognormal'))
+    tree.add_argument('--mean-size', type=int, default=DEFAULT_TREE['mean_size'], help='bytes')
+    tree.add_argument('--sigma', type=float, default=DEFAULT_TREE['sigma'])
+    tree.add_argument('--max-size', type=int, default=DEFAULT_TREE['max_size'], help='bytes')
+    tree.add_argument('--duplicates', type=float, default=DEFAULT_TREE['duplicates'])
+    tree.add_argument('--change', type=float, default=DEFAULT_TREE['change'])
+    tree.add_argument('--seed', type=int, default=DEFAULT_TREE['seed'])
+
+    backup = parser.add_argument_group('backup')
+    backup.add_argument('--dedup', action='store_true', help='content addressed bucket layout')
+    backup.add_argument('--workers', type=int, default=8, help='transfer workers (default: 8)')
+    backup.add_argument('--hash-algorithm', default='md5', choices=('md5', 'blake2b'))
+    backup.add_argument('--hash-pool', default='thread', choices=('thread', 'process'))
+    return parser.parse_args(argv)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_moto():
+    """ in-process moto server, returns (server, endpoint) """
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        sys.exit('No --endpoint given and moto is not installed (pip install "moto[server]")')
+    # moto accepts any credentials, boto3 still wants some
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    port = free_port()
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+    return server, 'http://127.0.0.1:%d' % port
+
+
+def empty_bucket(client, bucket):
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket):
+        keys = [{'Key': x['Key']} for x in page.get('Contents') or []]
+        if keys:
+            client.delete_objects(Bucket=bucket, Delete={'Objects': keys, 'Quiet': True})
+    client.delete_bucket(Bucket=bucket)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    # per file log lines of the pipeline would be timed too
+    logging.getLogger('s3.utils').setLevel(logging.WARNING)
+    logging.getLogger('s3.utils.bench').setLevel(logging.INFO)
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    import boto3
+    server = None
+    endpoint = args.endpoint
+    if not endpoint:
+        server, endpoint = start_moto()
+    client = boto3.client('s3', endpoint_url=endpoint)
+    bucket = args.bucket or 'bench-%s' % uuid.uuid4().hex[:12]
+    if not args.bucket:
+        client.create_bucket(Bucket=bucket)
+
+    root = args.root or tempfile.mkdtemp(prefix='s3_bench_')
+    tree = {
+        'files': args.files, 'depth': args.depth, 'fanout': args.fanout, 'size': args.size,
+        'mean_size': args.mean_size, 'sigma': args.sigma, 'max_size': args.max_size,
+        'duplicates': args.duplicates, 'change': args.change, 'seed': args.seed,
+    }
+    transfer = {'workers': args.workers, 'endpoint_url': endpoint}
+    hashing = {'algorithm': args.hash_algorithm, 'pool': args.hash_pool}
+    try:
+        results = Benchmark(root, bucket, tree, transfer, hashing, args.dedup).run()
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+            if not args.bucket:
+                empty_bucket(client, bucket)
+        if server:
+            server.stop()
+
+    # the endpoint differs between runs, keep the results comparable
+    results['transfer'].pop('endpoint_url', None)
+    results['endpoint'] = 'moto' if server else endpoint
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows = compare(baseline, results, args.threshold)
+        sys.stderr.write('%-18s %10s %10s %8s %10s\n' % ('phase', 'before', 'after', 'change', 'peak MB'))
+        for row in rows:
+            sys.stderr.write('%-18s %10.3f %10.3f %+7.1f%% %10s%s\n' % (
+                row['phase'], row['before'], row['after'], row['change'] * 100, row['rss_after'],
+                '  REGRESSION' if row['regression'] else ''))
+        if any(x['regression'] for x in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
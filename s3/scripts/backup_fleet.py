@@ -0,0 +1,60 @@
+import argparse
+import json
+import logging
+import sys
+
+from pyramid.paster import setup_logging
+
+from s3.projects import projects
+from s3.utils.fleet import Fleet
+from s3.utils.throttle import Budget, MB
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='s3_backup_fleet',
+        description='Run a backup command over many projects under global resource limits.')
+    parser.add_argument('config_uri', nargs='?', help='ini file, for logging')
+    parser.add_argument('-p', '--project', action='append', dest='projects',
+                        help='project name, may be repeated (default: all projects)')
+    parser.add_argument('-c', '--command', default='push', help='backup command (default: push)')
+    parser.add_argument('-w', '--workers', type=int, default=2, help='projects running at once (default: 2)')
+    parser.add_argument('--hash-workers', type=int, default=None,
+                        help='hashing threads shared by all projects (default: cpu count)')
+    parser.add_argument('--upload-workers', type=int, default=16,
+                        help='uploads in flight across all projects (default: 16)')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='upload bandwidth across all projects, MB/s (default: unlimited)')
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_args(argv)
+
+    if args.config_uri:
+        setup_logging(args.config_uri)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    names = args.projects or sorted(projects.keys())
+    unknown = [x for x in names if x not in projects]
+    if unknown:
+        sys.exit('Unknown projects: %s' % ', '.join(unknown))
+    names = [x for x in names if args.command in projects[x].get('commands', ())]
+
+    budget = Budget(
+        hash_workers=args.hash_workers,
+        upload_workers=args.upload_workers,
+        bandwidth=int(args.bandwidth * MB) if args.bandwidth else None)
+    try:
+        results = Fleet(names, args.command, budget=budget, workers=args.workers).run()
+    finally:
+        budget.close()
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+    failed = [x for x in results.values() if x['status'] != 'done']
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
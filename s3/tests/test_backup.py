@@ -0,0 +1,350 @@
+import datetime
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from botocore.exceptions import ClientError
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+def not_found(operation):
+    return ClientError({'Error': {'Code': 'NoSuchKey'}, 'ResponseMetadata': {'HTTPStatusCode': 404}}, operation)
+
+
+class FakeS3(object):
+    """ the client calls of S3Backup over a dict of key: bytes """
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = []
+        self.deletes = []
+
+    def upload_file(self, Filename, Bucket, Key, Config=None, Callback=None):
+        with open(Filename, 'rb') as f:
+            self.objects[Key] = f.read()
+        self.uploads.append(Key)
+
+    def download_file(self, Bucket, Key, Filename, Config=None, Callback=None):
+        if Key not in self.objects:
+            raise not_found('GetObject')
+        with open(Filename, 'wb') as f:
+            f.write(self.objects[Key])
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise not_found('GetObject')
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        self.objects[Key] = Body
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise not_found('HeadObject')
+        return {'ETag': '"%s"' % hashlib.md5(self.objects[Key]).hexdigest()}
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete['Objects']:
+            self.deletes.append(item['Key'])
+            self.objects.pop(item['Key'], None)
+        return {}
+
+    def get_paginator(self, name):
+        client = self
+
+        class Paginator(object):
+            def paginate(self, Bucket, Prefix='', Delimiter=None):
+                if name != 'list_objects_v2':
+                    yield {}
+                    return
+                contents = []
+                prefixes = set()
+                for key in sorted(client.objects):
+                    if not key.startswith(Prefix):
+                        continue
+                    rest = key[len(Prefix):]
+                    if Delimiter and Delimiter in rest:
+                        prefixes.add(Prefix + rest.split(Delimiter)[0] + Delimiter)
+                    else:
+                        contents.append({'Key': key, 'Size': len(client.objects[key]),
+                                         'ETag': '"%s"' % hashlib.md5(client.objects[key]).hexdigest(),
+                                         'LastModified': datetime.datetime(2024, 1, 1)})
+                yield {'Contents': contents, 'CommonPrefixes': [{'Prefix': x} for x in sorted(prefixes)]}
+        return Paginator()
+
+
+class FakeBucket(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def download_file(self, Key, Filename):
+        self.client.download_file(self.name, Key, Filename)
+
+    def upload_file(self, Filename, Key):
+        self.client.upload_file(Filename, self.name, Key)
+
+
+class FakeResource(object):
+    def __init__(self, client):
+        self.meta = mock.Mock(client=client)
+
+    def Bucket(self, name):
+        return FakeBucket(self.meta.client, name)
+
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+class BackupTestCase(unittest.TestCase):
+    """ push/pull runs of one home dir against an in-memory bucket """
+
+    dedup = False
+    delete_grace = None
+    hashing = None
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.home = os.path.join(self.root, 'home')
+        self.client = FakeS3()
+        os.makedirs(self.home)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, data, home=None):
+        path = os.path.join(home or self.home, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def backups(self, home=None):
+        """ scanned LocalBackup and synced S3Backup of a home dir """
+        import boto3
+        from s3.utils.backup import LocalBackup, S3Backup
+        home = home or self.home
+        config_dir = os.path.join(self.root, 'config_' + os.path.basename(home))
+        local = LocalBackup(HomeDir=home, ConfigDir=config_dir, ExcludeDirs=[], OnlyDirs=[], Hashing=self.hashing)
+        local.sync()
+        with mock.patch.object(boto3, 'resource', return_value=FakeResource(self.client)):
+            s3 = S3Backup(S3Bucket='bucket', HomeDir=home, ConfigDir=config_dir, ExcludeDirs=[], OnlyDirs=[],
+                          Dedup=self.dedup, DeleteGrace=self.delete_grace, Hashing=self.hashing)
+        s3.sync()
+        return local, s3
+
+    def run_command(self, command, home=None):
+        """ one run the way the runner does it: scan, sync, command, apply """
+        from s3.utils.backup import BackupManager
+        local, s3 = self.backups(home)
+        manager = BackupManager()
+        manager.slave = local
+        manager.master = s3
+        manager.progress = None
+        result = getattr(manager, command)()
+        if command in ('init', 'push'):
+            result = manager.apply()
+        return result, manager
+
+    def blobs(self):
+        return sorted(x for x in self.client.objects if x.startswith('.backup/blobs/'))
+
+    def blob(self, digest):
+        return '.backup/blobs/%s/%s' % (digest[:2], digest)
+
+
+class IsCurrentTest(BackupTestCase):
+    def listed(self, data, etag=None, mtime=None):
+        return {'Key': 'a.txt', 'Size': len(data), 'ETag': '"%s"' % (etag or md5(data)),
+                'LastModified': datetime.datetime.utcfromtimestamp(mtime or 0)}
+
+    def test_single_part_etag(self):
+        path = self.write('a.txt', b'content')
+        local, s3 = self.backups()
+        # the ETag is the MD5: it decides whatever the mtimes say
+        self.assertTrue(s3.is_current(self.listed(b'content', mtime=time.time() + 3600), path, local))
+        self.assertFalse(s3.is_current(self.listed(b'content', etag=md5(b'other')), path, local))
+        self.assertFalse(s3.is_current(self.listed(b'longer content'), path, local))
+        self.assertFalse(s3.is_current(self.listed(b'content'), path + '.missing', local))
+
+    def test_multipart_etag_falls_back_to_mtime(self):
+        path = self.write('a.txt', b'content')
+        local, s3 = self.backups()
+        mtime = os.stat(path).st_mtime
+        self.assertTrue(s3.is_current(self.listed(b'content', 'abc-2', mtime - 60), path, local))
+        self.assertFalse(s3.is_current(self.listed(b'content', 'abc-2', mtime + 60), path, local))
+        # no index entry either: same fallback
+        self.assertTrue(s3.is_current(self.listed(b'content', md5(b'other'), mtime - 60), path))
+
+    def test_changed_since_indexed(self):
+        path = self.write('a.txt', b'content')
+        local, s3 = self.backups()
+        self.write('a.txt', b'CONTENT')
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        # the index row is stale, the md5 can't be trusted: newer than the object
+        self.assertTrue(s3.is_current(self.listed(b'content', mtime=time.time() - 60), path, local))
+        self.assertFalse(s3.is_current(self.listed(b'content', mtime=time.time() + 60), path, local))
+
+
+class AlgorithmSwitchTest(BackupTestCase):
+    def test_switch_replaces_remote_digests(self):
+        self.write('a.txt', b'one')
+        self.write('b/c.txt', b'two')
+        self.write('d.txt', b'four')
+        self.run_command('init')
+        self.client.uploads = []
+
+        # changed between the last push and the switch
+        self.write('d.txt', b'changed')
+        self.hashing = {'algorithm': 'blake2b'}
+        result, manager = self.run_command('push')
+        # unchanged objects stay, the md5 digests are replaced rather than mixed in
+        self.assertEqual(self.client.uploads, ['d.txt'])
+        self.assertEqual(manager.master.index_algorithm(), 'blake2b')
+        digests = list(manager.master.index.lines('digests'))
+        self.assertEqual(len(digests), 3)
+        self.assertTrue(all(len(x) == 2 + 128 for x in digests))
+
+        self.client.uploads = []
+        result, manager = self.run_command('push')
+        self.assertEqual(self.client.uploads, [])
+
+    def test_switch_without_changes(self):
+        self.write('a.txt', b'one')
+        self.run_command('init')
+        self.client.uploads = []
+
+        self.hashing = {'algorithm': 'blake2b'}
+        result, manager = self.run_command('push')
+        self.assertEqual(self.client.uploads, [])
+        self.assertEqual(manager.master.index_algorithm(), 'blake2b')
+        self.assertEqual(len(list(manager.master.index.lines('digests'))), 1)
+
+
+class UserDirsTest(BackupTestCase):
+    names = ('blobs/a.txt', 'archive/c.txt', 'b.txt')
+
+    def test_pull(self):
+        for name in self.names:
+            self.write(name, name.encode('utf-8'))
+        self.run_command('init')
+
+        # dirs named like our own objects are plain user dirs
+        other = os.path.join(self.root, 'other')
+        os.makedirs(other)
+        stats, manager = self.run_command('pull', other)
+        self.assertEqual((stats['count'], stats['errors']), (len(self.names), 0))
+        for name in self.names:
+            with open(os.path.join(other, name), 'rb') as f:
+                self.assertEqual(f.read(), name.encode('utf-8'))
+
+
+class DedupTest(BackupTestCase):
+    dedup = True
+    delete_grace = 0
+
+    def manifest(self):
+        lines = self.client.objects['.backup/manifest'].decode('utf-8').split('\n')
+        return dict(reversed(x.split('|', 1)) for x in lines if x)
+
+    def test_upload(self):
+        self.write('a.txt', b'same')
+        self.write('b.txt', b'same')
+        self.write('c/d.txt', b'other')
+        result, manager = self.run_command('init')
+
+        # one blob per content, the keys only live in the manifest
+        self.assertEqual(sorted(x for x in self.client.uploads if x.startswith('.backup/blobs/')), self.blobs())
+        self.assertEqual(len(self.blobs()), 2)
+        self.assertNotIn('a.txt', self.client.objects)
+        self.assertEqual(self.manifest(), {'a.txt': md5(b'same'), 'b.txt': md5(b'same'), 'c/d.txt': md5(b'other')})
+        self.assertEqual(result['count'], 3)
+        self.assertEqual(result['bytes_saved'], manager.sizeof_fmt(4))
+
+    def test_duplicate_of_stored_blob(self):
+        self.write('a.txt', b'same')
+        self.run_command('init')
+        self.client.uploads = []
+
+        self.write('e.txt', b'same')
+        result, manager = self.run_command('push')
+        # already stored: only the manifest and the index are written
+        self.assertEqual([x for x in self.client.uploads if x.startswith('.backup/blobs/')], [])
+        self.assertEqual(self.manifest()['e.txt'], md5(b'same'))
+        self.assertEqual(result['count'], 1)
+
+    def test_manifest_compaction(self):
+        self.write('a.txt', b'one')
+        self.run_command('init')
+        self.write('a.txt', b'two')
+        result, manager = self.run_command('push')
+        # the last digest of a key wins, the uploaded entries are folded into the manifest
+        self.assertEqual(self.manifest(), {'a.txt': md5(b'two')})
+        self.assertEqual(manager.slave.read_uploaded_manifest(), [])
+
+    def test_pull(self):
+        self.write('a.txt', b'same')
+        self.write('b.txt', b'same')
+        self.write('c/d.txt', b'other')
+        self.run_command('init')
+
+        other = os.path.join(self.root, 'other')
+        os.makedirs(other)
+        stats, manager = self.run_command('pull', other)
+        self.assertEqual((stats['count'], stats['skipped'], stats['errors']), (3, 0, 0))
+        for name, data in (('a.txt', b'same'), ('b.txt', b'same'), (os.path.join('c', 'd.txt'), b'other')):
+            with open(os.path.join(other, name), 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+        # restored files are in the local index: nothing to download again
+        stats, manager = self.run_command('pull', other)
+        self.assertEqual((stats['count'], stats['skipped']), (0, 3))
+
+    def test_unreferenced_blobs_are_collected(self):
+        self.write('a.txt', b'same')
+        self.write('b.txt', b'same')
+        self.write('c/d.txt', b'other')
+        self.run_command('init')
+        self.assertEqual(self.blobs(), [self.blob(x) for x in sorted([md5(b'same'), md5(b'other')])])
+
+        # a shared blob stays while any key references it
+        os.remove(os.path.join(self.home, 'a.txt'))
+        self.run_command('push')
+        self.run_command('push')
+        self.assertIn(self.blob(md5(b'same')), self.blobs())
+
+        # the last reference is gone: collected by the run after the manifest changed
+        os.remove(os.path.join(self.home, 'c', 'd.txt'))
+        self.run_command('push')
+        self.assertIn(self.blob(md5(b'other')), self.blobs())
+        result, manager = self.run_command('push')
+        self.assertEqual(self.blobs(), [self.blob(md5(b'same'))])
+        self.assertEqual(manager.master.read_orphaned_blobs(), {})
+
+        report, manager = self.run_command('verify')
+        self.assertEqual(report['counts']['unindexed'], 0)
+
+    def test_referenced_again_within_grace(self):
+        self.write('a.txt', b'one')
+        self.run_command('init')
+        self.write('a.txt', b'two')
+        self.run_command('push')
+        # 'one' lost its last reference, a new file brings it back before the collection
+        self.write('b.txt', b'one')
+        self.run_command('push')
+        self.run_command('push')
+        self.assertEqual(self.blobs(), [self.blob(x) for x in sorted([md5(b'one'), md5(b'two')])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class BenchTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_generate_tree(self):
+        from s3.utils.bench import generate_tree, mutate_tree
+        settings = {'files': 50, 'depth': 2, 'fanout': 2, 'size': 'uniform', 'mean_size': 1000,
+                    'duplicates': 0.2, 'seed': 3}
+        stats = generate_tree(self.root, settings)
+
+        self.assertEqual(stats['files'], 50)
+        self.assertEqual(stats['bytes'], sum(os.path.getsize(x) for x in stats['paths']))
+        self.assertTrue(0 < stats['duplicates'] < 50)
+        depths = set(os.path.relpath(x, self.root).count(os.sep) for x in stats['paths'])
+        self.assertTrue(depths <= set([0, 1, 2]))
+
+        # same seed, same shape
+        other = generate_tree(os.path.join(self.root, 'other'), settings)
+        self.assertEqual(other['bytes'], stats['bytes'])
+
+        before = dict((x, open(x, 'rb').read()) for x in stats['paths'])
+        changed, size = mutate_tree(stats['paths'], 0.1)
+        self.assertEqual(changed, 5)
+        rewritten = [x for x in stats['paths'] if open(x, 'rb').read() != before[x]]
+        self.assertTrue(len(rewritten) <= 5)
+        self.assertEqual(sum(os.path.getsize(x) for x in stats['paths']), stats['bytes'])
+
+    def test_compare(self):
+        from s3.utils.bench import compare
+        baseline = {'phases': [{'phase': 'scan_dir', 'seconds': 1.0}, {'phase': 'diff', 'seconds': 2.0}]}
+        current = {'phases': [{'phase': 'scan_dir', 'seconds': 1.05}, {'phase': 'diff', 'seconds': 3.0},
+                              {'phase': 'pull', 'seconds': 1.0}]}
+        rows = compare(baseline, current, 0.1)
+        self.assertEqual([(x['phase'], x['regression']) for x in rows], [('scan_dir', False), ('diff', True)])
+
+
+if __name__ == '__main__':
+    unittest.main()
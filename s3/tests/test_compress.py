@@ -0,0 +1,58 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+
+class CompressionStageTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'dumps'))
+        self.files = {}
+        for name in ('dumps/one.sql', 'two.sql', 'notes.txt'):
+            content = ('INSERT INTO %s VALUES (1);\n' % name).encode('utf-8') * 1000
+            with open(os.path.join(self.root, name), 'wb') as f:
+                f.write(content)
+            self.files[name] = content
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def test_deflate(self):
+        from s3.utils.compress import CompressionStage
+        stage = CompressionStage({'codec': 'deflate', 'workers': 2})
+        stats = stage.run(stage.find(self.root))
+
+        self.assertEqual((stats['count'], stats['errors']), (2, 0))
+        self.assertFalse(os.path.exists(self.path('two.sql')))
+        self.assertTrue(os.path.exists(self.path('notes.txt')))
+        with zipfile.ZipFile(self.path('dumps/one.sql.zip')) as archive:
+            self.assertEqual(archive.read('one.sql'), self.files['dumps/one.sql'])
+        self.assertEqual([x for x in os.listdir(self.root) if x.endswith('.part')], [])
+
+    def test_gzip(self):
+        from s3.utils.compress import compress_file
+        result = compress_file(self.path('two.sql'), {'codec': 'gzip', 'read_size': 1024})
+
+        self.assertEqual(result['status'], 'compressed')
+        with gzip.open(self.path('two.sql.gz')) as f:
+            self.assertEqual(f.read(), self.files['two.sql'])
+        self.assertEqual(os.path.getsize(self.path('two.sql.gz')), result['compressed_bytes'])
+
+    def test_up_to_date(self):
+        from s3.utils.compress import compress_file
+        compress_file(self.path('two.sql'), {'codec': 'gzip'})
+        # same dump restored next to its archive
+        with gzip.open(self.path('two.sql.gz')) as f, open(self.path('two.sql'), 'wb') as out:
+            out.write(f.read())
+        archived = os.stat(self.path('two.sql.gz'))
+        os.utime(self.path('two.sql'), ns=(archived.st_atime_ns, archived.st_mtime_ns))
+
+        result = compress_file(self.path('two.sql'), {'codec': 'gzip'})
+        self.assertEqual(result['status'], 'skipped')
+        self.assertFalse(os.path.exists(self.path('two.sql')))
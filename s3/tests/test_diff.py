@@ -0,0 +1,26 @@
+import unittest
+
+
+class DiffEngineTests(unittest.TestCase):
+    def test_merge_join(self):
+        from s3.utils.diff import DiffEngine
+        local = [
+            ('aa1', '/home/a', 'aa', 'd1'),
+            ('aa2', '/home/b', 'aa', 'd2'),
+            ('bb3', '/home/c', 'bb', 'd3'),
+        ]
+        engine = DiffEngine(['cc4', 'aa2', '', 'aa1', 'ab0'], ['aad1', 'bbd3'])
+        changes = engine.diff(iter(local), keep_unchanged=True)
+
+        self.assertEqual([x.name for x in changes.added], ['bb3'])
+        self.assertEqual([x.name for x in changes.modified], ['aa2'])
+        self.assertEqual([x.name for x in changes.deleted], ['ab0', 'cc4'])
+        self.assertEqual([x.name for x in changes.unchanged], ['aa1'])
+        self.assertEqual(changes.pending(), ['bb3', 'aa2'])
+        self.assertEqual((changes.local_count, changes.remote_count), (3, 4))
+
+    def test_unchanged_only_counted(self):
+        from s3.utils.diff import DiffEngine
+        changes = DiffEngine(['aa1'], ['aad1']).diff([('aa1', '/home/a', 'aa', 'd1')])
+        self.assertEqual(changes.unchanged, [])
+        self.assertEqual(changes.counts()['unchanged'], 1)
@@ -0,0 +1,91 @@
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# fake mysqldump: 3MB of SQL on stdout
+FAKE_DUMP = [sys.executable, '-c',
+             'import sys\n'
+             'for i in range(30000):\n'
+             '    sys.stdout.write("INSERT INTO t VALUES (%d, \'%s\');\\n" % (i, "x" * 80))\n']
+FAILING_DUMP = [sys.executable, '-c', 'import sys; sys.stdout.write("partial"); '
+                                      'sys.stderr.write("Access denied"); sys.exit(2)']
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.parts = []
+        self.objects = {}
+        self.completed = False
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {'UploadId': 'upload'}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.parts.append(Body)
+        return {'ETag': '"%d"' % PartNumber}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.completed = True
+        self.objects[Key] = b''.join(self.parts)
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+
+class DumpTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_stream_to_file(self):
+        from s3.utils.dump import FileSink, run_dump
+        path = os.path.join(self.root, 'day', 'test.sql.gz')
+        result = run_dump('test', FAKE_DUMP, FileSink(path))
+
+        self.assertEqual(result['status'], 'ok')
+        self.assertEqual(result['returncode'], 0)
+        with gzip.open(path) as f:
+            content = f.read()
+        self.assertEqual(len(content), result['raw_bytes'])
+        self.assertEqual(os.path.getsize(path), result['compressed_bytes'])
+        self.assertTrue(content.endswith(b"'x" + b'x' * 79 + b"');\n"))
+
+    def test_failed_dump_leaves_nothing(self):
+        from s3.utils.dump import FileSink, run_dump
+        path = os.path.join(self.root, 'test.sql.gz')
+        result = run_dump('test', FAILING_DUMP, FileSink(path))
+
+        self.assertEqual(result['status'], 'failed')
+        self.assertEqual(result['returncode'], 2)
+        self.assertIn('Access denied', result['error'])
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_multipart_upload(self):
+        from s3.utils.dump import S3Sink, run_dump
+        client = FakeClient()
+        # incompressible enough to span several 64KB parts
+        command = [sys.executable, '-c', 'import os, sys; sys.stdout.write(os.urandom(300000).hex())']
+        result = run_dump('test', command, S3Sink(client, 'bucket', 'db/test.sql.gz', part_size=64 * 1024))
+
+        self.assertEqual(result['status'], 'ok')
+        self.assertTrue(client.completed)
+        self.assertGreater(len(client.parts), 1)
+        self.assertEqual(len(client.objects['db/test.sql.gz']), result['compressed_bytes'])
+
+    def test_concurrent_databases(self):
+        from s3.utils.dump import dump_database
+        results = dump_database({
+            'db_names': ['one', 'two', 'three'],
+            'backup_path': self.root,
+            'dump_command': FAKE_DUMP + ['{db_name}'],
+        }, stamp='day')
+
+        self.assertEqual([x['name'] for x in results], ['one', 'two', 'three'])
+        self.assertEqual(set(x['status'] for x in results), {'ok'})
+        self.assertEqual(sorted(os.listdir(os.path.join(self.root, 'day'))),
+                         ['one.sql.gz', 'three.sql.gz', 'two.sql.gz'])
@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class ExternalSortTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_sorted_unique_spills(self):
+        from s3.utils import extsort
+        lines = ['%03d' % (x % 50) for x in range(500, 0, -1)] + [' 007 ', '', '  ']
+        fanin = extsort.MAX_FANIN
+        extsort.MAX_FANIN = 3
+        try:
+            result = list(extsort.sorted_unique(lines, self.root, run_size=7))
+        finally:
+            extsort.MAX_FANIN = fanin
+        self.assertEqual(result, ['%03d' % x for x in range(50)])
+        # the runs are removed once merged
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_merge_file(self):
+        from s3.utils.extsort import iter_lines, merge_file
+        path = os.path.join(self.root, '.index_tmp')
+        self.assertEqual(merge_file(path, ['b', 'a', 'b'], self.root, 2), 2)
+        self.assertEqual(merge_file(path, iter(['c ', 'a', '']), self.root, 2), 3)
+        self.assertEqual(list(iter_lines(path)), ['a', 'b', 'c'])
+        self.assertEqual(sorted(os.listdir(self.root)), ['.index_tmp'])
+
+    def test_difference(self):
+        from s3.utils.extsort import difference
+        self.assertEqual(list(difference(['a', 'b', 'd', 'f'], ['b', 'c', 'f', 'g'])), ['a', 'd'])
+        self.assertEqual(list(difference(['a'], [])), ['a'])
+        self.assertEqual(list(difference([], ['a'])), [])
+
+    def test_intersection(self):
+        from s3.utils.extsort import intersection
+        self.assertEqual(list(intersection(['a', 'b', 'd', 'f'], ['b', 'c', 'f', 'g'])), ['b', 'f'])
+        self.assertEqual(list(intersection(['a'], [])), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+
+class FakeManager(object):
+    def __init__(self, pending):
+        self.pending = pending
+
+    def pending_size(self):
+        return self.pending
+
+
+class FakeRun(object):
+    sizes = {'small': 10, 'large': 1000, 'medium': 100}
+    applied = []
+
+    def __init__(self, name, command, request=None, budget=None):
+        self.name = name
+        self.manager = FakeManager(self.sizes.get(name, 0))
+
+    def prepare(self):
+        if self.name == 'broken':
+            raise IOError('unmounted')
+
+    def apply(self):
+        self.applied.append(self.name)
+        return {'count': 1}
+
+
+class FleetTests(unittest.TestCase):
+    def test_largest_pending_first(self):
+        from s3.utils.fleet import Fleet
+        FakeRun.applied = []
+        results = Fleet(['small', 'broken', 'large', 'medium'], workers=1, run_factory=FakeRun).run()
+
+        self.assertEqual(FakeRun.applied, ['large', 'medium', 'small'])
+        self.assertEqual(results['large']['status'], 'done')
+        self.assertEqual(results['large']['pending_bytes'], 1000)
+        self.assertEqual(results['broken']['status'], 'failed')
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class HashEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(40):
+            path = os.path.join(self.root, 'file_%d' % i)
+            with open(path, 'wb') as f:
+                f.write(b'x' * i)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_bounded(self):
+        from s3.utils.hashing import HashEngine
+        engine = HashEngine({'workers': 2})
+        counts = {'read': 0, 'done': 0, 'peak': 0}
+
+        def jobs():
+            for i, path in enumerate(self.paths):
+                counts['read'] += 1
+                counts['peak'] = max(counts['peak'], counts['read'] - counts['done'])
+                yield path, i
+
+        results = []
+        for digest, i in engine.imap(jobs()):
+            counts['done'] += 1
+            results.append((digest, i))
+
+        # the generator is never read further ahead than the window
+        self.assertEqual(engine.window(), 4)
+        self.assertTrue(counts['peak'] <= engine.window())
+        self.assertEqual(sorted(i for digest, i in results), list(range(40)))
+        self.assertEqual(dict((i, digest) for digest, i in results)[3], hashlib.md5(b'xxx').hexdigest())
+
+    def test_failed(self):
+        from s3.utils.hashing import HashEngine
+        results = list(HashEngine({'workers': 2}).imap([(self.paths[1], 'a'), (self.root + '/missing', 'b')]))
+        self.assertEqual(results, [(hashlib.md5(b'x').hexdigest(), 'a'), (None, 'b')])
+
+    def test_shared_pool_interleaves(self):
+        from s3.utils import hashing
+        from s3.utils.throttle import Budget
+        budget = Budget(hash_workers=2)
+        hashed = []
+        lock = threading.Lock()
+
+        def hash_file(path, *args):
+            time.sleep(0.002)
+            with lock:
+                hashed.append(path)
+            return 'digest'
+
+        def walk(name, paths):
+            for path in paths:
+                time.sleep(0.002)
+                yield path, name
+
+        def run(name, paths):
+            engine = hashing.HashEngine(budget=budget)
+            results[name] = list(engine.imap(walk(name, paths)))
+
+        results = {}
+        threads = [threading.Thread(target=run, args=('a', self.paths[:20])),
+                   threading.Thread(target=run, args=('b', self.paths[20:]))]
+        try:
+            with mock.patch.object(hashing, 'hash_file', hash_file):
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        finally:
+            budget.close()
+
+        self.assertEqual([len(results[x]) for x in ('a', 'b')], [20, 20])
+        # neither project waits for the other to finish its walk
+        first = set(hashed[:20])
+        self.assertTrue(first & set(self.paths[:20]) and first & set(self.paths[20:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class LocalIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.home_dir = os.path.join(self.root, 'public')
+        self.config_dir = os.path.join(self.root, '.backup')
+        os.makedirs(os.path.join(self.home_dir, 'a'))
+        self.write('a/one.txt', 'one')
+        self.write('two.txt', 'two')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, data):
+        with open(os.path.join(self.home_dir, name), 'w') as f:
+            f.write(data)
+
+    def sync(self):
+        from s3.utils.backup import LocalBackup
+        local = LocalBackup(HomeDir=self.home_dir, ConfigDir=self.config_dir, ExcludeDirs=[], OnlyDirs=[])
+        local.sync()
+        return local
+
+    def test_sync_reuses_unchanged_files(self):
+        local = self.sync()
+        self.assertEqual(local.stats['rehashed'], 2)
+
+        # make sure the mtime really moves on coarse filesystems
+        time.sleep(0.01)
+        self.write('two.txt', 'changed')
+        local = self.sync()
+        self.assertEqual(local.stats['rehashed'], 1)
+        self.assertEqual(local.stats['reused'], 1)
+        self.assertEqual(len(local.get_index_files()), 2)
+
+    def test_sync_removes_deleted_files(self):
+        self.sync()
+        os.remove(os.path.join(self.home_dir, 'a', 'one.txt'))
+        local = self.sync()
+        self.assertEqual(local.stats['removed'], 1)
+        self.assertEqual(len(local.get_tombstones()), 1)
+        files = local.get_index_files()
+        self.assertEqual(len(files), 1)
+        self.assertTrue(local.get_content_file(files[0]).endswith(local.get_file_hash(
+            os.path.join(self.home_dir, 'two.txt'))))
+
+    def test_empty_scan_keeps_index(self):
+        self.sync()
+        shutil.rmtree(self.home_dir)
+        os.makedirs(self.home_dir)
+        local = self.sync()
+        self.assertEqual(local.stats['removed'], 0)
+        self.assertEqual(len(local.get_index_files()), 2)
+
+    def test_unreadable_file_keeps_row(self):
+        from s3.utils import hashing
+        local = self.sync()
+        path = os.path.join(self.home_dir, 'two.txt')
+        content = local.get_content_file(local.generate_index_dirname(path) + local.generate_hash(path))
+
+        def hash_file(file_path, *args):
+            if file_path == path:
+                raise IOError(13, 'Permission denied')
+            return original(file_path, *args)
+
+        original = hashing.hash_file
+        time.sleep(0.01)
+        self.write('two.txt', 'changed')
+        with mock.patch.object(hashing, 'hash_file', hash_file):
+            local = self.sync()
+        # a read error is no deletion: the file keeps its last indexed row
+        self.assertEqual((local.stats['failed'], local.stats['removed']), (1, 0))
+        self.assertEqual(local.get_tombstones(), [])
+        self.assertEqual(local.get_content_file(local.generate_index_dirname(path) + local.generate_hash(path)),
+                         content)
+
+    def test_migrate_objects_layout(self):
+        from s3.utils import FileUtils
+        from s3.utils.index import IndexStore
+        utils = FileUtils()
+        file = os.path.join(self.home_dir, 'two.txt')
+        dir_name = utils.generate_index_dirname(file)
+        hash_path = utils.generate_hash(file)
+        objects_dir = os.path.join(self.config_dir, 'objects') + os.sep
+        utils.file_create(objects_dir + dir_name + os.sep, hash_path, file + '|' + dir_name + 'digest')
+
+        store = IndexStore(os.path.join(self.config_dir, 'index.db')).open()
+        self.assertEqual(store.migrate(objects_dir), 1)
+        self.assertFalse(os.path.exists(objects_dir))
+        self.assertEqual(store.get(dir_name + hash_path)[:3], (file, dir_name, 'digest'))
+        store.close()
+
+    def test_algorithm_change_rehashes(self):
+        from s3.utils.backup import LocalBackup
+        self.sync()
+        local = LocalBackup(HomeDir=self.home_dir, ConfigDir=self.config_dir, ExcludeDirs=[], OnlyDirs=[],
+                            Hashing={'algorithm': 'blake2b', 'pool': 'process', 'workers': 2})
+        local.sync()
+        self.assertEqual(local.stats['rehashed'], 2)
+        self.assertEqual(local.store.get_meta('algorithm'), 'blake2b')
+        content = local.get_content_file(local.get_index_files()[0])
+        self.assertEqual(len(content.split('|')[1]), 2 + 128)
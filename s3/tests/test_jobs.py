@@ -0,0 +1,91 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+
+class JobSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        from s3.utils.jobs import JobStore
+        self.root = tempfile.mkdtemp()
+        self.store = JobStore(os.path.join(self.root, 'jobs.db'))
+        self.scheduler = None
+
+    def tearDown(self):
+        if self.scheduler:
+            self.scheduler.stop(1)
+        shutil.rmtree(self.root)
+
+    def wait(self, job_id, status='done'):
+        for i in range(200):
+            job = self.store.get(job_id)
+            if job['status'] == status:
+                return job
+            time.sleep(0.01)
+        self.fail('job %s is %s' % (job_id, job['status']))
+
+    def test_job_result_and_progress(self):
+        from s3.utils.jobs import JobScheduler
+
+        def runner(job_id, project, command, progress):
+            progress(1, 2, 10, 20)
+            progress(2, 2, 20, 20)
+            return {'count': 2}
+
+        self.scheduler = JobScheduler(self.store, runner).start()
+        job = self.wait(self.scheduler.submit('test', 'push'))
+        self.assertEqual(job['result'], {'count': 2})
+        self.assertEqual((job['files_done'], job['files_total'], job['bytes_done']), (2, 2, 20))
+
+    def test_failed_job(self):
+        from s3.utils.jobs import JobScheduler
+
+        def runner(job_id, project, command, progress):
+            raise ValueError('boom')
+
+        self.scheduler = JobScheduler(self.store, runner).start()
+        job = self.wait(self.scheduler.submit('test', 'push'), 'failed')
+        self.assertEqual(job['error'], 'boom')
+
+    def test_project_limit(self):
+        from s3.utils.jobs import JobScheduler
+        release = threading.Event()
+        running = []
+
+        def runner(job_id, project, command, progress):
+            running.append(project)
+            release.wait(2)
+            return {}
+
+        self.scheduler = JobScheduler(self.store, runner, workers=3, project_limit=1).start()
+        first = self.scheduler.submit('a', 'push')
+        second = self.scheduler.submit('a', 'push')
+        other = self.scheduler.submit('b', 'push')
+        self.wait(other, 'running')
+        self.assertEqual(self.store.get(second)['status'], 'queued')
+        release.set()
+        self.wait(first)
+        self.wait(second)
+        self.assertEqual(sorted(running), ['a', 'a', 'b'])
+
+    def test_recover_only_dead_owners(self):
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        host = socket.gethostname()
+        live = '%s|%d|token' % (host, os.getppid())
+        dead = '%s|%d|token' % (host, process.pid)
+        for job_id, status, owner in (('a', 'running', live), ('b', 'queued', live), ('c', 'running', dead),
+                                      ('d', 'queued', dead), ('e', 'queued', None),
+                                      ('f', 'running', 'other-host|1|token')):
+            self.store.execute('INSERT INTO jobs (id, project, command, status, created, owner) '
+                               'VALUES (?, ?, ?, ?, ?, ?)', (job_id, 'test', 'push', status, time.time(), owner))
+
+        # another worker restarting leaves the jobs of the live ones alone
+        self.assertEqual(sorted(x[0] for x in self.store.recover()), ['d', 'e'])
+        self.assertEqual([self.store.get(x)['status'] for x in 'abcf'], ['running', 'queued', 'failed', 'running'])
+        self.assertEqual(self.store.get('d')['owner'], self.store.owner)
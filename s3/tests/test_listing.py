@@ -0,0 +1,114 @@
+import datetime
+import shutil
+import tempfile
+import unittest
+
+
+class FakeClient(object):
+    """ list_objects_v2 with Delimiter and head_object over a dict of key: etag """
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.listed = []
+        self.heads = 0
+
+    def get_paginator(self, name):
+        client = self
+
+        class Paginator(object):
+            def paginate(self, Bucket, Prefix='', Delimiter=None):
+                client.listed.append(Prefix)
+                contents = []
+                prefixes = set()
+                for key in sorted(client.objects):
+                    if not key.startswith(Prefix):
+                        continue
+                    rest = key[len(Prefix):]
+                    if Delimiter and Delimiter in rest:
+                        prefixes.add(Prefix + rest.split(Delimiter)[0] + Delimiter)
+                    else:
+                        contents.append({'Key': key, 'Size': 1, 'ETag': client.objects[key],
+                                         'LastModified': datetime.datetime(2024, 1, 1)})
+                yield {'Contents': contents, 'CommonPrefixes': [{'Prefix': x} for x in sorted(prefixes)]}
+        return Paginator()
+
+    def head_object(self, Bucket, Key):
+        self.heads += 1
+        return {'ETag': self.objects[Key]}
+
+
+class BucketListerTest(unittest.TestCase):
+    def setUp(self):
+        from s3.utils.resumable import CheckpointStore
+        from s3.utils.throttle import Throttle
+        self.root = tempfile.mkdtemp()
+        self.client = FakeClient({
+            '.index_s3': '"i1"',
+            'a/one': '"1"',
+            'a/b/two': '"2"',
+            'c/three': '"3"',
+            'archive/old': '"4"',
+            'skip/four': '"5"',
+        })
+        self.cache = CheckpointStore(self.root)
+        self.throttle = Throttle()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def lister(self, cache=True):
+        from s3.utils.listing import BucketLister
+        return BucketLister(self.client, 'bucket', self.throttle, 2, self.cache if cache else None, '.index_s3')
+
+    def test_pushdown(self):
+        objects = self.lister(False).list(exclude_dirs=['skip'], skip=('archive/',))
+        self.assertEqual(sorted(objects), ['.index_s3', 'a/b/two', 'a/one', 'c/three'])
+        self.assertEqual(sorted(self.client.listed), ['', 'a/', 'c/'])
+
+        self.client.listed = []
+        objects = self.lister(False).list(only_dirs=['c'])
+        self.assertEqual(sorted(objects), ['c/three'])
+        self.assertEqual(self.client.listed, ['c/'])
+
+    def test_revalidation(self):
+        lister = self.lister()
+        first = lister.list()
+        self.client.listed = []
+
+        # unchanged index: one HEAD, no listing
+        second = self.lister().list()
+        self.assertEqual(self.client.listed, [])
+        self.assertEqual(sorted(first), sorted(second))
+        self.assertEqual(second['a/one']['LastModified'], datetime.datetime(2024, 1, 1))
+
+        # a push of our own: only the written prefix is listed again
+        lister = self.lister()
+        old = lister.validator()
+        lister.invalidate(['a/new'])
+        self.client.objects['a/new'] = '"6"'
+        self.client.objects['.index_s3'] = '"i2"'
+        lister.stamp(old, lister.validator())
+        self.assertIn('a/new', self.lister().list())
+        self.assertEqual(self.client.listed, ['a/'])
+
+        # somebody else's push: everything is listed again
+        self.client.listed = []
+        self.client.objects['.index_s3'] = '"i3"'
+        self.lister().list()
+        self.assertEqual(sorted(self.client.listed), ['', 'a/', 'archive/', 'c/', 'skip/'])
+
+    def test_new_prefix(self):
+        lister = self.lister()
+        lister.list()
+        old = lister.validator()
+        lister.invalidate(['d/new'])
+        self.client.objects['d/new'] = '"7"'
+        self.client.objects['.index_s3'] = '"i2"'
+        lister.stamp(old, lister.validator())
+        self.client.listed = []
+        self.assertIn('d/new', self.lister().list())
+        self.assertEqual(sorted(self.client.listed), ['', 'd/'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+
+class LeaseLockTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, '.backup', '.lock_test')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def lock(self, **kwargs):
+        from s3.utils.lock import LeaseLock
+        return LeaseLock(self.path, **kwargs)
+
+    def write_lease(self, **values):
+        lease = {'token': 'old', 'pid': os.getpid(), 'hostname': 'elsewhere',
+                 'acquired': time.time(), 'renewed': time.time()}
+        lease.update(values)
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write(json.dumps(lease))
+
+    def test_exclusive(self):
+        from s3.utils.lock import LockBusy
+        first = self.lock().acquire()
+        try:
+            self.assertTrue(self.lock().is_locked())
+            self.assertRaises(LockBusy, self.lock().acquire)
+        finally:
+            first.release()
+        self.assertFalse(os.path.exists(self.path))
+        self.lock().acquire().release()
+
+    def test_expired_lease_is_broken(self):
+        self.write_lease(renewed=time.time() - 3600)
+        lock = self.lock().acquire()
+        self.assertTrue(lock.held)
+        lock.release()
+
+    def test_dead_pid_is_broken(self):
+        from s3.utils.lock import LeaseLock
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.write_lease(pid=pid, hostname=LeaseLock(self.path).hostname)
+        self.lock().acquire().release()
+
+    def test_wait_with_timeout(self):
+        first = self.lock().acquire()
+        threading.Timer(0.2, first.release).start()
+        second = self.lock().acquire(timeout=5, poll=0.05)
+        self.assertTrue(second.held)
+        second.release()
+
+    def test_heartbeat_renews(self):
+        lock = self.lock(lease=0.3, heartbeat=0.05).acquire()
+        try:
+            time.sleep(0.5)
+            self.assertTrue(self.lock(lease=0.3).is_locked())
+            self.assertFalse(lock.lost)
+        finally:
+            lock.release()
@@ -0,0 +1,50 @@
+import unittest
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        from s3.utils.metrics import Registry, Metrics
+        self.registry = Registry()
+        self.metrics = Metrics('test', self.registry)
+
+    def test_counters_and_exposition(self):
+        from s3.utils.metrics import throttle_values
+        self.metrics.transfer('upload', 100, 0.02)
+        self.metrics.transfer('upload', 50, 0.2)
+        self.metrics.transfer('upload', 0, error=IOError('reset'))
+        text = self.registry.render(throttle_values(
+            {'abc': {'bytes_per_sec': 1.5, 'requests_per_sec': 2, 'total_requests': 7, 'slowdowns': 1,
+                     'retries': 1, 'throttled_seconds': 0.5}}, {'abc': 'test'}))
+        lines = text.split('\n')
+
+        self.assertIn('# TYPE backup_bytes_total counter', lines)
+        self.assertIn('backup_bytes_total{direction="upload",project="test"} 150', lines)
+        self.assertIn('backup_errors_total{direction="upload",project="test"} 1', lines)
+        self.assertIn('backup_transfer_seconds_bucket{direction="upload",project="test",le="0.025"} 1', lines)
+        self.assertIn('backup_transfer_seconds_bucket{direction="upload",project="test",le="0.25"} 2', lines)
+        self.assertIn('backup_transfer_seconds_bucket{direction="upload",project="test",le="+Inf"} 2', lines)
+        self.assertIn('backup_transfer_seconds_count{direction="upload",project="test"} 2', lines)
+        self.assertIn('backup_throttle_retries_total{project="test"} 1', lines)
+        self.assertIn('backup_throttle_bytes_per_sec{project="test"} 1.5', lines)
+
+    def test_timed_walk(self):
+        items = list(self.metrics.timed(iter(range(5)), 'scan', 'backup_files_scanned_total'))
+        self.assertEqual(items, [0, 1, 2, 3, 4])
+        self.assertEqual(self.registry.get('backup_files_scanned_total', project='test'), 5)
+        self.assertEqual(self.registry.get('backup_phase_seconds', project='test', phase='scan').count, 1)
+
+    def test_phase_timed_on_error(self):
+        try:
+            with self.metrics.phase('diff'):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertIsNotNone(self.registry.get('backup_phase_last_seconds', project='test', phase='diff'))
+
+    def test_undeclared(self):
+        self.assertRaises(ValueError, self.registry.inc, 'backup_unknown_total')
+        self.assertRaises(ValueError, self.registry.observe, 'backup_files_total', 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
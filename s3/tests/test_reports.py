@@ -0,0 +1,57 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class ReportAggregatorTest(unittest.TestCase):
+    def setUp(self):
+        from s3.utils.reports import write_record
+        self.root = tempfile.mkdtemp()
+        self.dirs = [os.path.join(self.root, 'one'), os.path.join(self.root, 'two')]
+        write_record(self.dirs[0], 'alpha', {'project': 'alpha', 'count': 1})
+        write_record(self.dirs[0], 'alpha', {'project': 'alpha', 'count': 2})
+        write_record(self.dirs[1], 'beta', {'project': 'beta', 'count': 3})
+        with open(os.path.join(self.dirs[1], 'gamma'), 'w') as f:
+            f.write('<div>gamma</div>')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def aggregator(self):
+        from s3.utils.reports import ReportAggregator
+        return ReportAggregator(self.dirs, 5)
+
+    def test_json(self):
+        report = json.loads(''.join(self.aggregator().json()))
+        self.assertEqual((report['project_count'], report['edited_count']), (5, 3))
+        self.assertEqual([x.get('count') for x in report['records']], [1, 2, 3, None])
+        self.assertEqual(report['records'][3], {'html': '<div>gamma</div>'})
+
+    def test_html(self):
+        from s3.utils import reports
+        templates = dict(reports._templates)
+        reports._templates['mail_base.pt'] = lambda **kw: '<h4>%(edited_count)d</h4>%(content)s</body>' % kw
+        reports._templates['mail_report.pt'] = lambda **kw: '<div>%(project)s %(count)d</div>' % kw
+        try:
+            chunks = list(self.aggregator().html())
+        finally:
+            reports._templates.clear()
+            reports._templates.update(templates)
+        self.assertEqual(chunks, ['<h4>3</h4>', '<div>alpha 1</div>', '<div>alpha 2</div>', '<div>beta 3</div>',
+                                  '<div>gamma</div>', '</body>'])
+
+    def test_claim(self):
+        from s3.utils.reports import write_record
+        aggregator = self.aggregator()
+        files = aggregator.claim(aggregator.files())
+        self.assertTrue(all(x.endswith('.sending') for x in files))
+        # runs after the claim go to a new file, the claimed ones are still listed
+        write_record(self.dirs[0], 'alpha', {'project': 'alpha', 'count': 4})
+        self.assertEqual(len(list(aggregator.files())), 4)
+        self.assertEqual([x.get('count') for x in aggregator.records(files)], [1, 2, 3, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
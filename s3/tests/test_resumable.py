@@ -0,0 +1,140 @@
+import datetime
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from botocore.exceptions import ClientError
+
+
+class FakeS3(object):
+    """ in-memory multipart uploads and ranged GETs """
+
+    def __init__(self):
+        self.uploads = {}
+        self.objects = {}
+        self.fail_part = None
+        self.sent = []
+        self.aborted = []
+
+    def get_paginator(self, name):
+        client = self
+
+        class Paginator(object):
+            def paginate(self, **kwargs):
+                if name == 'list_parts':
+                    if kwargs['UploadId'] not in client.uploads:
+                        raise ClientError({'Error': {'Code': 'NoSuchUpload'}}, 'ListParts')
+                    parts = client.uploads[kwargs['UploadId']]['parts']
+                    yield {'Parts': [{'PartNumber': k, 'ETag': '"%d"' % k} for k in sorted(parts)]}
+                else:
+                    yield {'Uploads': [{'Key': v['key'], 'UploadId': k, 'Initiated': v['initiated']}
+                                       for k, v in client.uploads.items()]}
+        return Paginator()
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = 'upload%d' % len(self.uploads)
+        self.uploads[upload_id] = {'key': Key, 'parts': {}, 'initiated': datetime.datetime.utcnow()}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_part:
+            raise IOError('connection reset')
+        self.sent.append(PartNumber)
+        self.uploads[UploadId]['parts'][PartNumber] = Body
+        return {'ETag': '"%d"' % PartNumber}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)['parts']
+        self.objects[Key] = b''.join(parts[x['PartNumber']] for x in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(UploadId)
+        self.uploads.pop(UploadId, None)
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        data = self.objects[Key]
+        if IfMatch is not None and IfMatch != '"v1"':
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'GetObject')
+        if Range:
+            data = data[int(Range[len('bytes='):-1]):]
+        return {'Body': io.BytesIO(data), 'ETag': '"v1"'}
+
+
+class BrokenBody(object):
+    def __init__(self, data, limit):
+        self.stream = io.BytesIO(data[:limit])
+
+    def read(self, size):
+        data = self.stream.read(size)
+        if not data:
+            raise IOError('connection reset')
+        return data
+
+
+class ResumableTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.data = os.urandom(5 * 1024 + 100)
+        self.path = os.path.join(self.root, 'big.bin')
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        self.client = FakeS3()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def uploader(self):
+        from s3.utils.resumable import CheckpointStore, ResumableUploader
+        from s3.utils.throttle import Throttle
+        settings = {'multipart_chunksize': 1024, 'multipart_concurrency': 1}
+        return ResumableUploader(self.client, 'bucket', settings,
+                                 CheckpointStore(os.path.join(self.root, 'multipart')), Throttle())
+
+    def test_upload_resumes_after_failure(self):
+        self.client.fail_part = 4
+        self.assertRaises(IOError, self.uploader().upload, self.path, 'big.bin')
+        self.assertEqual(self.client.sent, [1, 2, 3, 5, 6])
+
+        self.client.fail_part = None
+        self.uploader().upload(self.path, 'big.bin')
+        # only the failed part is sent again
+        self.assertEqual(self.client.sent, [1, 2, 3, 5, 6, 4])
+        self.assertEqual(self.client.objects['big.bin'], self.data)
+        self.assertEqual(os.listdir(os.path.join(self.root, 'multipart')), [])
+
+    def test_changed_file_restarts(self):
+        self.client.fail_part = 2
+        self.assertRaises(IOError, self.uploader().upload, self.path, 'big.bin')
+        with open(self.path, 'ab') as f:
+            f.write(b'more')
+
+        self.client.fail_part = None
+        self.uploader().upload(self.path, 'big.bin')
+        self.assertEqual(self.client.aborted, ['upload0'])
+        self.assertEqual(self.client.objects['big.bin'], self.data + b'more')
+
+    def test_abort_stale(self):
+        self.client.fail_part = 2
+        self.assertRaises(IOError, self.uploader().upload, self.path, 'big.bin')
+        self.assertEqual(self.uploader().abort_stale(3600), 0)
+        self.assertEqual(self.uploader().abort_stale(-1), 1)
+        self.assertEqual(self.client.uploads, {})
+
+    def test_ranged_get_resumes(self):
+        from s3.utils.resumable import ResumableDownloader
+        from s3.utils.throttle import Throttle
+        self.client.objects['big.bin'] = self.data
+        downloader = ResumableDownloader(self.client, 'bucket', Throttle(), read_size=512)
+
+        get_object = self.client.get_object
+        self.client.get_object = lambda **kwargs: dict(get_object(**kwargs), Body=BrokenBody(self.data, 2048))
+        self.assertRaises(IOError, downloader.download, 'big.bin', self.root)
+        partial = downloader.partial_path(self.root, 'big.bin')
+        self.assertEqual(os.path.getsize(partial), 2048)
+
+        self.client.get_object = get_object
+        path = downloader.download('big.bin', self.root, '"v1"')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
@@ -0,0 +1,93 @@
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class FakeClient(object):
+    def __init__(self, objects=None):
+        self.objects = objects or {}
+        self.deleted = []
+
+    def get_paginator(self, name):
+        client = self
+
+        class Paginator(object):
+            def paginate(self, Bucket, Prefix):
+                yield {'Contents': [dict(value, Key=key) for key, value in sorted(client.objects.items())
+                                    if key.startswith(Prefix)]}
+        return Paginator()
+
+    def upload_file(self, path, bucket, key, ExtraArgs=None):
+        self.objects[key] = {'StorageClass': ExtraArgs['StorageClass'],
+                             'LastModified': datetime.datetime.utcnow()}
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete['Objects']:
+            self.deleted.append(item['Key'])
+            del self.objects[item['Key']]
+
+
+class RetentionTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.now = datetime.datetime(2026, 10, 18, 12, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def dump_dirs(self, days):
+        for day in days:
+            name = (self.now - datetime.timedelta(days=day)).strftime('%m_%d_%Y___%H_%M_%S')
+            os.makedirs(os.path.join(self.root, name))
+            with open(os.path.join(self.root, name, 'test.sql.gz'), 'wb') as f:
+                f.write(b'dump')
+
+    def test_select(self):
+        from s3.utils.retention import Artifact, select
+        artifacts = [Artifact(str(x), self.now - datetime.timedelta(days=x), []) for x in range(400)]
+        kept = select(artifacts, daily=7, weekly=4, monthly=12)
+        # 7 days, 4 weeks and 12 months, overlapping at the newest copies
+        self.assertTrue(set(str(x) for x in range(7)) <= kept)
+        self.assertIn('399', set(str(x) for x in range(400)) - kept)
+        self.assertTrue(15 <= len(kept) <= 23)
+
+    def test_local_prune(self):
+        from s3.utils.retention import DUMP_FORMAT, RetentionEngine
+        self.dump_dirs(range(10))
+        stats = RetentionEngine(self.root, DUMP_FORMAT, {'daily': 3, 'weekly': 0, 'monthly': 0, 'local_days': None},
+                                now=self.now).run()
+
+        self.assertEqual((stats['kept'], stats['pruned']), (3, 7))
+        self.assertEqual(len(os.listdir(self.root)), 3)
+
+    def test_cold_upload_and_lifecycle(self):
+        from s3.utils.retention import DUMP_FORMAT, RetentionEngine
+        self.dump_dirs([0, 1, 20])
+        # archived copy outside the policy, uploaded 10 days ago as STANDARD_IA (30 days minimum)
+        client = FakeClient({'archive/01_01_2025___00_00_00/test.sql.gz': {
+            'StorageClass': 'STANDARD_IA',
+            'LastModified': datetime.datetime.utcnow() - datetime.timedelta(days=10)}})
+        settings = {'daily': 3, 'weekly': 0, 'monthly': 0, 'local_days': 14, 'storage_class': 'GLACIER'}
+        stats = RetentionEngine(self.root, DUMP_FORMAT, settings, client, 'bucket', 'archive/', now=self.now).run()
+
+        self.assertEqual(stats['uploaded'], 1)
+        self.assertEqual(len(os.listdir(self.root)), 2)
+        cold = [k for k, v in client.objects.items() if v['StorageClass'] == 'GLACIER']
+        self.assertEqual(len(cold), 1)
+        self.assertEqual((stats['deferred'], client.deleted), (1, []))
+
+    def test_compact_history(self):
+        from s3.utils.retention import compact_history
+        day = os.path.join(self.root, '01_10_2026')
+        os.makedirs(day)
+        for i, names in enumerate((['b', 'a'], ['a', 'c'])):
+            with open(os.path.join(day, '.local_%d' % i), 'w') as f:
+                f.write('\n'.join(names))
+
+        self.assertEqual(compact_history(self.root, 2, self.now), 1)
+        self.assertEqual(os.listdir(self.root), ['01_10_2026.gz'])
+        with gzip.open(os.path.join(self.root, '01_10_2026.gz')) as f:
+            self.assertEqual(f.read(), b'a\nb\nc')
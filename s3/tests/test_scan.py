@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class ScanDirTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp() + os.sep
+        for path in ('root.txt', 'a/a.txt', 'a/b/b.txt', 'ab/ab.txt', 'c/c.txt', '.git/HEAD', 'c/.backup/x'):
+            path = os.path.join(self.root, path)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def scan(self, *args, **kwargs):
+        from s3.utils import FileUtils
+        return sorted(x[len(self.root):] for x in FileUtils().scan_dir(self.root, *args, **kwargs))
+
+    def test_scan_all(self):
+        self.assertEqual(self.scan([], []), ['a/a.txt', 'a/b/b.txt', 'ab/ab.txt', 'c/c.txt', 'root.txt'])
+
+    def test_exclude_is_a_string_prefix(self):
+        self.assertEqual(self.scan(['a'], []), ['c/c.txt', 'root.txt'])
+        self.assertEqual(self.scan(['a/b'], []), ['a/a.txt', 'ab/ab.txt', 'c/c.txt', 'root.txt'])
+
+    def test_only_dirs_descend_to_nested_rule(self):
+        self.assertEqual(self.scan([], ['a/b']), ['a/b/b.txt', 'root.txt'])
+        self.assertEqual(self.scan([], ['c'], root_files=False), ['c/c.txt'])
+
+    def test_prefix_trie(self):
+        from s3.utils.matcher import PrefixTrie
+        trie = PrefixTrie(['a/b', 'c'])
+        self.assertTrue(trie.matches('a/b/c'))
+        self.assertTrue(trie.matches('cd'))
+        self.assertFalse(trie.matches('a'))
+        self.assertTrue(trie.leads_to('a'))
+        self.assertFalse(trie.leads_to('b'))
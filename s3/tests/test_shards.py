@@ -0,0 +1,137 @@
+import io
+import shutil
+import tempfile
+import unittest
+
+from botocore.exceptions import ClientError
+
+
+class FakeS3(object):
+    def __init__(self):
+        self.objects = {}
+        self.puts = []
+        self.gets = []
+
+    def get_object(self, Bucket, Key):
+        self.gets.append(Key)
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        self.puts.append(Key)
+        self.objects[Key] = Body
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete['Objects']:
+            self.objects.pop(item['Key'], None)
+
+
+def name(shard, n):
+    # dir hash + path hash, the shard is chars 2:4
+    return 'xx' + shard + '%036d' % n
+
+
+class ShardedIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.client = FakeS3()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def index(self, local_dir):
+        from s3.utils.shards import ShardedIndex
+        from s3.utils.throttle import Throttle
+        return ShardedIndex(self.client, 'bucket', Throttle(), '.index_s3', self.root + '/' + local_dir,
+                            {'files': '.index_s3', 'digests': '.index_s3_digests'}, 2, 2)
+
+    def test_incremental(self):
+        writer = self.index('writer')
+        writer.sync()
+        names = [name(x, n) for x in ('0a', '1b', '2c') for n in range(3)]
+        writer.commit({'files': (names, []), 'digests': (['xx0a' + 'f' * 30], [])})
+        self.assertEqual(len([x for x in self.client.puts if x.endswith('.gz')]), 4)
+        self.assertEqual(sorted(writer.lines('files')), sorted(names))
+
+        reader = self.index('reader')
+        reader.sync()
+        self.assertEqual(reader.stats['downloaded'], 4)
+        self.assertEqual(sorted(reader.lines('files')), sorted(names))
+        self.assertEqual((reader.count('files'), reader.count('digests')), (9, 1))
+
+        # one changed shard: one upload, one download
+        self.client.puts = []
+        writer.commit({'files': ([name('1b', 9)], [name('1b', 0)])})
+        self.assertEqual([x.split('.')[2] for x in self.client.puts], ['d/files/1b', 'json'])
+        reader.sync()
+        self.assertEqual((reader.stats['downloaded'], reader.stats['reused']), (1, 3))
+        self.assertIn(name('1b', 9), list(reader.lines('files')))
+        self.assertNotIn(name('1b', 0), list(reader.lines('files')))
+
+        # nothing changed, nothing uploaded
+        self.client.puts = []
+        self.assertEqual(writer.commit({'files': ([name('1b', 9)], [])}), 0)
+        self.assertEqual(self.client.puts, [])
+
+    def test_failed_upload_keeps_manifest(self):
+        writer = self.index('writer')
+        writer.sync()
+        writer.commit({'files': ([name('0a', 1)], [])})
+        manifest = self.client.objects['.index_s3.json']
+
+        def fail(**kwargs):
+            raise IOError('reset')
+        self.client.put_object = fail
+        self.assertRaises(IOError, writer.commit, {'files': ([name('1b', 1)], [])})
+        self.assertEqual(self.client.objects['.index_s3.json'], manifest)
+        self.assertEqual(list(writer.lines('files')), [name('0a', 1)])
+
+    def test_reverted_shard_is_not_collected(self):
+        from s3.utils import shards
+        ttl = shards.GARBAGE_TTL
+        shards.GARBAGE_TTL = 0
+        try:
+            writer = self.index('writer')
+            writer.sync()
+            writer.commit({'files': ([name('0a', 1)], [])})
+            writer.commit({'files': ([name('0a', 2)], [])})
+            # back to the first content: its key is live again and stays in the bucket
+            writer.commit({'files': ([], [name('0a', 2)])})
+        finally:
+            shards.GARBAGE_TTL = ttl
+        key = writer.manifest['shards']['files/0a']['key']
+        self.assertIn(key, self.client.objects)
+        self.assertNotIn(key, [x[0] for x in writer.manifest['garbage']])
+        reader = self.index('reader')
+        reader.sync()
+        self.assertEqual(list(reader.lines('files')), [name('0a', 1)])
+
+    def test_emptied_shard_is_not_uploaded(self):
+        writer = self.index('writer')
+        writer.sync()
+        writer.commit({'files': ([name('0a', 1), name('1b', 1)], [])})
+        self.client.puts = []
+        writer.commit({'files': ([], [name('1b', 1)])})
+        self.assertEqual(self.client.puts, ['.index_s3.json'])
+        self.assertEqual(sorted(writer.manifest['shards']), ['files/0a'])
+        self.assertEqual(len(writer.manifest['garbage']), 1)
+
+    def test_legacy(self):
+        self.client.objects['.index_s3'] = ('\n'.join([name('0a', 1), name('1b', 2)]) + '\n').encode('utf-8')
+        index = self.index('local')
+        index.sync()
+        self.assertEqual(sorted(index.lines('files')), [name('0a', 1), name('1b', 2)])
+        self.assertEqual(index.count('files'), 2)
+
+        # the first change reshards the whole legacy index
+        index.commit({'files': ([name('2c', 3)], [name('0a', 1)])})
+        self.assertTrue(index.manifest)
+        self.assertEqual(sorted(index.lines('files')), [name('1b', 2), name('2c', 3)])
+        reader = self.index('reader')
+        reader.sync()
+        self.assertEqual(sorted(reader.lines('files')), [name('1b', 2), name('2c', 3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
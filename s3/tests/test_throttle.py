@@ -0,0 +1,83 @@
+import time
+import unittest
+
+
+class TokenBucketTests(unittest.TestCase):
+    def test_rate(self):
+        from s3.utils.throttle import TokenBucket
+        bucket = TokenBucket(1000)
+        start = time.time()
+        for i in range(4):
+            bucket.consume(500)
+        # one second of burst, then 1000 tokens/s
+        self.assertGreaterEqual(time.time() - start, 0.9)
+
+    def test_unlimited(self):
+        from s3.utils.throttle import TokenBucket
+        self.assertEqual(TokenBucket().consume(10 ** 9), 0)
+
+
+class ThrottleTests(unittest.TestCase):
+    def test_windows(self):
+        from s3.utils.throttle import Throttle
+        now = time.mktime((2026, 10, 19, 10, 0, 0, 0, 0, -1))  # monday 10:00
+        throttle = Throttle({'bytes_per_sec': None, 'windows': [
+            {'days': [0, 1, 2, 3, 4], 'hours': [8, 20], 'bytes_per_sec': 100},
+            {'hours': [22, 6], 'requests_per_sec': 5},
+        ]})
+        self.assertEqual(throttle.limits(now), (100, None))
+        self.assertEqual(throttle.limits(now + 13 * 3600), (None, 5))
+        self.assertEqual(throttle.limits(now + 5 * 24 * 3600), (None, None))
+
+    def test_slowdown_retry(self):
+        from botocore.exceptions import ClientError
+        from s3.utils.throttle import Throttle
+        throttle = Throttle({'requests_per_sec': 1000, 'backoff_base': 0.01})
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ClientError({'Error': {'Code': 'SlowDown'}}, 'PutObject')
+            return 'ok'
+
+        self.assertEqual(throttle.call(flaky), 'ok')
+        self.assertEqual(throttle.metrics()['slowdowns'], 2)
+        self.assertEqual(throttle.requests.rate, 250)
+
+    def test_wrapped_slowdown_retry(self):
+        import tempfile
+        from boto3.exceptions import S3UploadFailedError
+        from botocore.exceptions import ClientError
+        from s3.utils.throttle import Throttle
+        from s3.utils.transfer import UploadEngine
+        calls = []
+
+        class Client(object):
+            def upload_file(self, path, bucket, key, Config=None, Callback=None):
+                calls.append(key)
+                if len(calls) < 2:
+                    # what boto3's upload_file raises for a single part upload
+                    try:
+                        raise ClientError({'Error': {'Code': 'SlowDown'}}, 'PutObject')
+                    except ClientError as e:
+                        raise S3UploadFailedError('Failed to upload %s to %s/%s: %s' % (path, bucket, key, e))
+
+        throttle = Throttle({'requests_per_sec': 1000, 'backoff_base': 0.01})
+        engine = UploadEngine(Client(), 'bucket', throttle=throttle)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'data')
+            f.flush()
+            self.assertEqual(engine.upload({'path': f.name, 'key': 'a/b'}), 4)
+        self.assertEqual(calls, ['a/b', 'a/b'])
+        self.assertEqual(throttle.metrics()['slowdowns'], 1)
+        self.assertEqual(throttle.requests.rate, 500)
+
+    def test_other_errors_are_raised(self):
+        from botocore.exceptions import ClientError
+        from s3.utils.throttle import Throttle
+
+        def denied():
+            raise ClientError({'Error': {'Code': 'AccessDenied'}}, 'PutObject')
+
+        self.assertRaises(ClientError, Throttle().call, denied)
@@ -0,0 +1,140 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+
+class UploadClient(object):
+    """ upload_file recording the uploads in flight, failing for keys in `fail` """
+
+    def __init__(self, fail=()):
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.keys = []
+
+    def upload_file(self, path, bucket, key, Config=None, Callback=None):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            time.sleep(0.01)
+            if key in self.fail:
+                raise IOError('connection reset')
+            with self.lock:
+                self.keys.append(key)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+class UploadEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.items = []
+        for i in range(20):
+            path = os.path.join(self.root, 'file_%d' % i)
+            with open(path, 'wb') as f:
+                f.write(b'x' * (i + 1))
+            self.items.append({'path': path, 'key': 'dir/file_%d' % i})
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_run(self):
+        from s3.utils.transfer import UploadEngine
+        client = UploadClient(fail=('dir/file_3', 'dir/file_7'))
+        engine = UploadEngine(client, 'bucket', {'workers': 3})
+        finished = []
+        stats = engine.run(iter(self.items), lambda item, error: finished.append((item['key'], error)))
+
+        self.assertTrue(1 < client.peak <= 3)
+        # once per item, failures with their error
+        self.assertEqual(sorted(x[0] for x in finished), sorted(x['key'] for x in self.items))
+        errors = dict((k, e) for k, e in finished if e is not None)
+        self.assertEqual(sorted(errors), ['dir/file_3', 'dir/file_7'])
+        self.assertTrue(isinstance(errors['dir/file_3'], IOError))
+
+        self.assertEqual((stats['count'], stats['errors']), (18, 2))
+        self.assertEqual(stats['bytes'], sum(range(1, 21)) - 4 - 8)
+        self.assertEqual(sorted(client.keys), sorted(k for k, e in finished if e is None))
+        self.assertEqual(stats['files_per_sec'], round(18 / stats['elapsed'], 2))
+        self.assertEqual(self.items[0]['size'], 1)
+
+    def test_throughput(self):
+        from s3.utils.transfer import MB, throughput
+        stats = throughput({'count': 10, 'bytes': 4 * MB, 'elapsed': 2.0})
+        self.assertEqual((stats['files_per_sec'], stats['mb_per_sec']), (5.0, 2.0))
+        stats = throughput({'count': 0, 'bytes': 0, 'elapsed': 0})
+        self.assertEqual((stats['files_per_sec'], stats['mb_per_sec']), (0, 0))
+
+
+class DownloadClient(object):
+    """ download_file writing the object, or half of it before failing """
+
+    def __init__(self, objects, fail=()):
+        self.objects = objects
+        self.fail = fail
+
+    def download_file(self, bucket, key, path, Config=None, Callback=None):
+        with open(path, 'wb') as f:
+            if key in self.fail:
+                f.write(self.objects[key][:2])
+                raise IOError('connection reset')
+            f.write(self.objects[key])
+
+
+class DownloadEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.home = os.path.join(self.root, 'home')
+        self.tmp = os.path.join(self.root, 'tmp')
+        os.makedirs(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def engine(self, client):
+        from s3.utils.transfer import DownloadEngine
+        return DownloadEngine(client, 'bucket', {'workers': 2}, self.tmp)
+
+    def test_fetch(self):
+        engine = self.engine(DownloadClient({'a/b.txt': b'content'}))
+        path = os.path.join(self.home, 'a', 'b.txt')
+        self.assertEqual(engine.fetch({'key': 'a/b.txt', 'path': path, 'size': 7}), 7)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'content')
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_failed_fetch_leaves_no_partial_file(self):
+        path = os.path.join(self.home, 'b.txt')
+        os.makedirs(self.home)
+        with open(path, 'wb') as f:
+            f.write(b'old')
+        engine = self.engine(DownloadClient({'b.txt': b'content', 'c.txt': b'content'}, fail=('b.txt', 'c.txt')))
+        stats = engine.run([{'key': 'b.txt', 'path': path, 'size': 7},
+                            {'key': 'c.txt', 'path': os.path.join(self.home, 'c.txt'), 'size': 7}])
+        self.assertEqual((stats['count'], stats['errors']), (0, 2))
+        # the old copy stays, nothing half written appears next to it
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'old')
+        self.assertEqual(os.listdir(self.home), ['b.txt'])
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_clear_tmp(self):
+        engine = self.engine(DownloadClient({}))
+        for name in ('.s3tmp_1', '.s3part_fresh', '.s3part_old', 'other'):
+            with open(os.path.join(self.tmp, name), 'wb') as f:
+                f.write(b'x')
+        old = time.time() - engine.settings['multipart_ttl'] - 60
+        os.utime(os.path.join(self.tmp, '.s3part_old'), (old, old))
+        engine.clear_tmp()
+        # killed downloads are dropped, partial ranged downloads only once expired
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['.s3part_fresh', 'other'])
+
+
+if __name__ == '__main__':
+    unittest.main()
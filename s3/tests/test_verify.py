@@ -0,0 +1,145 @@
+import hashlib
+import io
+import unittest
+
+
+class FakeClient(object):
+    """ list_objects_v2 with Delimiter and get_object over a dict of key: content """
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.listed = []
+
+    def get_paginator(self, name):
+        client = self
+
+        class Paginator(object):
+            def paginate(self, Bucket, Prefix='', Delimiter=None):
+                client.listed.append(Prefix)
+                contents = []
+                prefixes = set()
+                for key in sorted(client.objects):
+                    if not key.startswith(Prefix):
+                        continue
+                    rest = key[len(Prefix):]
+                    if Delimiter and Delimiter in rest:
+                        prefixes.add(Prefix + rest.split(Delimiter)[0] + Delimiter)
+                    else:
+                        data = client.objects[key]
+                        contents.append({'Key': key, 'Size': len(data),
+                                         'ETag': '"%s"' % hashlib.md5(data).hexdigest()})
+                yield {'Contents': contents, 'CommonPrefixes': [{'Prefix': x} for x in sorted(prefixes)]}
+        return Paginator()
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+
+class Bucket(object):
+    name = 'bucket'
+
+
+class Master(object):
+    home_dir = '/home/'
+    dedup = False
+
+    def __init__(self, client, index):
+        from s3.utils.throttle import Throttle
+        self.client = client
+        self.bucket = Bucket()
+        self.throttle = Throttle()
+        self.index = index
+
+    def get_index_files(self):
+        return list(self.index)
+
+    def get_index_digests(self):
+        return list(self.index.values())
+
+    def is_backup_key(self, key):
+        return not key.startswith('.index')
+
+
+class Hasher(object):
+    algorithm = 'md5'
+
+
+class Slave(object):
+    hasher = Hasher()
+
+    def __init__(self, rows, tombstones=()):
+        self.rows = rows
+        self.tombstones = tombstones
+
+    def get_index_stat_entries(self):
+        return iter(self.rows)
+
+    def get_tombstones(self):
+        return iter(self.tombstones)
+
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+class VerifierTest(unittest.TestCase):
+    def setUp(self):
+        self.objects = {
+            'a/one': b'one',
+            'a/two': b'two',
+            'b/c/three': b'three',
+            'b/stray': b'stray',
+            'gone': b'gone',
+            '.index_s3': b'',
+        }
+        self.client = FakeClient(self.objects)
+        # name: (path, content); 'missing' is indexed but not in the bucket, 'two' differs there
+        local = {
+            'n1': ('/home/a/one', b'one'),
+            'n2': ('/home/a/two', b'2'),
+            'n3': ('/home/b/c/three', b'three'),
+            'n4': ('/home/missing', b'four'),
+        }
+        self.rows = [(name, path, 'xx', md5(data), len(data)) for name, (path, data) in sorted(local.items())]
+        self.index = dict((name, 'xx' + md5(data)) for name, (path, data) in local.items())
+        self.tombstones = [('n5', '/home/gone', 0)]
+        self.index['n5'] = 'xx' + md5(b'gone')
+
+    def verifier(self, settings=None):
+        from s3.utils.verify import Verifier
+        return Verifier(Master(self.client, self.index), Slave(self.rows, self.tombstones), settings)
+
+    def test_drift(self):
+        report = self.verifier().run()
+
+        self.assertFalse(report['ok'])
+        self.assertEqual(report['drift']['missing'], ['missing'])
+        self.assertEqual([x['key'] for x in report['drift']['size_mismatch']], ['a/two'])
+        # a deleted file stays in the bucket during the grace period, only stray is unknown
+        self.assertEqual(report['drift']['unindexed'], ['b/stray'])
+        self.assertEqual(report['counts']['matching'], 2)
+        self.assertEqual(report['counts']['deleted_locally'], 1)
+        # one listing per top level prefix
+        self.assertEqual(sorted(self.client.listed), ['', 'a/', 'b/'])
+
+    def test_etag(self):
+        self.objects['a/one'] = b'eno'
+        report = self.verifier().run()
+        self.assertEqual(report['drift']['etag_mismatch'],
+                         [{'key': 'a/one', 'expected': md5(b'one'), 'actual': md5(b'eno')}])
+
+    def test_deep_sample(self):
+        self.objects['a/two'] = b'2'
+        self.tombstones = []
+        del self.index['n5']
+        del self.objects['gone'], self.objects['b/stray']
+        self.rows = [x for x in self.rows if x[0] != 'n4']
+
+        report = self.verifier({'sample': 100}).run()
+        self.assertTrue(report['ok'])
+        self.assertEqual(report['counts']['sampled'], 3)
+        self.assertEqual(report['drift']['deep_mismatch'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
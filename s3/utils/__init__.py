@@ -1,54 +1,66 @@
-import hashlib
 import os
 import random
 from hashlib import sha1
 
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+from s3.utils.extsort import iter_lines
+from s3.utils.hashing import hash_file
+from s3.utils.matcher import PrefixTrie
+
 
 class FileUtils(object):
-    def scan_dir(self, path, exclude_dirs=None, only_dirs=None, root_files=True):
+    ignore_dirs = ('.git', '.backup')
+
+    def walk_files(self, path, exclude_dirs=None, only_dirs=None, root_files=True):
+        """
+        Generator of (file path, DirEntry). Excluded subtrees and directories
+        which can't lead to an only_dirs rule are pruned before descending.
+        """
         home_dir = path
-        files = []
-        for dir_name, dir_names, file_names in os.walk(path):
-            if '.git' in dir_names:
-                # don't go into any .git directories.
-                dir_names.remove('.git')
-
-            if '.backup' in dir_names:
-                dir_names.remove('.backup')
-
-            path = self.get_relative_path(home_dir, dir_name)
-            paths = path.split('/')
-
-            # Exclude dirs
-            if len(path) > 0 and len(exclude_dirs) > 0:
-                path = path.lstrip('/')
-                path = path.rstrip('/')
-                matches = [x for x in exclude_dirs if path.startswith(x)]
-                if len(matches) > 0:
-                    continue
-
-            # Only dirs
-            if len(path) > 0 and len(only_dirs) > 0:
-                matches = [x for x in only_dirs if path.startswith(x)]
-                if len(matches) <= 0:
-                    continue
-
-            # Ignore root files
-            if not root_files and len(path) <= 0:
-                if len(paths) > 0 >= len(paths[0]):
-                    continue
-
-            # print path to all subdirectories first.
-            for subdirname in dir_names:
-                # print(os.path.join(dir_name, subdirname))
-                pass
-
-            # print path to all filenames.
-            for file_name in file_names:
-                files.append(os.path.join(dir_name, file_name))
-                pass
-
-        return files
+        exclude = PrefixTrie(exclude_dirs)
+        only = PrefixTrie(only_dirs)
+
+        stack = [path]
+        while stack:
+            dir_name = stack.pop()
+            relative = self.get_relative_path(home_dir, dir_name).strip('/')
+
+            if len(relative) > 0:
+                list_files = len(only) <= 0 or only.matches(relative)
+            else:
+                # Ignore root files
+                list_files = root_files
+
+            try:
+                entries = scandir(dir_name)
+            except (IOError, OSError) as e:
+                continue
+
+            dirs = []
+            for entry in entries:
+                if entry.is_dir():
+                    # don't go into .git/.backup nor follow symlinked directories
+                    if entry.name in self.ignore_dirs or entry.is_symlink():
+                        continue
+                    child = relative + '/' + entry.name if relative else entry.name
+                    # Exclude dirs
+                    if len(exclude) > 0 and exclude.matches(child):
+                        continue
+                    # Only dirs
+                    if len(only) > 0 and not (only.matches(child) or only.leads_to(child)):
+                        continue
+                    dirs.append(entry.path)
+                elif list_files:
+                    yield entry.path, entry
+
+            stack.extend(reversed(dirs))
+
+    def scan_dir(self, path, exclude_dirs=None, only_dirs=None, root_files=True):
+        return [file for file, entry in self.walk_files(path, exclude_dirs, only_dirs, root_files)]
 
     def html_decode(self, string):
         """
@@ -117,8 +129,8 @@ class FileUtils(object):
         file.close()
 
     def file_to_list(self, path):
-        file = self.file_open(path)
-        return [x for x in file.split('\n')] if file else []
+        # line by line, the file is never held as one string
+        return list(iter_lines(path))
 
     def get_index_dirname(self, hashname):
         return hashname[0:2] if len(hashname) > 2 else os.sep
@@ -131,17 +143,15 @@ class FileUtils(object):
         return self.get_index_dirname(path_hash)
 
     def generate_hash(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
         s = sha1()
-        s.update(data + "%u\0" % len(data))
+        s.update(data + b"%u\0" % len(data))
         s.update(data)
         return s.hexdigest()
 
-    def get_file_hash(self, file):
-        hash_md5 = hashlib.md5()
-        with open(file, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+    def get_file_hash(self, file, algorithm='md5'):
+        return hash_file(file, algorithm)
 
     def generate_hash_dict(self, files):
         return [self.generate_hash(x) for x in files]
@@ -1,17 +1,35 @@
 # -*- coding: utf-8 -*-
 
-from multiprocessing.pool import ThreadPool
-
 from pyramid.renderers import render
 from pyramid.view import view_config
 import abc
+import calendar
+import itertools
+import logging
 import os
 import boto3
 import random
-import shutil
 import time
 from s3.utils import FileUtils
+from s3.utils.extsort import difference, intersection, iter_lines, merge_file, sorted_unique, write_lines
+from s3.utils.diff import DiffEngine, ADDED, MODIFIED, DELETED, UNCHANGED
+from s3.utils.hashing import HashEngine, hashing_settings
+from s3.utils.index import IndexStore
+from s3.utils.journal import Journal
+from s3.utils.listing import BucketLister
+from s3.utils.lock import LeaseLock
+from s3.utils.metrics import Metrics as ProjectMetrics
+from s3.utils.resumable import CheckpointStore, error_code
+from s3.utils.shards import ShardedIndex
+from s3.utils.throttle import get_throttle
 from s3.utils.mailer import send_mail
+from s3.utils.verify import Verifier
+from s3.utils.transfer import UploadEngine, DownloadEngine, client_config, transfer_settings
+
+log = logging.getLogger(__name__)
+
+# rehashed index rows written per transaction
+INDEX_BATCH = 10000
 
 
 class Backup(FileUtils):
@@ -34,24 +52,32 @@ class Backup(FileUtils):
         self.index_file_tmp = '.index_tmp_' + self.key
         self.index_file_uploaded = '.index_uploaded_' + self.key
         self.index_file_uploaded_digest = '.index_uploaded_digest_' + self.key
+        self.index_file_rehashed = '.index_rehashed_' + self.key
+        self.index_file_db = '.index_db_' + self.key
+        self.index_file_journal = '.journal_uploaded_' + self.key
+        self.index_file_uploaded_manifest = '.index_uploaded_manifest_' + self.key
+        self.index_file_delete = '.index_delete_' + self.key
+        self.index_file_deleted = '.index_deleted_' + self.key
+        self.lease = LeaseLock(self.config_dir + '.lock_' + self.key)
 
     def is_lock(self):
-        return self.file_exists(self.config_dir + '.lock_' + self.key)
+        """ locked by a live run, stale leases don't count """
+        return self.lease.is_locked()
 
-    def lock(self):
-        self.file_create(self.config_dir, '.lock_' + self.key, '')
+    def lock(self, timeout=0):
+        """ raises LockBusy if another run still holds the lock after timeout seconds """
+        self.lease.acquire(timeout)
 
     def unlock(self):
-        if self.is_lock():
-            os.remove(self.config_dir + '.lock_' + self.key)
+        self.lease.release()
+
+    def merge_index_file(self, file_name, lines):
+        """ sorted union of an index file and lines, merged on disk so memory stays flat """
+        return merge_file(self.config_dir + file_name, lines, self.config_dir)
 
     def write_tmp(self, files):
-        # old files
-        exists_files = self.file_to_list(self.config_dir + self.index_file_tmp)
-        # merge and remove duplicates
-        files = self.merge_list_unique(exists_files, files)
-        # write tmp files
-        self.file_create(self.config_dir, self.index_file_tmp, '\n'.join(files))
+        # merge with the files staged before, duplicates removed
+        self.merge_index_file(self.index_file_tmp, files)
 
     def read_tmp(self):
         return self.file_to_list(self.config_dir + self.index_file_tmp)
@@ -60,9 +86,7 @@ class Backup(FileUtils):
         self.file_create(self.config_dir, self.index_file_tmp, '')
 
     def write_uploaded(self, files):
-        exists_files = self.file_to_list(self.config_dir + self.index_file_uploaded)
-        files = self.merge_list_unique(exists_files, files)
-        self.file_create(self.config_dir, self.index_file_uploaded, '\n'.join(files))
+        self.merge_index_file(self.index_file_uploaded, files)
 
     def read_uploaded(self):
         return self.file_to_list(self.config_dir + self.index_file_uploaded)
@@ -71,9 +95,7 @@ class Backup(FileUtils):
         self.file_create(self.config_dir, self.index_file_uploaded, '')
 
     def write_uploaded_digest(self, files):
-        exists_files = self.file_to_list(self.config_dir + self.index_file_uploaded_digest)
-        files = self.merge_list_unique(exists_files, files)
-        self.file_create(self.config_dir, self.index_file_uploaded_digest, '\n'.join(files))
+        return self.merge_index_file(self.index_file_uploaded_digest, files)
 
     def read_uploaded_digest(self):
         return self.file_to_list(self.config_dir + self.index_file_uploaded_digest)
@@ -81,6 +103,92 @@ class Backup(FileUtils):
     def clear_uploaded_digest(self):
         self.file_create(self.config_dir, self.index_file_uploaded_digest, '')
 
+    def pending(self):
+        """ streaming sorted names staged for upload and not uploaded yet """
+        return difference(sorted_unique(iter_lines(self.config_dir + self.index_file_tmp), self.config_dir),
+                          sorted_unique(iter_lines(self.config_dir + self.index_file_uploaded), self.config_dir))
+
+    def stage_pending(self):
+        """ drop uploaded names from the staged ones, returns (staged, pending) counts """
+        staged = sum(1 for x in iter_lines(self.config_dir + self.index_file_tmp) if x.strip())
+        if staged <= 0:
+            return 0, 0
+        return staged, write_lines(self.config_dir + self.index_file_tmp, self.pending())
+
+    def has_lines(self, file_name):
+        return any(x.strip() for x in iter_lines(self.config_dir + file_name))
+
+    def count_uploaded(self):
+        return sum(1 for x in iter_lines(self.config_dir + self.index_file_uploaded) if x.strip())
+
+    def iter_tmp(self):
+        return iter_lines(self.config_dir + self.index_file_tmp)
+
+    def write_delete(self, entries):
+        """ "name|key" entries due for deletion from S3 """
+        self.file_create(self.config_dir, self.index_file_delete, '\n'.join(entries))
+
+    def read_delete(self):
+        return [x.split('|', 1) for x in self.file_to_list(self.config_dir + self.index_file_delete) if '|' in x]
+
+    def clear_delete(self):
+        self.file_create(self.config_dir, self.index_file_delete, '')
+
+    def write_deleted(self, entries):
+        """ "name|key" entries deleted from S3, dropped from the S3 index on rebase """
+        self.merge_index_file(self.index_file_deleted, entries)
+
+    def read_deleted(self):
+        return [x.split('|', 1) for x in self.file_to_list(self.config_dir + self.index_file_deleted) if '|' in x]
+
+    def clear_deleted(self):
+        self.file_create(self.config_dir, self.index_file_deleted, '')
+
+    def write_uploaded_manifest(self, entries):
+        """ entries: "digest|key" lines, the last digest of a key wins """
+        manifest = self.read_manifest(self.config_dir + self.index_file_uploaded_manifest)
+        manifest.update(self.read_manifest(lines=entries))
+        self.write_manifest(self.config_dir + self.index_file_uploaded_manifest, manifest)
+
+    def read_uploaded_manifest(self):
+        return self.file_to_list(self.config_dir + self.index_file_uploaded_manifest)
+
+    def clear_uploaded_manifest(self):
+        self.file_create(self.config_dir, self.index_file_uploaded_manifest, '')
+
+    def read_manifest(self, path=None, lines=None):
+        """ key -> content digest """
+        manifest = {}
+        for line in lines if lines is not None else self.file_to_list(path):
+            meta = line.split('|', 1)
+            if len(meta) == 2:
+                manifest[meta[1]] = meta[0]
+        return manifest
+
+    def write_manifest(self, path, manifest):
+        dir_name, file_name = os.path.split(path)
+        self.file_create(dir_name + os.sep, file_name, '\n'.join(
+            [digest + '|' + key for key, digest in manifest.items()]))
+
+    def open_journal(self):
+        """ append-only log of uploads finished in the current run """
+        return Journal(self.config_dir + self.index_file_journal).open()
+
+    def compact_journal(self):
+        """ fold the upload journal (of this or an interrupted run) into the uploaded indexes """
+        journal = Journal(self.config_dir + self.index_file_journal)
+        # one streaming pass per index, the journal is never loaded whole
+        count = sum(1 for record in journal.replay() if len(record) >= 2)
+        if count > 0:
+            self.write_uploaded(record[0] for record in journal.replay() if len(record) >= 2)
+            self.write_uploaded_digest(record[1] for record in journal.replay() if len(record) >= 2)
+        # content addressed upload: name|digest|key, the key may contain "|"
+        manifest = [record[1][2:] + '|' + '|'.join(record[2:]) for record in journal.replay() if len(record) >= 3]
+        if len(manifest) > 0:
+            self.write_uploaded_manifest(manifest)
+        journal.clear()
+        return count
+
     def write_local_history(self, files):
         dest_dir = self.history_dir + time.strftime("%d_%m_%Y") + os.sep
         file_name = '.local_' + str(random.getrandbits(10))
@@ -123,33 +231,153 @@ class Backup(FileUtils):
 
 
 class LocalBackup(Backup):
-    def __init__(self, HomeDir='', ExcludeDirs=None, OnlyDirs=None, ConfigDir='.backup'):
+    def __init__(self, HomeDir='', ExcludeDirs=None, OnlyDirs=None, ConfigDir='.backup', Hashing=None, Budget=None,
+                 Metrics=None):
         super(LocalBackup, self).__init__(HomeDir, ExcludeDirs=ExcludeDirs, OnlyDirs=OnlyDirs, ConfigDir=ConfigDir)
+        self.store = IndexStore(self.config_dir + self.index_file_db)
+        self.hasher = HashEngine(Hashing, Budget)
+        self.metrics = Metrics or ProjectMetrics(self.key)
+        self.stats = {}
+
+    def __open_store(self):
+        if self.store.conn is None:
+            self.store.open()
+            # one-time migration of the objects/<2-char>/<hash> layout
+            if os.path.isdir(self.objects_dir):
+                count = self.store.migrate(self.objects_dir, self.config_dir + '.index_stat_' + self.key)
+                if self.file_exists(self.config_dir + self.index_file):
+                    os.remove(self.config_dir + self.index_file)
+                log.info('Migrated %d objects of %s to %s' % (count, self.home_dir, self.store.path))
+        return self.store
 
     def __index_files(self):
-        if self.dir_exists(self.objects_dir):
-            shutil.rmtree(self.objects_dir)
-        self.files = self.scan_dir(self.home_dir, self.exclude_dirs, self.only_dirs)
+        # generator: hashing starts while the walk is still running, only the walk itself is timed as scan
+        self.files = self.metrics.timed(self.walk_files(self.home_dir, self.exclude_dirs, self.only_dirs),
+                                        'scan', 'backup_files_scanned_total')
         return self.files
 
-    def __write_async(self, tup):
-        i, file, hash_path = tup
-        dir_name = self.generate_index_dirname(file)
-        digest = self.get_file_hash(file)
-        self.file_create(self.objects_dir + dir_name + os.sep, hash_path, file + '|' + dir_name + digest)
-        return dir_name + hash_path
+    def __candidates(self, reused, previous=None):
+        """
+        Read while the hashes are in flight: names of unchanged files go
+        straight to the `reused` run file, the others are yielded for hashing.
+        With `previous` every file is rehashed, "name|digest" of the unchanged
+        ones are written to it.
+        """
+        for file, entry in self.files:
+            dir_name = self.generate_index_dirname(file)
+            index_name = dir_name + self.generate_hash(file)
+
+            try:
+                # DirEntry caches the stat result
+                st = entry.stat()
+            except (IOError, OSError) as e:
+                # removed since the scan
+                continue
+
+            row = (index_name, file, dir_name)
+            digest = self.store.lookup(index_name, st)
+            if previous is not None:
+                if digest is not None:
+                    previous.write(index_name + '|' + digest + '\n')
+                yield file, row + self.store.stat_key(st)
+            elif digest is None:
+                yield file, row + self.store.stat_key(st)
+            else:
+                reused.write(index_name + '\n')
+
+    def __write_rehashed(self, previous, algorithm):
+        """ "old digest|new digest" of the files rehashed unchanged, sorted for a merge-join """
+        def pairs():
+            entries = self.store.entries()
+            entry = next(entries, None)
+            for line in sorted_unique(iter_lines(previous), self.config_dir):
+                name, digest = line.split('|', 1)
+                while entry is not None and entry[0] < name:
+                    entry = next(entries, None)
+                if entry is not None and entry[0] == name:
+                    yield entry[2] + digest + '|' + entry[2] + entry[3]
+
+        write_lines(self.config_dir + self.index_file_rehashed, sorted_unique(pairs(), self.config_dir))
+        self.store.set_meta('rehashed_from', algorithm)
+
+    def read_rehashed(self, algorithm):
+        """ sorted "old digest|new digest" of the last switch from `algorithm` """
+        if self.__open_store().get_meta('rehashed_from') != algorithm:
+            return iter(())
+        return iter_lines(self.config_dir + self.index_file_rehashed)
+
+    def clear_rehashed(self):
+        if os.path.exists(self.config_dir + self.index_file_rehashed):
+            os.remove(self.config_dir + self.index_file_rehashed)
 
     def __write_index(self):
-        inputs = []
-        hash_files = self.generate_hash_dict(self.files)
-        for i in range(0, len(self.files)):
-            inputs.append((i, self.files[i], hash_files[i]))
-
-        pool = ThreadPool()
-        hash_files_path = pool.map(self.__write_async, inputs)
-
-        data = '\n'.join(hash_files_path)
-        self.file_create(self.config_dir, self.index_file, data)
+        self.__open_store()
+
+        # digests of another algorithm must never be mixed with the new ones
+        algorithm = self.store.get_meta('algorithm', 'md5')
+        rehash_all = algorithm != self.hasher.algorithm
+        if rehash_all:
+            log.info('Hash algorithm of %s changed from %s to %s, rehashing' % (
+                self.home_dir, algorithm, self.hasher.algorithm))
+
+        # names seen by this scan go to run files, the tree is never held in memory
+        runs = dict((x, self.config_dir + '.scan_%s_%s' % (x, self.key)) for x in ('reused', 'hashed', 'seen',
+                                                                                    'removed', 'previous'))
+        try:
+            hashed = []
+            hashed_count = 0
+            failed = 0
+            with open(runs['reused'], 'w') as reused, open(runs['hashed'], 'w') as names, \
+                    open(runs['previous'], 'w') as previous:
+                candidates = self.__candidates(reused, previous if rehash_all else None)
+                for digest, row in self.hasher.imap(candidates):
+                    if digest is not None:
+                        hashed.append(row[:3] + (digest,) + row[3:])
+                    else:
+                        # unreadable for now: the previous row stays, a read error is no deletion
+                        failed += 1
+                    names.write(row[0] + '\n')
+                    # only rehashed files have to be written, unchanged rows stay as they are
+                    if len(hashed) >= INDEX_BATCH:
+                        self.store.write_many(hashed)
+                        hashed_count += len(hashed)
+                        hashed = []
+            self.store.write_many(hashed)
+            hashed_count += len(hashed)
+            if rehash_all:
+                # lets the S3 index switch its digests without uploading the objects again
+                self.__write_rehashed(runs['previous'], algorithm)
+            self.store.set_meta('algorithm', self.hasher.algorithm)
+
+            seen = write_lines(runs['seen'], sorted_unique(
+                itertools.chain(iter_lines(runs['hashed']), iter_lines(runs['reused'])), self.config_dir))
+
+            # files which came back (rehashed rows are already live again)
+            tombstones = [x[0] for x in self.store.tombstones()]
+            self.store.revive_many(intersection(tombstones, iter_lines(runs['seen'])))
+
+            # tombstone entries of deleted files, the deletion reaches S3 after the grace period
+            removed = write_lines(runs['removed'], difference(self.store.names(), iter_lines(runs['seen'])))
+            if seen <= 0 and removed > 0:
+                log.warning('No files found in %s, keeping %d index entries (unmounted?)' % (
+                    self.home_dir, removed))
+                removed = 0
+            else:
+                self.store.tombstone_many(iter_lines(runs['removed']), int(time.time()))
+        finally:
+            for path in runs.values():
+                if os.path.exists(path):
+                    os.remove(path)
+
+        self.metrics.inc('backup_files_hashed_total', hashed_count)
+        self.stats = {
+            'rehashed': hashed_count,
+            'reused': seen - hashed_count - failed,
+            'failed': failed,
+            'removed': removed,
+        }
+        log.info('Local index %s: %d rehashed, %d reused, %d unreadable, %d removed' % (
+            self.home_dir, self.stats['rehashed'], self.stats['reused'], self.stats['failed'], self.stats['removed']))
 
     def sync_file(self, params=None):
         return
@@ -158,131 +386,405 @@ class LocalBackup(Backup):
         return
 
     def get_index_files(self):
-        return self.file_to_list(self.config_dir + self.index_file)
+        return list(self.__open_store().names())
 
     def get_content_file(self, hashname):
-        index_path = self.objects_dir + self.get_index_dirname(hashname) + os.sep + hashname[2:]
-        return self.file_open(index_path)
+        row = self.__open_store().get(hashname)
+        return row[0] + '|' + row[1] + row[2] if row else None
+
+    def get_tombstones(self):
+        """ (name, path, deleted_at) of files deleted from home_dir """
+        return self.__open_store().tombstones()
+
+    def purge_tombstones(self, names):
+        self.__open_store().delete_many(names)
+
+    def get_index_entries(self):
+        """ streaming scan of (name, path, dir_hash, digest), sorted by name """
+        return self.__open_store().entries()
+
+    def get_index_size(self, names):
+        """ total size of the given index names, as of the last scan """
+        store = self.__open_store()
+        size = 0
+        for name in names:
+            row = store.get(name)
+            if row and row[3]:
+                size += row[3]
+        return size
+
+    def get_index_stat_entries(self):
+        """ streaming scan of (name, path, dir_hash, digest, size), sorted by name """
+        return self.__open_store().stat_entries()
+
+    def get_file_entry(self, file_path):
+        """ index row (path, dir_hash, digest, size, mtime_ns, inode) of an absolute path """
+        return self.__open_store().get(self.generate_index_dirname(file_path) + self.generate_hash(file_path))
 
     def download(self, params=None):
         return
 
     def rebase(self):
         self.__index_files()
-        self.__write_index()
+        with self.metrics.phase('index'):
+            self.__write_index()
 
     def sync(self):
         self.__index_files()
-        self.__write_index()
+        with self.metrics.phase('index'):
+            self.__write_index()
 
 
 class S3Backup(Backup):
-    def __init__(self, S3Bucket='', HomeDir='', ExcludeDirs=None, OnlyDirs=None, ConfigDir='.backup'):
+    def __init__(self, S3Bucket='', HomeDir='', ExcludeDirs=None, OnlyDirs=None, ConfigDir='.backup',
+                 Transfer=None, Dedup=False, DeleteGrace=None, Budget=None, Throttle=None, Metrics=None, Hashing=None):
         super(S3Backup, self).__init__(HomeDir, ExcludeDirs=ExcludeDirs, OnlyDirs=OnlyDirs, ConfigDir=ConfigDir)
+        # algorithm of the digests pushed to the S3 index, recorded in its manifest
+        self.algorithm = hashing_settings(Hashing)['algorithm']
         self.s3_index_file = '.index_s3'
         self.s3_index_digests = '.index_s3_digests'
-        self.s3 = boto3.resource('s3')
+        # objects of ours live under .backup/, never walked locally so never a user key
+        self.reserved_prefix = '.backup/'
+        # content addressed mode: .backup/blobs/<xx>/<digest> stored once, .backup/manifest maps keys to digests
+        self.dedup = Dedup
+        self.manifest_file = '.manifest'
+        self.s3_manifest = self.reserved_prefix + 'manifest'
+        self.blobs_prefix = self.reserved_prefix + 'blobs/'
+        # "digest|time" of blobs the manifest stopped referencing, deleted after the grace period
+        self.blobs_orphaned = '.blobs_orphaned'
+        # cold copies of history written by the retention engine
+        self.archive_prefix = self.reserved_prefix + 'archive/'
+        # seconds a deleted file stays in the bucket, None keeps deleted files forever
+        self.delete_grace = DeleteGrace
+        self.transfer = transfer_settings(Transfer)
+        # one client shared by all transfer workers, its connection pool sized to match
+        self.s3 = boto3.resource('s3', config=client_config(self.transfer),
+                                 endpoint_url=self.transfer['endpoint_url'])
+        self.client = self.s3.meta.client
         self.bucket = self.s3.Bucket(S3Bucket)
-
-    def __upload_s3_digest(self):
-        digests_s3 = self.get_index_digests()
-        digests_uploaded = self.read_uploaded_digest()
-
-        if digests_uploaded and len(digests_uploaded) > 0:
-            self.write_uploaded_digest(digests_s3)
-            self.bucket.upload_file(self.config_dir + self.index_file_uploaded_digest, self.s3_index_digests)
-            self.clear_uploaded_digest()
+        # bytes/s and requests/s of this project, shared by every run of it in the process
+        self.throttle = get_throttle(self.key, Throttle)
+        self.metrics = Metrics or ProjectMetrics(self.key)
+        self.uploader = UploadEngine(self.client, S3Bucket, self.transfer, Budget, self.throttle,
+                                     self.config_dir + 'multipart', self.metrics)
+        self.downloader = DownloadEngine(self.client, S3Bucket, self.transfer, self.config_dir + 'tmp', self.throttle,
+                                         self.metrics)
+        # .index_s3.json lists the shards of the S3 index, the old single objects are read until the first push
+        self.index = ShardedIndex(self.client, S3Bucket, self.throttle, self.s3_index_file,
+                                  self.config_dir + 'index_s3',
+                                  {'files': self.s3_index_file, 'digests': self.s3_index_digests},
+                                  self.transfer['index_shard_chars'], self.transfer['list_workers'])
+        # every push rewrites the index manifest, its ETag revalidates the cached listing
+        ttl = self.transfer['list_cache_ttl']
+        self.lister = BucketLister(self.client, S3Bucket, self.throttle, self.transfer['list_workers'],
+                                   CheckpointStore(self.config_dir + 'listing') if ttl != 0 else None,
+                                   self.index.manifest_key, ttl)
 
     def __upload_s3_index(self):
+        """ fold the uploaded and deleted names into the touched shards of the S3 index """
         try:
-            # self.bucket.objects.filter(Delimiter=''):
-            files_s3 = self.get_index_files()
-            files_uploaded = self.read_uploaded()
-
-            if files_uploaded and len(files_uploaded) > 0:
-                self.write_uploaded(files_s3)
-                self.bucket.upload_file(self.config_dir + self.index_file_uploaded, self.s3_index_file)
+            # streamed from the sorted index files, the shards only group the changes
+            files_uploaded = iter_lines(self.config_dir + self.index_file_uploaded)
+            files_deleted = self.read_deleted()
+            digests_uploaded = iter_lines(self.config_dir + self.index_file_uploaded_digest)
+
+            changes = {}
+            if self.has_lines(self.index_file_uploaded) or len(files_deleted) > 0:
+                changes['files'] = (files_uploaded, [name for name, key in files_deleted])
+            meta = {}
+            replace = ()
+            if self.has_lines(self.index_file_uploaded_digest):
+                changes['digests'] = (digests_uploaded, [])
+                meta['algorithm'] = self.algorithm
+                if not self.digests_current():
+                    # digests of another algorithm are dropped, never mixed with the new ones
+                    log.info('S3 index of %s: digests switched from %s to %s' % (
+                        self.bucket.name, self.index_algorithm(), self.algorithm))
+                    replace = ('digests',)
+            if changes:
+                self.index.commit(changes, meta, replace)
+            if 'files' in changes:
                 self.clear_uploaded()
+                self.clear_deleted()
                 self.clear_tmp()
+            if 'digests' in changes:
+                self.clear_uploaded_digest()
         except Exception as e:
-            pass
-        finally:
-            pass
+            # the staged files stay in place, the next run uploads the index again
+            log.exception('Upload of the S3 index of %s failed' % self.bucket.name)
+            raise
 
-    def __download_s3_index_digests(self):
+    def __download_manifest(self):
         try:
-            self.bucket.download_file(self.s3_index_digests, self.config_dir + self.s3_index_digests)
+            self.bucket.download_file(self.s3_manifest, self.config_dir + self.manifest_file)
         except Exception as e:
-            pass
-
-    def __download_s3_index(self):
-        try:
-            self.bucket.download_file(self.s3_index_file, self.config_dir + self.s3_index_file)
-        except Exception as e:
-            pass
-
-    def __download_from_s3(self):
-        bucket = self.bucket
-        paginator = bucket.meta.client.get_paginator('list_objects')
-        page_iterator = paginator.paginate(Bucket=bucket.name)
-        for page in page_iterator:
-            for file in page.get('Contents'):
-                paths = file.get('Key').split('/')
-                if len(paths) > 0:
-                    if len(self.exclude_dirs) > 0 and paths[0] in self.exclude_dirs:
-                        continue
-
-                    if len(self.only_dirs) > 0 and paths[0] not in self.only_dirs:
-                        continue
-
-                # ignore s3_index file
-                if self.s3_index_file in file.get('Key'):
+            # missing before the first push, anything else is worth knowing about
+            if error_code(e) not in ('404', 'NoSuchKey'):
+                log.warning('Download of the manifest of %s failed: %s' % (self.bucket.name, e))
+
+    def __upload_manifest(self):
+        entries = self.read_uploaded_manifest()
+        deleted = self.read_deleted()
+        if (entries and len(entries) > 0) or len(deleted) > 0:
+            manifest = self.get_manifest()
+            before = set(manifest.values())
+            manifest.update(self.read_manifest(lines=entries))
+            for name, key in deleted:
+                manifest.pop(key, None)
+            self.write_manifest(self.config_dir + self.manifest_file, manifest)
+            self.bucket.upload_file(self.config_dir + self.manifest_file, self.s3_manifest)
+            self.clear_uploaded_manifest()
+            # blobs of deleted and changed files which no other key shares
+            self.orphan_blobs(before - set(manifest.values()))
+
+    def read_orphaned_blobs(self):
+        """ {digest: time it lost its last reference} """
+        orphaned = {}
+        for line in self.file_to_list(self.config_dir + self.blobs_orphaned):
+            meta = line.split('|')
+            if len(meta) == 2:
+                orphaned[meta[0]] = int(meta[1])
+        return orphaned
+
+    def write_orphaned_blobs(self, orphaned):
+        self.file_create(self.config_dir, self.blobs_orphaned, '\n'.join(
+            ['%s|%d' % (digest, orphaned_at) for digest, orphaned_at in sorted(orphaned.items())]))
+
+    def orphan_blobs(self, digests):
+        if len(digests) <= 0:
+            return
+        orphaned = self.read_orphaned_blobs()
+        now = int(time.time())
+        for digest in digests:
+            orphaned.setdefault(digest, now)
+        self.write_orphaned_blobs(orphaned)
+
+    def collect_blobs(self):
+        """
+        Delete the blobs unreferenced for longer than the delete grace period,
+        runs of other hosts may still be pulling an older manifest until then.
+        Returns the number of deleted blobs.
+        """
+        orphaned = self.read_orphaned_blobs()
+        if self.delete_grace is None or len(orphaned) <= 0:
+            return 0
+
+        referenced = set(self.get_manifest().values())
+        referenced.update(self.read_manifest(lines=self.read_uploaded_manifest()).values())
+        deadline = time.time() - self.delete_grace
+        # blobs referenced again since are simply forgotten
+        orphaned = dict((k, v) for k, v in orphaned.items() if k not in referenced)
+        due = dict((self.blob_key(k), k) for k, v in orphaned.items() if v <= deadline)
+
+        deleted = self.delete_files(sorted(due)) if due else []
+        for key in deleted:
+            orphaned.pop(due[key])
+        self.write_orphaned_blobs(orphaned)
+        if due:
+            log.info('Collected %d of %d unreferenced blobs from %s' % (len(deleted), len(due), self.bucket.name))
+        return len(deleted)
+
+    def blob_key(self, digest):
+        """ key of a content digest (without the dir hash prefix) """
+        return self.blobs_prefix + digest[:2] + '/' + digest
+
+    def get_manifest(self):
+        return self.read_manifest(self.config_dir + self.manifest_file)
+
+    def __download_blobs(self, local=None):
+        stats = {'skipped': 0}
+
+        def pending():
+            for key, digest in self.get_manifest().items():
+                paths = key.split('/')
+                if len(self.exclude_dirs) > 0 and paths[0] in self.exclude_dirs:
                     continue
-
-                # ignore s3_index_hash file
-                if self.s3_index_digests in file.get('Key'):
+                if len(self.only_dirs) > 0 and paths[0] not in self.only_dirs:
                     continue
 
-                # ignore history folder
-                if 'history' in file.get('Key'):
+                destination = self.home_dir + key
+                entry = local.get_file_entry(destination) if local else None
+                if entry and entry[2] == digest:
+                    try:
+                        if tuple(entry[3:]) == local.store.stat_key(os.stat(destination)):
+                            stats['skipped'] += 1
+                            continue
+                    except (IOError, OSError) as e:
+                        pass
+                yield {'key': self.blob_key(digest), 'path': destination, 'size': 0}
+
+        stats.update(self.downloader.run(pending()))
+        stats['throttle'] = self.throttle.metrics()
+        log.info('Pull %s (deduplicated): %d downloaded, %d up to date, %d failed' % (
+            self.bucket.name, stats['count'], stats['skipped'], stats['errors']))
+        return stats
+
+    def is_backup_key(self, key):
+        """ key of a backed up file: inside only_dirs/exclude_dirs and not one of ours """
+        paths = key.split('/')
+        if len(paths) > 0:
+            if len(self.exclude_dirs) > 0 and paths[0] in self.exclude_dirs:
+                return False
+
+            if len(self.only_dirs) > 0 and paths[0] not in self.only_dirs:
+                return False
+
+        # ignore s3_index file
+        if self.s3_index_file in key:
+            return False
+
+        # ignore s3_index_hash file
+        if self.s3_index_digests in key:
+            return False
+
+        # ignore the manifest, the blobs and the archived history
+        if key.startswith(self.reserved_prefix):
+            return False
+
+        # ignore history folder
+        if 'history' in key:
+            return False
+        return True
+
+    def __list_from_s3(self):
+        # only_dirs and exclude_dirs are pushed down as prefixes, the rest is filtered here
+        skip = (self.reserved_prefix, 'history/')
+        for file in self.lister.list(self.only_dirs, self.exclude_dirs, skip).values():
+            if self.is_backup_key(file.get('Key')):
+                yield file
+
+    def is_current(self, file, destination, local=None):
+        """ local copy of the listed object is already up to date """
+        try:
+            st = os.stat(destination)
+        except (IOError, OSError) as e:
+            return False
+
+        if st.st_size != file.get('Size'):
+            return False
+
+        etag = file.get('ETag', '').strip('"')
+        entry = local.get_file_entry(destination) if local else None
+        if entry and '-' not in etag and local.hasher.algorithm == 'md5' and \
+                tuple(entry[3:]) == local.store.stat_key(st):
+            # single part upload, the ETag is the MD5 of the content
+            return entry[2] == etag
+
+        # multipart ETag or no index entry: fall back to size and mtime
+        last_modified = file.get('LastModified')
+        if last_modified is None:
+            return False
+        return st.st_mtime >= calendar.timegm(last_modified.utctimetuple())
+
+    def __download_from_s3(self, local=None):
+        stats = {'skipped': 0}
+
+        def pending():
+            for file in self.__list_from_s3():
+                destination = self.home_dir + file.get('Key')
+                if self.is_current(file, destination, local):
+                    stats['skipped'] += 1
                     continue
+                yield {'key': file.get('Key'), 'path': destination, 'size': file.get('Size', 0),
+                       'etag': file.get('ETag')}
 
-                destination = self.home_dir + file.get('Key')
-                if not self.dir_exists(destination):
-                    os.makedirs(os.path.dirname(destination))
-                self.s3.meta.client.download_file(bucket.name, file.get('Key'), destination)
+        stats.update(self.downloader.run(pending()))
+        stats['throttle'] = self.throttle.metrics()
+        log.info('Pull %s: %d downloaded, %d up to date, %d failed' % (
+            self.bucket.name, stats['count'], stats['skipped'], stats['errors']))
+        return stats
 
     def get_content_file(self, hashname):
         return
 
     def download(self, params=None):
-        self.__download_from_s3()
-        return
+        if self.dedup:
+            return self.__download_blobs((params or {}).get('local'))
+        return self.__download_from_s3((params or {}).get('local'))
 
     def sync_file(self, params=None):
-        self.bucket.upload_file(params['path'], params['key'])
+        self.uploader.upload(params)
         return
 
+    def delete_files(self, keys):
+        """ DeleteObjects in batches of 1000 keys, returns the deleted keys """
+        deleted = []
+        for i in range(0, len(keys), 1000):
+            batch = keys[i:i + 1000]
+            self.lister.invalidate(batch)
+            response = self.throttle.call(self.client.delete_objects, Bucket=self.bucket.name, Delete={
+                'Objects': [{'Key': x} for x in batch],
+                'Quiet': True,
+            })
+            # quiet mode only reports failures
+            errors = set()
+            for error in response.get('Errors', []):
+                errors.add(error.get('Key'))
+                log.warning('Delete of %s failed: %s' % (error.get('Key'), error.get('Message')))
+            deleted.extend([x for x in batch if x not in errors])
+        return deleted
+
+    def sync_files(self, items, callback=None):
+        """ upload many files concurrently, callback(item, error) per finished file """
+        def pending():
+            for item in items:
+                self.lister.invalidate([item['key']])
+                yield item
+
+        return self.uploader.run(pending(), callback)
+
+    def abort_stale_uploads(self):
+        """ abort multipart uploads older than the transfer multipart_ttl """
+        try:
+            return self.uploader.abort_stale()
+        except Exception as e:
+            log.warning('Cleanup of stale multipart uploads in %s failed: %s' % (self.bucket.name, e))
+            return 0
+
     def rebase(self):
+        # the S3 index is about to change: keep the listings of prefixes we didn't write valid
+        validator = self.lister.validator()
+        if self.dedup:
+            self.__upload_manifest()
         self.__upload_s3_index()
-        self.__upload_s3_digest()
+        self.lister.stamp(validator, self.lister.validator())
         return
 
+    def index_algorithm(self):
+        # indexes written before the algorithm was recorded are md5
+        return self.index.meta().get('algorithm', 'md5')
+
+    def digests_current(self):
+        """ the digests of the S3 index use the algorithm of the project """
+        return self.index_algorithm() == self.algorithm
+
     def get_index_digests(self):
-        return self.file_to_list(self.config_dir + self.s3_index_digests)
+        """ streaming digests of the S3 index, shard by shard """
+        if not self.digests_current():
+            # every file compares as modified until a push replaced them
+            return iter(())
+        return self.index.lines('digests')
 
     def get_index_files(self):
-        return self.file_to_list(self.config_dir + self.s3_index_file)
+        """ streaming names of the S3 index, shard by shard """
+        return self.index.lines('files')
+
+    def count_index(self, table):
+        return self.index.count(table)
 
     def sync(self):
-        self.__download_s3_index()
-        self.__download_s3_index_digests()
-        pass
+        with self.metrics.phase('s3_sync'):
+            self.index.sync()
+            if self.dedup:
+                self.__download_manifest()
 
 
 class BackupManager(FileUtils):
     def __init__(self):
         super(BackupManager, self).__init__()
+        self.changes = None
+        # progress(files_done, files_total, bytes_done, bytes_total), called while uploading
+        self.progress = None
 
     @property
     def master(self):
@@ -301,125 +803,259 @@ class BackupManager(FileUtils):
         self._slave = value
 
     def init(self):
-        master_files = self.master.get_index_files()
         slave_files = self.slave.get_index_files()
 
-        if len(slave_files) > 0 and len(master_files) == 0:
+        if len(slave_files) > 0 and self.master.count_index('files') == 0:
             # create tmp file for s3
             self.slave.write_tmp(slave_files)
 
     def push(self):
-        master_files = self.master.get_index_files()
-        slave_files = self.slave.get_index_files()
+        changes = self.diff()
 
-        if len(slave_files) <= 0 or len(master_files) <= 0:
+        if changes.local_count <= 0 or changes.remote_count <= 0:
             return
 
-        files = list(set(slave_files) - set(master_files))
+        added = [x.name for x in changes.added]
 
-        # create tmp file for s3
-        self.slave.write_tmp(files)
+        if self.master.digests_current():
+            self.slave.clear_rehashed()
+        else:
+            # the objects stay, only the digests of the S3 index are rewritten
+            self.slave.write_uploaded_digest(self.translate_digests())
 
-        # write local history file
-        self.slave.write_local_history(files)
+        # create tmp file for s3, without remote digests only new files can be told apart
+        if self.master.count_index('digests') > 0 or not self.master.digests_current():
+            self.slave.write_tmp(changes.pending())
+        else:
+            self.slave.write_tmp(added)
 
-        self.diff()
+        # write local history file
+        self.slave.write_local_history(added)
 
-    def diff(self):
-        master_digest_files = self.master.get_index_digests()
-        slave_files = self.slave.get_index_files()
+        self.stage_deletions(changes)
 
-        if master_digest_files is not None and len(master_digest_files) <= 0:
+    def stage_deletions(self, changes):
+        """ queue tombstones older than the grace period for deletion from S3 """
+        if self.master.delete_grace is None:
             return
 
-        modified_files = []
-        if len(slave_files) > 0:
-            for file in slave_files:
-                try:
-                    content = self.slave.get_content_file(file)
-                    if content:
-                        meta = content.split('|')
-                        digest = meta[1]
-                        if digest not in master_digest_files:
-                            modified_files.append(file)
-                except Exception as e:
-                    pass
-                finally:
-                    pass
+        remote = set(x.name for x in changes.deleted)
+        deadline = time.time() - self.master.delete_grace
+        due = []
+        never_uploaded = []
+        for name, path, deleted_at in self.slave.get_tombstones():
+            if name not in remote:
+                never_uploaded.append(name)
+            elif deleted_at <= deadline:
+                due.append(name + '|' + self.get_relative_path(self.master.home_dir, path))
+
+        self.slave.purge_tombstones(never_uploaded)
+        self.slave.write_delete(due)
+
+    def delete(self):
+        """ delete the queued keys, returns the number of deleted files """
+        entries = self.slave.read_delete()
+        if len(entries) <= 0:
+            return 0
+
+        if self.master.dedup:
+            # blobs may be shared, deleted keys are dropped from the manifest and
+            # the blobs nothing references any more collected after the grace period
+            deleted = set(key for name, key in entries)
+        else:
+            deleted = set(self.master.delete_files([key for name, key in entries]))
+
+        done = [(name, key) for name, key in entries if key in deleted]
+        self.slave.write_deleted([name + '|' + key for name, key in done])
+        self.slave.purge_tombstones([name for name, key in done])
+        # failed keys are queued again by the next push
+        self.slave.clear_delete()
+        log.info('Deleted %d of %d keys from %s' % (len(done), len(entries), self.master.bucket.name))
+        return len(done)
+
+    def pending_size(self):
+        """ bytes staged for upload by push or init """
+        return self.slave.get_index_size(self.slave.pending())
 
-            self.slave.write_tmp(modified_files)
+    def diff(self):
+        """ typed change set of the local index against the S3 index """
+        with self.master.metrics.phase('diff'):
+            if self.master.digests_current():
+                digests = self.master.get_index_digests()
+            else:
+                digests = self.translate_digests()
+            engine = DiffEngine(self.master.get_index_files(), digests, self.slave.config_dir)
+            self.changes = engine.diff(self.slave.get_index_entries())
+        counts = self.changes.counts()
+        log.info('Diff %s: %d added, %d modified, %d deleted, %d unchanged in %.2fs' % (
+            self.slave.home_dir, counts[ADDED], counts[MODIFIED], counts[DELETED], counts[UNCHANGED],
+            self.changes.elapsed))
+        return self.changes
+
+    def translate_digests(self):
+        """
+        The S3 index digests of another algorithm the local files still
+        match, as digests of the project algorithm (unsorted).
+        """
+        remote = iter(sorted_unique(self.master.index.lines('digests'), self.slave.config_dir))
+        current = next(remote, None)
+        for line in self.slave.read_rehashed(self.master.index_algorithm()):
+            old, new = line.split('|', 1)
+            while current is not None and current < old:
+                current = next(remote, None)
+            if current == old:
+                yield new
 
     def pull(self):
-        master_files = self.master.get_index_files()
-        if len(master_files) <= 0:
+        if self.master.count_index('files') <= 0:
             return
 
-        self.master.download()
+        stats = self.master.download({'local': self.slave})
         self.slave.rebase()
+        return stats
 
     def rebase_digest(self):
-        slave_files = self.slave.get_index_files()
-        if len(slave_files) > 0:
-            digests = []
-            for file in slave_files:
-                try:
-                    content = self.slave.get_content_file(file)
-                    if content:
-                        meta = content.split('|')
-                        digest = meta[1]
-                        digests.append(digest)
-                except Exception as e:
-                    pass
-                finally:
-                    pass
-            self.slave.write_uploaded_digest(digests)
+        digests = (dir_hash + digest for name, path, dir_hash, digest in self.slave.get_index_entries())
+        if self.slave.write_uploaded_digest(digests) > 0:
             self.master.rebase()
 
-    def apply(self):
-        uploaded_files = []
-        uploaded_digests = []
-
-        # uploaded files
-        uploaded_files = self.slave.read_uploaded()
+    def verify(self, settings=None):
+        """ audit the bucket against the indexes, the drift report is kept in <config_dir>/verify """
+        verifier = Verifier(self.master, self.slave, settings)
+        report = verifier.run()
+        report['path'] = verifier.write(report, self.slave.config_dir + 'verify')
+        return report
 
-        # open tmp file
-        files = self.slave.read_tmp()
-
-        if len(files) > 0:
-            if len(uploaded_files) > 0:
-                files = list(set(files) - set(uploaded_files))
-                self.slave.clear_tmp()
-                self.slave.write_tmp(files)
-
-            size = 0
-            for file in files:
+    def apply(self):
+        with self.master.metrics.phase('apply'):
+            return self.__apply()
+
+    def __apply(self):
+        # replay the journal of an interrupted run
+        self.slave.compact_journal()
+
+        # interrupted uploads are resumed below, abandoned ones are aborted
+        self.master.abort_stale_uploads()
+
+        # propagate deletions queued by push
+        deleted = self.delete()
+        if self.master.dedup:
+            self.master.collect_blobs()
+
+        # staged files less the ones uploaded before, merged on disk
+        staged, pending = self.slave.stage_pending()
+        if staged <= 0 and deleted <= 0:
+            if not self.master.digests_current():
+                # digests switched to the new algorithm, nothing to upload
+                self.master.rebase()
+            return
+        log.info('%d of %d staged files of %s pending upload' % (pending, staged, self.slave.home_dir))
+        # files uploaded in this and interrupted runs
+        finished = {'count': self.slave.count_uploaded()}
+
+        def items():
+            # streamed from the staged file, the transfer pool only holds a few of them
+            for file in self.slave.iter_tmp():
+                content = self.slave.get_content_file(file) if file else None
+                if content:
+                    meta = content.split('|')
+                    file_path = meta[0]
+                    yield {
+                        'name': file,
+                        'path': file_path,
+                        'digest': meta[1],
+                        'key': self.get_relative_path(self.master.home_dir, file_path),
+                    }
+
+        done = {'files': 0, 'bytes': 0}
+        total = {'files': pending, 'bytes': 0}
+        if self.progress:
+            for item in items():
                 try:
-                    content = self.slave.get_content_file(file)
-                    if content:
-                        meta = content.split('|')
-                        file_path = meta[0]
-                        digest = meta[1]
-
-                        key = self.get_relative_path(self.master.home_dir, file_path)
-                        self.master.sync_file({'path': file_path, 'key': key})
-
-                        # os.path.getsize(file_path)
-                        size += os.stat(file_path).st_size
-
-                        # list of uploaded files
-                        uploaded_files.append(file)
-                        self.slave.write_uploaded(uploaded_files)
-
-                        # list of digests
-                        uploaded_digests.append(digest)
-                        self.slave.write_uploaded_digest(uploaded_digests)
-                except Exception as e:
+                    total['bytes'] += os.stat(item['path']).st_size
+                except (IOError, OSError) as e:
                     pass
-
-            self.master.rebase()
-
-            return {
-                'count': len(uploaded_files),
-                'date': time.strftime("%d-%m-%Y"),
-                'size': self.sizeof_fmt(size)
-            }
+            self.progress(0, total['files'], 0, total['bytes'])
+
+        duplicates = []
+        pending_items = items()
+        if self.master.dedup:
+            pending_items = self.dedup(pending_items, duplicates)
+
+        journal = self.slave.open_journal()
+        stored = set()
+
+        def uploaded(item, error):
+            if self.progress:
+                done['files'] += 1
+                done['bytes'] += item.get('size', 0)
+                self.progress(done['files'], total['files'], done['bytes'], total['bytes'])
+            if error is not None:
+                return
+            # completion log, written from this thread only
+            if self.master.dedup:
+                journal.append(item['name'], item['digest'], item['target'])
+                stored.add(item['digest'][2:])
+            else:
+                journal.append(item['name'], item['digest'])
+            finished['count'] += 1
+
+        saved = 0
+        try:
+            stats = self.master.sync_files(pending_items, uploaded)
+
+            # duplicates only reference a blob, once it is known to be stored
+            for item in duplicates:
+                if item['stored'] or item['digest'][2:] in stored:
+                    try:
+                        item['size'] = os.stat(item['path']).st_size
+                    except (IOError, OSError) as e:
+                        continue
+                    saved += item['size']
+                    uploaded(item, None)
+        finally:
+            journal.close()
+            # rewrite the uploaded indexes once per run
+            self.slave.compact_journal()
+
+        self.master.rebase()
+
+        return {
+            'count': finished['count'],
+            'deleted': deleted,
+            'date': time.strftime("%d-%m-%Y"),
+            'size': self.sizeof_fmt(stats['bytes']),
+            'errors': stats['errors'],
+            'elapsed': round(stats['elapsed'], 2),
+            'files_per_sec': stats['files_per_sec'],
+            'mb_per_sec': stats['mb_per_sec'],
+            'bytes_saved': self.sizeof_fmt(saved),
+            # share of the pushed bytes which didn't have to be uploaded
+            'dedup_ratio': round(saved / float(stats['bytes'] + saved), 2) if saved else 0.0,
+            'changes': self.changes.counts() if self.changes else {},
+            'diff_elapsed': round(self.changes.elapsed, 2) if self.changes else 0,
+            'throttle': self.master.throttle.metrics(),
+        }
+
+    def dedup(self, items, duplicates):
+        """
+        Generator of the pending items whose blobs have to be uploaded; items
+        whose content is already stored (or uploaded by an earlier item of
+        this run) are appended to `duplicates` instead.
+        """
+        known = set(self.master.get_manifest().values())
+        known.update(self.slave.read_manifest(lines=self.slave.read_uploaded_manifest()).values())
+
+        # digests first seen in this run, stored only if their upload succeeds
+        seen = set()
+        for item in items:
+            digest = item['digest'][2:]
+            item['target'] = item['key']
+            item['key'] = self.master.blob_key(digest)
+            if digest in known:
+                item['stored'] = digest not in seen
+                duplicates.append(item)
+            else:
+                known.add(digest)
+                seen.add(digest)
+                yield item
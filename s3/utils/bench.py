@@ -0,0 +1,247 @@
+import logging
+import math
+import os
+import platform
+import random
+import sys
+import time
+
+from s3.utils import FileUtils
+from s3.utils.metrics import Metrics, Registry
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+log = logging.getLogger(__name__)
+
+KB = 1024
+MB = 1024 * 1024
+
+# shape of the generated tree, every key can be set from the command line
+DEFAULT_TREE = {
+    'files': 1000,
+    # directory levels below home_dir and sub directories per directory
+    'depth': 3,
+    'fanout': 4,
+    # fixed, uniform (0..2 * mean_size) or lognormal (many small files, a few large ones)
+    'size': 'lognormal',
+    'mean_size': 32 * KB,
+    'sigma': 1.5,
+    'max_size': 64 * MB,
+    # share of the files whose content is a copy of an earlier file
+    'duplicates': 0.1,
+    # share of the files rewritten between the full and the incremental push
+    'change': 0.05,
+    'seed': 1,
+}
+
+
+def tree_settings(settings=None):
+    result = dict(DEFAULT_TREE)
+    result.update(settings or {})
+    if result['size'] not in ('fixed', 'uniform', 'lognormal'):
+        raise ValueError('Unknown size distribution %s' % result['size'])
+    return result
+
+
+def file_size(rng, settings):
+    mean = settings['mean_size']
+    if settings['size'] == 'fixed':
+        size = mean
+    elif settings['size'] == 'uniform':
+        size = rng.randint(0, 2 * mean)
+    else:
+        # mu chosen so the distribution keeps mean_size as its mean
+        sigma = settings['sigma']
+        size = rng.lognormvariate(math.log(max(mean, 1)) - sigma * sigma / 2, sigma)
+    return int(min(size, settings['max_size']))
+
+
+def tree_dirs(settings):
+    """ relative directories of the tree, home_dir ('') included """
+    dirs = ['']
+    level = ['']
+    for depth in range(settings['depth']):
+        level = [os.path.join(parent, 'd%d_%d' % (depth, i)) for parent in level for i in range(settings['fanout'])]
+        dirs.extend(level)
+    return dirs
+
+
+def generate_tree(root, settings=None):
+    """
+    Write a synthetic tree under root, returns {files, bytes, duplicates, paths}.
+    Layout and sizes depend only on the seed, the content is random.
+    """
+    settings = tree_settings(settings)
+    rng = random.Random(settings['seed'])
+    dirs = tree_dirs(settings)
+    paths = []
+    contents = []
+    stats = {'files': 0, 'bytes': 0, 'duplicates': 0}
+    for i in range(settings['files']):
+        path = os.path.join(root, rng.choice(dirs), 'f%06d.bin' % i)
+        dir_name = os.path.dirname(path)
+        if not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        if contents and rng.random() < settings['duplicates']:
+            data = rng.choice(contents)
+            stats['duplicates'] += 1
+        else:
+            data = os.urandom(file_size(rng, settings))
+            # keep a few small ones around as duplicate sources
+            if len(data) <= MB and len(contents) < 100:
+                contents.append(data)
+        with open(path, 'wb') as f:
+            f.write(data)
+        paths.append(path)
+        stats['files'] += 1
+        stats['bytes'] += len(data)
+    stats['paths'] = paths
+    return stats
+
+
+def mutate_tree(paths, ratio, seed=1):
+    """ rewrite `ratio` of the files with new content of the same size, returns (files, bytes) """
+    rng = random.Random(seed + 1)
+    changed = rng.sample(paths, int(len(paths) * ratio))
+    size = 0
+    for path in changed:
+        length = os.path.getsize(path)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(length))
+        size += length
+    return len(changed), size
+
+
+def peak_rss():
+    """ peak resident set size of the process (and finished hashing processes) in MB """
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # bytes on macOS, kilobytes elsewhere
+    return round(peak / float(MB if sys.platform == 'darwin' else KB), 1)
+
+
+class Benchmark(FileUtils):
+    """
+    Times the backup pipeline over a generated tree against one bucket:
+    scan, cold index, full upload, incremental push after `change` of the
+    files were rewritten, and a pull into an empty directory. Every phase
+    records seconds, files, bytes, throughput and the peak RSS so far.
+    """
+
+    def __init__(self, root, bucket, tree=None, transfer=None, hashing=None, dedup=False):
+        self.root = root
+        self.bucket = bucket
+        self.tree = tree_settings(tree)
+        self.transfer = transfer or {}
+        self.hashing = hashing
+        self.dedup = dedup
+        # a registry of our own: transferred bytes without the rest of the process
+        self.registry = Registry()
+        self.metrics = Metrics('bench', self.registry)
+        self.phases = []
+
+    def transferred(self, direction):
+        return (self.registry.get('backup_files_total', project='bench', direction=direction) or 0,
+                self.registry.get('backup_bytes_total', project='bench', direction=direction) or 0)
+
+    def measure(self, name, func, files=None, size=None, direction=None):
+        """ run func() as phase `name`; files and size are counted by the transfer if direction is set """
+        before = self.transferred(direction) if direction else (0, 0)
+        start = time.time()
+        result = func()
+        seconds = time.time() - start
+        if direction:
+            after = self.transferred(direction)
+            files, size = after[0] - before[0], after[1] - before[1]
+        phase = {
+            'phase': name,
+            'seconds': round(seconds, 3),
+            'files': files,
+            'bytes': size,
+            'files_per_sec': round(files / seconds, 1) if files and seconds > 0 else None,
+            'mb_per_sec': round(size / float(MB) / seconds, 2) if size and seconds > 0 else None,
+            'peak_rss_mb': peak_rss(),
+        }
+        self.phases.append(phase)
+        log.info('%-18s %8.3fs %8s files %10s MB/s  peak %s MB' % (
+            name, seconds, files, phase['mb_per_sec'], phase['peak_rss_mb']))
+        return result
+
+    def backups(self, home_dir, config_dir):
+        from s3.utils.backup import BackupManager, LocalBackup, S3Backup
+        local = LocalBackup(HomeDir=home_dir, ConfigDir=config_dir, ExcludeDirs=[], OnlyDirs=[],
+                            Hashing=self.hashing, Metrics=self.metrics)
+        s3 = S3Backup(S3Bucket=self.bucket, HomeDir=home_dir, ConfigDir=config_dir, ExcludeDirs=[], OnlyDirs=[],
+                      Transfer=self.transfer, Dedup=self.dedup, Metrics=self.metrics, Hashing=self.hashing)
+        manager = BackupManager()
+        manager.slave = local
+        manager.master = s3
+        return local, s3, manager
+
+    def run(self):
+        home_dir = os.path.join(self.root, 'home')
+        tree = self.measure('generate', lambda: generate_tree(home_dir, self.tree))
+        self.phases[-1].update(files=tree['files'], bytes=tree['bytes'])
+
+        self.measure('scan_dir', lambda: self.scan_dir(home_dir), tree['files'])
+
+        local, s3, manager = self.backups(home_dir, os.path.join(self.root, 'config'))
+        self.measure('sync_cold', local.sync, tree['files'], tree['bytes'])
+        self.measure('s3_sync', s3.sync)
+        self.measure('init', manager.init)
+        self.measure('apply_full', manager.apply, direction='upload')
+
+        changed, changed_bytes = mutate_tree(tree['paths'], self.tree['change'], self.tree['seed'])
+        self.measure('sync_warm', local.sync, tree['files'], changed_bytes)
+        self.measure('diff', manager.diff, tree['files'])
+        # push runs its own diff before staging the changes
+        self.measure('push', manager.push, changed)
+        self.measure('apply_incremental', manager.apply, direction='upload')
+
+        pull_local, pull_s3, pull_manager = self.backups(os.path.join(self.root, 'pull'),
+                                                         os.path.join(self.root, 'pull_config'))
+        pull_s3.sync()
+        self.measure('pull', pull_manager.pull, direction='download')
+
+        tree.pop('paths')
+        return {
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count() if hasattr(os, 'cpu_count') else None,
+            'tree': dict(self.tree, **tree),
+            'changed': changed,
+            'dedup': self.dedup,
+            'transfer': self.transfer,
+            'hashing': self.hashing,
+            'phases': self.phases,
+        }
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Phase by phase seconds and peak RSS of two runs. A phase slower by more
+    than `threshold` (0.1 = 10%) is a regression.
+    """
+    before = dict((x['phase'], x) for x in baseline['phases'])
+    rows = []
+    for phase in current['phases']:
+        old = before.get(phase['phase'])
+        if not old:
+            continue
+        change = (phase['seconds'] - old['seconds']) / old['seconds'] if old['seconds'] else 0
+        rows.append({
+            'phase': phase['phase'],
+            'before': old['seconds'],
+            'after': phase['seconds'],
+            'change': round(change, 3),
+            'rss_before': old.get('peak_rss_mb'),
+            'rss_after': phase.get('peak_rss_mb'),
+            'regression': change > threshold,
+        })
+    return rows
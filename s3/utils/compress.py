@@ -0,0 +1,215 @@
+import fnmatch
+import logging
+import os
+import time
+import zipfile
+import zlib
+
+from s3.utils import FileUtils
+from s3.utils.pool import run_bounded
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+EXTENSIONS = {
+    'deflate': '.zip',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+# per project overrides live in projects.py under 'compress'
+DEFAULT_COMPRESS = {
+    # deflate (.zip), gzip (.gz) or zstd (.zst)
+    'codec': 'deflate',
+    'level': None,
+    # files compressed at once; zlib and zstd release the GIL while compressing
+    'workers': 2,
+    # zstd worker threads per file, 0 compresses on the calling thread
+    'threads': 0,
+    'pattern': '*.sql',
+    'read_size': 1 * MB,
+}
+
+
+def check_codec(codec):
+    if codec not in EXTENSIONS:
+        raise ValueError('Unknown compression codec %s' % codec)
+    if codec == 'zstd' and zstandard is None:
+        raise ValueError('zstd needs the zstandard package')
+    return codec
+
+
+def extension(codec):
+    return EXTENSIONS[check_codec(codec)]
+
+
+class Compressor(object):
+    """
+    Streaming compressor: feed chunks to compress(), then call flush() once.
+    gzip output is a regular .gz member, zstd a regular .zst frame.
+    """
+
+    def __init__(self, codec='gzip', level=None, threads=0):
+        self.codec = check_codec(codec)
+        if codec == 'deflate':
+            raise ValueError('deflate writes zip archives, use compress_file')
+        if codec == 'zstd':
+            self.obj = zstandard.ZstdCompressor(level=level or 3, threads=threads).compressobj()
+        else:
+            # wbits 16 + MAX_WBITS: gzip header and trailer
+            self.obj = zlib.compressobj(level or 6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.obj.compress(data)
+
+    def flush(self):
+        return self.obj.flush()
+
+
+def decompressor(codec):
+    """ streaming decompressor with a decompress(data) method """
+    if check_codec(codec) == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+def compress_settings(settings=None):
+    result = dict(DEFAULT_COMPRESS)
+    result.update(settings or {})
+    check_codec(result['codec'])
+    return result
+
+
+def mtime_key(st):
+    return getattr(st, 'st_mtime_ns', None) or st.st_mtime
+
+
+def copy_times(st, path):
+    if hasattr(st, 'st_mtime_ns'):
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    else:
+        os.utime(path, (st.st_atime, st.st_mtime))
+
+
+def write_zip(path, fileobj, level=None):
+    try:
+        archive = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED, compresslevel=level)
+    except TypeError:
+        # compresslevel is Python 3.7+
+        archive = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED)
+    # ZipFile.write streams the source in small chunks
+    archive.write(path, os.path.basename(path))
+    archive.close()
+
+
+def compress_file(path, settings=None):
+    """
+    Compress path to path + extension and remove path. The archive is
+    written to a .part file and renamed into place, and carries the mtime
+    of its source: an archive with the same mtime is up to date, and the
+    source is only removed.
+    """
+    settings = compress_settings(settings)
+    target = path + extension(settings['codec'])
+    st = os.stat(path)
+    result = {'path': path, 'target': target, 'status': 'compressed', 'raw_bytes': st.st_size, 'compressed_bytes': 0}
+
+    try:
+        current = os.stat(target)
+    except (IOError, OSError) as e:
+        current = None
+    if current is not None and mtime_key(current) == mtime_key(st):
+        os.remove(path)
+        result.update({'status': 'skipped', 'compressed_bytes': current.st_size})
+        return result
+
+    tmp_path = target + '.part'
+    try:
+        with open(tmp_path, 'wb') as f:
+            if settings['codec'] == 'deflate':
+                write_zip(path, f, settings['level'])
+            else:
+                compressor = Compressor(settings['codec'], settings['level'], settings['threads'])
+                with open(path, 'rb') as source:
+                    while True:
+                        chunk = source.read(settings['read_size'])
+                        if not chunk:
+                            break
+                        f.write(compressor.compress(chunk))
+                f.write(compressor.flush())
+            f.flush()
+            os.fsync(f.fileno())
+
+        # still being written (a running dump): keep the source, retry next time
+        after = os.stat(path)
+        if mtime_key(after) != mtime_key(st) or after.st_size != st.st_size:
+            os.remove(tmp_path)
+            result['status'] = 'changed'
+            return result
+
+        copy_times(st, tmp_path)
+        os.rename(tmp_path, target)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    os.remove(path)
+    result['compressed_bytes'] = os.path.getsize(target)
+    return result
+
+
+class CompressionStage(FileUtils):
+    """ compresses every file matching `pattern` under a directory on a pool of workers """
+
+    def __init__(self, settings=None):
+        self.settings = compress_settings(settings)
+
+    def find(self, home_dir):
+        for path, entry in self.walk_files(home_dir, None, None):
+            if fnmatch.fnmatch(entry.name, self.settings['pattern']):
+                yield path
+
+    def run(self, paths, progress=None):
+        """ progress(files_done, files_total, bytes_done, bytes_total) """
+        paths = list(paths)
+        stats = {'count': 0, 'skipped': 0, 'changed': 0, 'errors': 0, 'raw_bytes': 0, 'compressed_bytes': 0}
+        total = {'files': len(paths), 'bytes': 0}
+        sizes = {}
+        for path in paths:
+            try:
+                sizes[path] = os.path.getsize(path)
+            except (IOError, OSError) as e:
+                sizes[path] = 0
+            total['bytes'] += sizes[path]
+        done = {'files': 0, 'bytes': 0}
+        start = time.time()
+
+        def finished(path, result, error):
+            done['files'] += 1
+            done['bytes'] += sizes[path]
+            if error is not None:
+                stats['errors'] += 1
+                log.warning('Compression of %s failed: %s' % (path, error))
+            elif result['status'] == 'changed':
+                stats['changed'] += 1
+            else:
+                stats['count' if result['status'] == 'compressed' else 'skipped'] += 1
+                stats['raw_bytes'] += result['raw_bytes']
+                stats['compressed_bytes'] += result['compressed_bytes']
+            if progress:
+                progress(done['files'], total['files'], done['bytes'], total['bytes'])
+
+        run_bounded(lambda path: compress_file(path, self.settings), paths, self.settings['workers'], finished)
+
+        stats['elapsed'] = round(time.time() - start, 2)
+        stats['ratio'] = round(stats['compressed_bytes'] / float(stats['raw_bytes']), 3) if stats['raw_bytes'] else 0
+        log.info('Compressed %d files (%d up to date, %d failed) in %.2fs' % (
+            stats['count'], stats['skipped'], stats['errors'], stats['elapsed']))
+        return stats
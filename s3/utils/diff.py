@@ -0,0 +1,109 @@
+import json
+import time
+from collections import namedtuple
+
+from s3.utils.extsort import sorted_unique
+
+ADDED = 'added'
+MODIFIED = 'modified'
+DELETED = 'deleted'
+UNCHANGED = 'unchanged'
+
+# path and digest are None for deleted entries: the remote index only knows names
+Change = namedtuple('Change', 'kind name path digest')
+
+
+class ChangeSet(object):
+    def __init__(self, keep_unchanged=False):
+        self.added = []
+        self.modified = []
+        self.deleted = []
+        self.unchanged = []
+        self.unchanged_count = 0
+        self.keep_unchanged = keep_unchanged
+        self.local_count = 0
+        self.remote_count = 0
+        self.elapsed = 0
+
+    def add(self, change):
+        if change.kind == UNCHANGED:
+            self.unchanged_count += 1
+            # usually the bulk of the tree, only kept on request
+            if not self.keep_unchanged:
+                return
+        getattr(self, change.kind).append(change)
+
+    def pending(self):
+        """ names which have to be uploaded """
+        return [x.name for x in self.added] + [x.name for x in self.modified]
+
+    def counts(self):
+        return {
+            ADDED: len(self.added),
+            MODIFIED: len(self.modified),
+            DELETED: len(self.deleted),
+            UNCHANGED: self.unchanged_count,
+        }
+
+
+class DiffEngine(object):
+    """
+    Merge-join of the local index (sorted stream of (name, path, dir_hash,
+    digest)) against the remote index names, then of the names found on
+    both sides against the remote digests. The remote streams come in any
+    order and, like the candidates, are sorted through runs on disk in tmp_dir.
+    """
+
+    def __init__(self, remote_names, remote_digests, tmp_dir=None):
+        self.remote_names = remote_names
+        self.remote_digests = remote_digests
+        self.tmp_dir = tmp_dir
+
+    def diff(self, local_entries, keep_unchanged=False):
+        start = time.time()
+        changes = ChangeSet(keep_unchanged)
+        candidates = sorted_unique(self.join_names(local_entries, changes), self.tmp_dir)
+        remote = iter(sorted_unique(self.remote_digests, self.tmp_dir))
+
+        remote_digest = next(remote, None)
+        for line in candidates:
+            digest, name, path = json.loads(line)
+            while remote_digest is not None and remote_digest < digest:
+                remote_digest = next(remote, None)
+            kind = UNCHANGED if remote_digest == digest else MODIFIED
+            changes.add(Change(kind, name, path, digest))
+        # the candidates came by digest
+        changes.modified.sort(key=lambda x: x.name)
+        changes.unchanged.sort(key=lambda x: x.name)
+
+        changes.elapsed = time.time() - start
+        return changes
+
+    def join_names(self, local_entries, changes):
+        """ adds the added and deleted names, yields the names on both sides as [digest, name, path] lines """
+        remote = iter(sorted_unique(self.remote_names, self.tmp_dir))
+
+        def next_remote():
+            name = next(remote, None)
+            if name is not None:
+                changes.remote_count += 1
+            return name
+
+        remote_name = next_remote()
+        for name, path, dir_hash, digest in local_entries:
+            changes.local_count += 1
+            while remote_name is not None and remote_name < name:
+                changes.add(Change(DELETED, remote_name, None, None))
+                remote_name = next_remote()
+
+            digest = dir_hash + digest
+            if remote_name == name:
+                remote_name = next_remote()
+                # a JSON list keeps odd paths on one line and sorts by digest
+                yield json.dumps([digest, name, path])
+            else:
+                changes.add(Change(ADDED, name, path, digest))
+
+        while remote_name is not None:
+            changes.add(Change(DELETED, remote_name, None, None))
+            remote_name = next_remote()
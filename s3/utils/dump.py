@@ -0,0 +1,260 @@
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from s3.utils.compress import Compressor, extension
+from s3.utils.pool import run_bounded
+from s3.utils.throttle import Throttle
+
+log = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# per database overrides live in projects.py under 'dump'
+DEFAULT_DUMP = {
+    'codec': 'gzip',
+    'level': None,
+    'read_size': 1 * MB,
+    # S3 part size, at least 5MB
+    'part_size': 8 * MB,
+    # databases dumped at once
+    'workers': 2,
+}
+
+
+class DumpError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class FileSink(object):
+    """ writes to <path>.part, renamed to path once the dump succeeded """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.part'
+        self.file = None
+
+    @property
+    def target(self):
+        return self.path
+
+    def open(self):
+        dir_name = os.path.dirname(self.path)
+        if dir_name and not os.path.isdir(dir_name):
+            try:
+                os.makedirs(dir_name)
+            except OSError as e:
+                if not os.path.isdir(dir_name):
+                    raise
+        self.file = open(self.tmp_path, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class S3Sink(object):
+    """
+    Streams into an S3 multipart upload, part_size bytes per part. Dumps
+    smaller than one part are sent with a single PutObject.
+    """
+
+    def __init__(self, client, bucket_name, key, part_size=DEFAULT_DUMP['part_size'], throttle=None):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        self.throttle = throttle or Throttle()
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+
+    @property
+    def target(self):
+        return 's3://%s/%s' % (self.bucket_name, self.key)
+
+    def open(self):
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def upload_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.throttle.call(
+                self.client.create_multipart_upload, Bucket=self.bucket_name, Key=self.key)['UploadId']
+        number = len(self.parts) + 1
+        response = self.throttle.call(self.client.upload_part, Bucket=self.bucket_name, Key=self.key,
+                                      UploadId=self.upload_id, PartNumber=number, Body=data)
+        self.throttle.consume_bytes(len(data))
+        self.parts.append({'PartNumber': number, 'ETag': response['ETag']})
+
+    def commit(self):
+        if self.upload_id is None:
+            self.throttle.call(self.client.put_object, Bucket=self.bucket_name, Key=self.key,
+                               Body=bytes(self.buffer))
+            self.throttle.consume_bytes(len(self.buffer))
+            return
+        if self.buffer:
+            self.upload_part(bytes(self.buffer))
+        self.throttle.call(self.client.complete_multipart_upload, Bucket=self.bucket_name, Key=self.key,
+                           UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        if self.upload_id is not None:
+            try:
+                self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+            except Exception as e:
+                log.warning('Abort of %s failed: %s' % (self.target, e))
+        self.buffer = bytearray()
+
+
+def drain(stream, lines, limit=50):
+    """ keep the last `limit` lines of stderr, reading it keeps the child from blocking """
+    for line in iter(stream.readline, b''):
+        lines.append(line.decode('utf-8', 'replace').rstrip())
+        if len(lines) > limit:
+            del lines[0]
+    stream.close()
+
+
+def run_dump(name, command, sink, codec='gzip', level=None, env=None, read_size=DEFAULT_DUMP['read_size']):
+    """
+    command's stdout -> Compressor -> sink, without a temp copy. Returns
+    {name, target, status, returncode, raw_bytes, compressed_bytes, elapsed, ratio, error}.
+    """
+    start = time.time()
+    result = {
+        'name': name,
+        'target': sink.target,
+        'codec': codec,
+        'status': 'ok',
+        'returncode': None,
+        'raw_bytes': 0,
+        'compressed_bytes': 0,
+        'error': None,
+    }
+    compressor = Compressor(codec, level)
+    errors = []
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, close_fds=True)
+    reader = threading.Thread(target=drain, args=(process.stderr, errors))
+    reader.daemon = True
+    reader.start()
+    try:
+        sink.open()
+        while True:
+            chunk = process.stdout.read(read_size)
+            if not chunk:
+                break
+            result['raw_bytes'] += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                result['compressed_bytes'] += len(data)
+                sink.write(data)
+        data = compressor.flush()
+        result['compressed_bytes'] += len(data)
+        sink.write(data)
+
+        result['returncode'] = process.wait()
+        reader.join()
+        if result['returncode'] != 0:
+            raise DumpError('%s exited with %d: %s' % (
+                os.path.basename(command[0]), result['returncode'], ' '.join(errors[-5:])))
+        sink.commit()
+    except Exception as e:
+        if process.poll() is None:
+            process.kill()
+            result['returncode'] = process.wait()
+        sink.abort()
+        result['status'] = 'failed'
+        result['error'] = str(e)
+        log.error('Dump of %s failed: %s' % (name, e))
+    finally:
+        process.stdout.close()
+
+    result['elapsed'] = round(time.time() - start, 2)
+    result['ratio'] = round(result['compressed_bytes'] / float(result['raw_bytes']), 3) if result['raw_bytes'] else 0
+    if result['status'] == 'ok':
+        log.info('Dump of %s: %d bytes, %d compressed in %.2fs' % (
+            name, result['raw_bytes'], result['compressed_bytes'], result['elapsed']))
+    return result
+
+
+def dump_settings(database):
+    result = dict(DEFAULT_DUMP)
+    result.update(database.get('dump') or {})
+    return result
+
+
+def dump_command(database, db_name):
+    """
+    argv and environment of one dump. 'dump_command' in the database entry
+    replaces mysqldump, {db_name} in it is filled in.
+    """
+    env = dict(os.environ)
+    if database.get('dump_command'):
+        return [x.format(db_name=db_name) for x in database['dump_command']], env
+    # the password goes through the environment, not the process list
+    env['MYSQL_PWD'] = database.get('db_user_password') or ''
+    command = ['mysqldump', '-h', database.get('db_host') or 'localhost', '-u', database.get('db_user'), db_name]
+    return command, env
+
+
+def db_names(database):
+    names = database.get('db_names') or [database.get('db_name')]
+    return [x for x in names if x]
+
+
+def dump_database(database, stamp=None, client=None):
+    """ dump every database of one databases entry concurrently, returns the results """
+    settings = dump_settings(database)
+    stamp = stamp or time.strftime('%m_%d_%Y___%H_%M_%S')
+    file_name = '%s.sql' + extension(settings['codec'])
+
+    if database.get('bucket') and client is None:
+        import boto3
+        client = boto3.client('s3')
+
+    jobs = []
+    for db_name in db_names(database):
+        if database.get('bucket'):
+            key = '%s%s/%s' % (database.get('prefix', ''), stamp, file_name % db_name)
+            sink = S3Sink(client, database['bucket'], key, settings['part_size'])
+        else:
+            sink = FileSink(os.path.join(database.get('backup_path'), stamp, file_name % db_name))
+        command, env = dump_command(database, db_name)
+        jobs.append((db_name, command, env, sink))
+
+    results = {}
+
+    def dump(job):
+        db_name, command, env, sink = job
+        return run_dump(db_name, command, sink, settings['codec'], settings['level'], env, settings['read_size'])
+
+    def finished(job, result, error):
+        results[job[0]] = result if error is None else {'name': job[0], 'status': 'failed', 'error': str(error)}
+
+    run_bounded(dump, jobs, settings['workers'], finished)
+    return [results[x[0]] for x in jobs]
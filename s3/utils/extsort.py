@@ -0,0 +1,124 @@
+import heapq
+import itertools
+import os
+import tempfile
+
+# lines held in memory before a sorted run is spilled to disk
+RUN_SIZE = 200000
+# runs merged at once, more are merged in several passes
+MAX_FANIN = 128
+
+
+def iter_lines(path):
+    """ lines of a file without their newline, nothing if it doesn't exist """
+    try:
+        f = open(path, 'r')
+    except (IOError, OSError) as e:
+        return
+    with f:
+        for line in f:
+            yield line.rstrip('\n')
+
+
+def write_lines(path, lines):
+    """ write lines to path through a temp file and a rename, returns their count """
+    dir_name = os.path.dirname(path)
+    if dir_name and not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+    count = 0
+    with open(path + '.tmp', 'w') as f:
+        for line in lines:
+            f.write(line + '\n')
+            count += 1
+    os.rename(path + '.tmp', path)
+    return count
+
+
+def write_run(lines, tmp_dir):
+    fd, path = tempfile.mkstemp(prefix='.run_', dir=tmp_dir)
+    with os.fdopen(fd, 'w') as f:
+        for line in lines:
+            f.write(line + '\n')
+    return path
+
+
+def unique(lines):
+    """ drop adjacent duplicates of a sorted stream """
+    last = None
+    for line in lines:
+        if line != last:
+            yield line
+            last = line
+
+
+def merge_runs(paths, tmp_dir):
+    """ paths of sorted runs merged down to at most MAX_FANIN runs """
+    while len(paths) > MAX_FANIN:
+        merged = []
+        for i in range(0, len(paths), MAX_FANIN):
+            group = paths[i:i + MAX_FANIN]
+            merged.append(write_run(unique(heapq.merge(*[iter_lines(x) for x in group])), tmp_dir))
+            for path in group:
+                os.remove(path)
+        paths = merged
+    return paths
+
+
+def sorted_unique(lines, tmp_dir=None, run_size=RUN_SIZE):
+    """
+    Stripped, non empty lines sorted and without duplicates, holding at most
+    run_size of them in memory: larger inputs are spilled as sorted runs
+    and merged from disk.
+    """
+    runs = []
+    chunk = set()
+    try:
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            chunk.add(line)
+            if len(chunk) >= run_size:
+                runs.append(write_run(sorted(chunk), tmp_dir))
+                chunk = set()
+        if not runs:
+            for line in sorted(chunk):
+                yield line
+            return
+        if chunk:
+            runs.append(write_run(sorted(chunk), tmp_dir))
+        chunk = None
+        runs = merge_runs(runs, tmp_dir)
+        for line in unique(heapq.merge(*[iter_lines(x) for x in runs])):
+            yield line
+    finally:
+        for path in runs:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def merge_file(path, lines, tmp_dir=None, run_size=RUN_SIZE):
+    """ rewrite path as the sorted union of its lines and `lines`, returns the line count """
+    return write_lines(path, sorted_unique(itertools.chain(iter_lines(path), lines), tmp_dir, run_size))
+
+
+def difference(left, right):
+    """ lines of sorted stream `left` missing from sorted stream `right` """
+    right = iter(right)
+    current = next(right, None)
+    for line in left:
+        while current is not None and current < line:
+            current = next(right, None)
+        if current != line:
+            yield line
+
+
+def intersection(left, right):
+    """ lines of sorted stream `left` also in sorted stream `right` """
+    right = iter(right)
+    current = next(right, None)
+    for line in left:
+        while current is not None and current < line:
+            current = next(right, None)
+        if current == line:
+            yield line
@@ -0,0 +1,85 @@
+import logging
+import time
+
+from s3.utils.runner import BackupLocked
+from s3.utils.runner import BackupRun
+from s3.utils.pool import run_bounded
+
+log = logging.getLogger(__name__)
+
+
+class Fleet(object):
+    """
+    Runs one command over many projects under a shared Budget.
+
+    Every project is scanned and diffed first (`workers` at a time), then the
+    uploads are started largest pending change set first: with a fixed number
+    of project slots that longest-processing-time order keeps the slowest
+    project from starting last and stretching the whole run.
+    """
+
+    def __init__(self, project_names, command_name='push', budget=None, workers=2, request=None,
+                 run_factory=BackupRun):
+        self.project_names = project_names
+        self.command_name = command_name
+        self.budget = budget
+        self.workers = workers
+        self.request = request
+        self.run_factory = run_factory
+        self.results = {}
+
+    def prepare(self, name):
+        run = self.run_factory(name, self.command_name, request=self.request, budget=self.budget)
+        run.prepare()
+        return run
+
+    def plan(self):
+        """ prepared runs, largest pending size first """
+        runs = []
+
+        def prepared(name, run, error):
+            if error is not None:
+                self.failed(name, error)
+                return
+            pending = run.manager.pending_size()
+            self.results[name] = {'status': 'prepared', 'pending_bytes': pending}
+            runs.append((pending, name, run))
+
+        run_bounded(self.prepare, self.project_names, self.workers, prepared)
+        runs.sort(key=lambda x: (-x[0], x[1]))
+        return runs
+
+    def apply(self, item):
+        pending, name, run = item
+        start = time.time()
+        result = run.apply()
+        return result, time.time() - start
+
+    def run(self):
+        start = time.time()
+        runs = self.plan()
+        log.info('Fleet %s: %s' % (self.command_name, ', '.join('%s (%d bytes)' % (name, pending)
+                                                                   for pending, name, run in runs)))
+
+        def applied(item, result, error):
+            name = item[1]
+            if error is not None:
+                self.failed(name, error)
+                return
+            self.results[name].update({
+                'status': 'done',
+                'elapsed': round(result[1], 2),
+                'result': result[0] or {},
+            })
+
+        # the executor starts the runs in submission order
+        run_bounded(self.apply, runs, self.workers, applied)
+
+        log.info('Fleet %s done in %.2fs' % (self.command_name, time.time() - start))
+        return self.results
+
+    def failed(self, name, error):
+        status = 'locked' if isinstance(error, BackupLocked) else 'failed'
+        result = self.results.setdefault(name, {'pending_bytes': 0})
+        result.update({'status': status, 'error': str(error)})
+        log.error('Fleet %s of %s %s: %s' % (self.command_name, name, status, error))
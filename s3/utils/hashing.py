@@ -0,0 +1,145 @@
+import collections
+import hashlib
+import mmap
+import multiprocessing
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+MB = 1024 * 1024
+
+# per project overrides live in projects.py under 'hashing'.
+# md5 stays the default: single part S3 ETags are MD5 digests.
+DEFAULT_HASHING = {
+    'algorithm': 'md5',
+    'read_size': 1 * MB,
+    'mmap_threshold': 64 * MB,
+    'pool': 'thread',
+    'workers': None,
+}
+
+buffers = threading.local()
+
+
+def hashing_settings(settings=None):
+    result = dict(DEFAULT_HASHING)
+    result.update(settings or {})
+    if result['algorithm'] not in ('md5', 'blake2b'):
+        raise ValueError('Unknown hash algorithm %s' % result['algorithm'])
+    if result['algorithm'] == 'blake2b' and blake2b is None:
+        raise ValueError('blake2b needs Python 3.6+ or the pyblake2 package')
+    if result['pool'] not in ('thread', 'process'):
+        raise ValueError('Unknown hashing pool %s' % result['pool'])
+    return result
+
+
+def new_hash(algorithm):
+    if algorithm == 'blake2b':
+        return blake2b()
+    return hashlib.md5()
+
+
+def read_buffer(size):
+    # one buffer per thread (or process), reused for every file
+    buf = getattr(buffers, 'buf', None)
+    if buf is None or len(buf) != size:
+        buf = buffers.buf = bytearray(size)
+    return buf
+
+
+def hash_file(path, algorithm='md5', read_size=DEFAULT_HASHING['read_size'],
+              mmap_threshold=DEFAULT_HASHING['mmap_threshold']):
+    digest = new_hash(algorithm)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if mmap_threshold and size >= mmap_threshold:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                digest.update(mapped)
+            finally:
+                mapped.close()
+        else:
+            buf = read_buffer(read_size)
+            view = memoryview(buf)
+            while True:
+                count = f.readinto(buf)
+                if not count:
+                    break
+                digest.update(view[:count])
+    return digest.hexdigest()
+
+
+def hash_job(job):
+    """ pool task: job is (path, settings, extra), returns (digest or None, extra) """
+    path, settings, extra = job
+    try:
+        return hash_file(path, settings['algorithm'], settings['read_size'], settings['mmap_threshold']), extra
+    except (IOError, OSError) as e:
+        # unreadable or removed since the scan
+        return None, extra
+
+
+class HashEngine(object):
+    def __init__(self, settings=None, budget=None):
+        self.settings = hashing_settings(settings)
+        # a shared Budget replaces the per project pool (and its 'pool' setting)
+        self.budget = budget
+
+    @property
+    def algorithm(self):
+        return self.settings['algorithm']
+
+    def hash_file(self, path):
+        return hash_file(path, self.algorithm, self.settings['read_size'], self.settings['mmap_threshold'])
+
+    def pool(self):
+        if self.budget:
+            return self.budget.hash_pool
+        if self.settings['pool'] == 'process':
+            return multiprocessing.Pool(self.settings['workers'])
+        return ThreadPool(self.settings['workers'])
+
+    def window(self):
+        """ hashes in flight per caller, the generator is only read this far ahead """
+        if self.budget:
+            # one round per worker: the projects sharing the pool take turns
+            return self.budget.hash_workers or multiprocessing.cpu_count()
+        return 2 * (self.settings['workers'] or multiprocessing.cpu_count())
+
+    def imap(self, jobs):
+        """
+        Hash (path, extra) pairs as they come from the generator and yield
+        (digest, extra) in submission order, at most window() of them queued.
+        """
+        pool = self.pool()
+        if self.budget:
+            # shared with other projects, owned by the budget
+            for result in self.__submit(pool, jobs):
+                yield result
+            return
+        try:
+            for result in self.__submit(pool, jobs):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def __submit(self, pool, jobs):
+        window = self.window()
+        pending = collections.deque()
+        # submitted from the calling thread, the tasks of every caller queue up side by side
+        for path, extra in jobs:
+            pending.append(pool.apply_async(hash_job, ((path, self.settings, extra),)))
+            while len(pending) >= window or (pending and pending[0].ready()):
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
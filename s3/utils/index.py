@@ -0,0 +1,174 @@
+import os
+import shutil
+import sqlite3
+import threading
+
+from s3.utils import FileUtils
+
+
+class IndexStore(FileUtils):
+    """
+    Single-file local index (sqlite), one row per tracked file:
+    name (dir hash + path hash) -> path, dir hash, digest and the stat tuple
+    (size, mtime_ns, inode) the digest was computed from. Rows of deleted
+    files stay as tombstones (deleted_at set) until the deletion reached S3.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def open(self):
+        if self.conn is None:
+            if not self.dir_exists(self.path):
+                os.makedirs(os.path.dirname(self.path))
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS objects ('
+                ' name TEXT PRIMARY KEY,'
+                ' path TEXT NOT NULL,'
+                ' dir_hash TEXT NOT NULL,'
+                ' digest TEXT NOT NULL,'
+                ' size INTEGER,'
+                ' mtime_ns INTEGER,'
+                ' inode INTEGER,'
+                ' deleted_at INTEGER)')
+            columns = [x[1] for x in self.conn.execute('PRAGMA table_info(objects)')]
+            if 'deleted_at' not in columns:
+                self.conn.execute('ALTER TABLE objects ADD COLUMN deleted_at INTEGER')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.conn.commit()
+        return self
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self.lock:
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def stat_key(self, st):
+        mtime_ns = getattr(st, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(st.st_mtime * 1000000000)
+        return st.st_size, mtime_ns, st.st_ino
+
+    def get(self, name, tombstones=False):
+        """ (path, dir_hash, digest, size, mtime_ns, inode) or None """
+        query = 'SELECT path, dir_hash, digest, size, mtime_ns, inode FROM objects WHERE name = ?'
+        if not tombstones:
+            query += ' AND deleted_at IS NULL'
+        with self.lock:
+            return self.conn.execute(query, (name,)).fetchone()
+
+    def lookup(self, name, st):
+        """ cached digest if the stat tuple is unchanged, tombstones included """
+        row = self.get(name, True)
+        if row and tuple(row[3:]) == self.stat_key(st):
+            return row[2]
+        return None
+
+    def write_many(self, rows):
+        """ bulk upsert of (name, path, dir_hash, digest, size, mtime_ns, inode), clears tombstones """
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO objects (name, path, dir_hash, digest, size, mtime_ns, inode)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def tombstone_many(self, names, deleted_at):
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    'UPDATE objects SET deleted_at = ? WHERE name = ? AND deleted_at IS NULL',
+                    ((deleted_at, x) for x in names))
+
+    def revive_many(self, names):
+        with self.lock:
+            with self.conn:
+                self.conn.executemany('UPDATE objects SET deleted_at = NULL WHERE name = ?', [(x,) for x in names])
+
+    def tombstones(self):
+        """ (name, path, deleted_at) of deleted files, sorted by name """
+        with self.lock:
+            return self.conn.execute(
+                'SELECT name, path, deleted_at FROM objects WHERE deleted_at IS NOT NULL ORDER BY name').fetchall()
+
+    def delete_many(self, names):
+        with self.lock:
+            with self.conn:
+                self.conn.executemany('DELETE FROM objects WHERE name = ?', [(x,) for x in names])
+
+    def names(self):
+        """ streaming scan of all live names, sorted """
+        cursor = self.conn.execute('SELECT name FROM objects WHERE deleted_at IS NULL ORDER BY name')
+        for row in cursor:
+            yield row[0]
+
+    def entries(self):
+        """ streaming scan of live (name, path, dir_hash, digest), sorted by name """
+        cursor = self.conn.execute(
+            'SELECT name, path, dir_hash, digest FROM objects WHERE deleted_at IS NULL ORDER BY name')
+        for row in cursor:
+            yield row
+
+    def stat_entries(self):
+        """ streaming scan of live (name, path, dir_hash, digest, size), sorted by name """
+        cursor = self.conn.execute(
+            'SELECT name, path, dir_hash, digest, size FROM objects WHERE deleted_at IS NULL ORDER BY name')
+        for row in cursor:
+            yield row
+
+    def count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM objects WHERE deleted_at IS NULL').fetchone()[0]
+
+    def migrate(self, objects_dir, stat_file=None):
+        """
+        One-time import of the old layout: one objects/<2-char>/<hash> file per
+        tracked file holding "path|dir_hash + digest", plus the optional stat cache.
+        """
+        if not os.path.isdir(objects_dir):
+            return 0
+
+        stats = {}
+        if stat_file and self.file_exists(stat_file):
+            for line in self.file_to_list(stat_file):
+                meta = line.rsplit('|', 4)
+                if len(meta) == 5:
+                    stats[meta[0]] = meta[1:]
+
+        count = 0
+        rows = []
+        for dir_name in os.listdir(objects_dir):
+            for hash_path in os.listdir(os.path.join(objects_dir, dir_name)):
+                content = self.file_open(os.path.join(objects_dir, dir_name, hash_path))
+                if not content:
+                    continue
+                path, digest = content.rsplit('|', 1)
+                size = mtime_ns = inode = None
+                stat = stats.get(path)
+                if stat and stat[3] == digest[2:]:
+                    size, mtime_ns, inode = [int(x) for x in stat[:3]]
+                rows.append((dir_name + hash_path, path, digest[:2], digest[2:], size, mtime_ns, inode))
+                if len(rows) >= 10000:
+                    self.write_many(rows)
+                    count += len(rows)
+                    rows = []
+        self.write_many(rows)
+        count += len(rows)
+
+        shutil.rmtree(objects_dir)
+        if stat_file and self.file_exists(stat_file):
+            os.remove(stat_file)
+        return count
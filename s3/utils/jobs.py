@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+from s3.utils.lock import pid_alive
+from s3.utils.metrics import registry
+
+log = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+COLUMNS = ('id', 'project', 'command', 'status', 'created', 'started', 'finished',
+           'files_done', 'files_total', 'bytes_done', 'bytes_total', 'result', 'error', 'owner')
+
+
+class JobStore(object):
+    """
+    local sqlite store of backup jobs, shared by the processes of a host.
+    Each job is owned by the "hostname|pid|token" of the process queueing it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.hostname = socket.gethostname()
+        # the token tells this process from an earlier one with the same pid
+        self.owner = '%s|%d|%s' % (self.hostname, os.getpid(), uuid.uuid4().hex)
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' id TEXT PRIMARY KEY,'
+            ' project TEXT NOT NULL,'
+            ' command TEXT NOT NULL,'
+            ' status TEXT NOT NULL,'
+            ' created REAL, started REAL, finished REAL,'
+            ' files_done INTEGER DEFAULT 0, files_total INTEGER DEFAULT 0,'
+            ' bytes_done INTEGER DEFAULT 0, bytes_total INTEGER DEFAULT 0,'
+            ' result TEXT, error TEXT)')
+        if 'owner' not in [x[1] for x in self.conn.execute('PRAGMA table_info(jobs)')]:
+            self.conn.execute('ALTER TABLE jobs ADD COLUMN owner TEXT')
+        self.conn.commit()
+
+    def execute(self, query, params=()):
+        with self.lock:
+            with self.conn:
+                return self.conn.execute(query, params).fetchall()
+
+    def create(self, project, command):
+        job_id = uuid.uuid4().hex
+        self.execute('INSERT INTO jobs (id, project, command, status, created, owner) VALUES (?, ?, ?, ?, ?, ?)',
+                     (job_id, project, command, QUEUED, time.time(), self.owner))
+        return job_id
+
+    def start(self, job_id):
+        self.execute('UPDATE jobs SET status = ?, started = ? WHERE id = ?', (RUNNING, time.time(), job_id))
+
+    def progress(self, job_id, files_done, files_total, bytes_done, bytes_total):
+        self.execute('UPDATE jobs SET files_done = ?, files_total = ?, bytes_done = ?, bytes_total = ? WHERE id = ?',
+                     (files_done, files_total, bytes_done, bytes_total, job_id))
+
+    def finish(self, job_id, result):
+        self.execute('UPDATE jobs SET status = ?, finished = ?, result = ? WHERE id = ?',
+                     (DONE, time.time(), json.dumps(result), job_id))
+
+    def fail(self, job_id, error):
+        self.execute('UPDATE jobs SET status = ?, finished = ?, error = ? WHERE id = ?',
+                     (FAILED, time.time(), error, job_id))
+
+    def get(self, job_id):
+        rows = self.execute('SELECT %s FROM jobs WHERE id = ?' % ', '.join(COLUMNS), (job_id,))
+        return self.to_dict(rows[0]) if rows else None
+
+    def list(self, status=None, limit=100):
+        if status:
+            rows = self.execute('SELECT %s FROM jobs WHERE status = ? ORDER BY created DESC LIMIT ?' % (
+                ', '.join(COLUMNS)), (status, limit))
+        else:
+            rows = self.execute('SELECT %s FROM jobs ORDER BY created DESC LIMIT ?' % ', '.join(COLUMNS), (limit,))
+        return [self.to_dict(x) for x in rows]
+
+    def counts(self):
+        """ {(project, status): number of jobs} """
+        rows = self.execute('SELECT project, status, COUNT(*) FROM jobs GROUP BY project, status')
+        return dict(((project, status), count) for project, status, count in rows)
+
+    def is_dead(self, owner):
+        """ the owning process is gone; owners on other hosts can't be told and count as alive """
+        if not owner:
+            # rows written before jobs had an owner
+            return True
+        hostname, pid, token = owner.split('|')
+        if hostname != self.hostname or owner == self.owner:
+            return False
+        return int(pid) == os.getpid() or not pid_alive(int(pid))
+
+    def recover(self):
+        """
+        after a restart: running jobs of dead processes of this host are lost,
+        their queued ones are taken over and returned to be run again
+        """
+        rows = self.execute('SELECT DISTINCT owner FROM jobs WHERE status IN (?, ?)', (RUNNING, QUEUED))
+        for owner, in rows:
+            if not self.is_dead(owner):
+                continue
+            self.execute('UPDATE jobs SET status = ?, finished = ?, error = ? WHERE status = ? AND owner IS ?',
+                         (FAILED, time.time(), 'interrupted by restart', RUNNING, owner))
+            # a single statement: of two processes recovering at once only one takes the jobs over
+            self.execute('UPDATE jobs SET owner = ? WHERE status = ? AND owner IS ?', (self.owner, QUEUED, owner))
+        rows = self.execute('SELECT id, project, command FROM jobs WHERE status = ? AND owner = ? ORDER BY created',
+                            (QUEUED, self.owner))
+        return [tuple(x) for x in rows]
+
+    def to_dict(self, row):
+        job = dict(zip(COLUMNS, row))
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+
+class JobScheduler(object):
+    """
+    Runs queued jobs on `workers` background threads, at most `project_limit`
+    jobs of the same project at a time. runner(job_id, project, command, progress)
+    returns the JSON-able result of the job.
+    """
+
+    def __init__(self, store, runner, workers=2, project_limit=1, progress_interval=1.0):
+        self.store = store
+        self.runner = runner
+        self.workers = workers
+        self.project_limit = project_limit
+        self.progress_interval = progress_interval
+
+        self.condition = threading.Condition()
+        self.queue = []
+        self.running = {}
+        self.threads = []
+        self.stopped = False
+
+    def start(self):
+        with self.condition:
+            self.queue.extend(self.store.recover())
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name='backup-job-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def submit(self, project, command):
+        job_id = self.store.create(project, command)
+        with self.condition:
+            self.queue.append((job_id, project, command))
+            self.condition.notify()
+        return job_id
+
+    def next(self):
+        """ first queued job whose project is below its limit, blocks until there is one """
+        with self.condition:
+            while not self.stopped:
+                for job in self.queue:
+                    if self.running.get(job[1], 0) < self.project_limit:
+                        self.queue.remove(job)
+                        self.running[job[1]] = self.running.get(job[1], 0) + 1
+                        return job
+                self.condition.wait()
+        return None
+
+    def done(self, project):
+        with self.condition:
+            self.running[project] -= 1
+            self.condition.notify_all()
+
+    def work(self):
+        while True:
+            job = self.next()
+            if job is None:
+                return
+            job_id, project, command = job
+            try:
+                self.run(job_id, project, command)
+            finally:
+                self.done(project)
+
+    def run(self, job_id, project, command):
+        self.store.start(job_id)
+        state = {'last': 0}
+
+        def progress(files_done, files_total, bytes_done, bytes_total):
+            # one write per interval, not per file
+            now = time.time()
+            if now - state['last'] >= self.progress_interval or files_done >= files_total:
+                state['last'] = now
+                self.store.progress(job_id, files_done, files_total, bytes_done, bytes_total)
+
+        try:
+            result = self.runner(job_id, project, command, progress)
+        except Exception as e:
+            log.error('Job %s (%s/%s) failed: %s' % (job_id, project, command, traceback.format_exc()))
+            self.store.fail(job_id, str(e))
+            registry.inc('backup_runs_total', project=project, command=command, status=FAILED)
+        else:
+            self.store.finish(job_id, result)
+            registry.inc('backup_runs_total', project=project, command=command, status=DONE)
@@ -0,0 +1,60 @@
+import os
+import time
+
+
+class Journal(object):
+    """
+    Append-only record log. Records are "|"-joined fields, one per line, and
+    are fsync'd every `batch` records or `interval` seconds, whichever comes
+    first. A torn last line (no trailing newline) is ignored on replay.
+    """
+
+    def __init__(self, path, batch=100, interval=1.0):
+        self.path = path
+        self.batch = batch
+        self.interval = interval
+        self.file = None
+        self.pending = 0
+        self.synced = time.time()
+
+    def open(self):
+        if self.file is None:
+            dir_name = os.path.dirname(self.path)
+            if dir_name and not os.path.exists(dir_name):
+                os.makedirs(dir_name)
+            self.file = open(self.path, 'a')
+        return self
+
+    def append(self, *fields):
+        self.file.write('|'.join(fields) + '\n')
+        self.pending += 1
+        if self.pending >= self.batch or time.time() - self.synced >= self.interval:
+            self.sync()
+
+    def sync(self):
+        if self.file is not None and self.pending > 0:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.pending = 0
+        self.synced = time.time()
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+    def replay(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    # interrupted mid-write
+                    break
+                yield line[:-1].split('|')
+
+    def clear(self):
+        self.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
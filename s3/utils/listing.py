@@ -0,0 +1,185 @@
+import calendar
+import datetime
+import logging
+import time
+
+from botocore.exceptions import ClientError
+
+from s3.utils.pool import run_bounded
+from s3.utils.resumable import error_code
+
+log = logging.getLogger(__name__)
+
+
+def to_entry(item):
+    """ cacheable [size, etag, last modified epoch] of a listed object """
+    last_modified = item.get('LastModified')
+    if last_modified is not None:
+        last_modified = calendar.timegm(last_modified.utctimetuple())
+    return [item.get('Size'), item.get('ETag'), last_modified]
+
+
+def from_entry(key, entry):
+    """ listed object as boto returns it, LastModified as a naive UTC datetime """
+    size, etag, last_modified = entry
+    if last_modified is not None:
+        last_modified = datetime.datetime.utcfromtimestamp(last_modified)
+    return {'Key': key, 'Size': size, 'ETag': etag, 'LastModified': last_modified}
+
+
+class BucketLister(object):
+    """
+    ListObjectsV2 of a bucket, one request chain per top level prefix on a
+    bounded pool. only_dirs become server side prefixes, excluded top level
+    prefixes are never listed.
+
+    With a cache (a CheckpointStore) every prefix listing is kept locally,
+    stamped with the ETag of `validator_key`, an object rewritten by every
+    push. While it still has that ETag one HEAD revalidates all cached
+    prefixes; writes of our own re-stamp the prefixes they didn't touch.
+    """
+
+    def __init__(self, client, bucket_name, throttle, workers=8, cache=None, validator_key=None, ttl=None):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.throttle = throttle
+        self.workers = workers
+        self.cache = cache
+        self.validator_key = validator_key
+        # seconds a cached prefix is trusted at most, writes by other tools aren't seen before
+        self.ttl = ttl
+        self.stats = {}
+        # prefixes dropped since the last stamp
+        self.invalidated = set()
+
+    def list_prefix(self, prefix, delimiter=None):
+        """ ({key: listed object}, [common prefixes], pages), runs in the pool threads """
+        objects = {}
+        prefixes = []
+        pages = 0
+        params = {'Bucket': self.bucket_name, 'Prefix': prefix}
+        if delimiter:
+            params['Delimiter'] = delimiter
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**params):
+            self.throttle.request()
+            pages += 1
+            for item in page.get('Contents') or []:
+                objects[item['Key']] = item
+            prefixes.extend(x['Prefix'] for x in page.get('CommonPrefixes') or [])
+        return objects, prefixes, pages
+
+    def validator(self):
+        """ current ETag of the validator object, None if there is none or nothing is cached """
+        if not self.validator_key or self.cache is None:
+            return None
+        try:
+            response = self.throttle.call(self.client.head_object, Bucket=self.bucket_name, Key=self.validator_key)
+        except ClientError as e:
+            if error_code(e) in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return response.get('ETag')
+
+    def cached(self, prefix, validator):
+        if self.cache is None or validator is None:
+            return None
+        state = self.cache.load(prefix)
+        if not state or state['validator'] != validator:
+            return None
+        if self.ttl is not None and time.time() - state['listed'] > self.ttl:
+            return None
+        return state
+
+    def store(self, prefix, validator, objects, prefixes=()):
+        if self.cache is None or validator is None:
+            return
+        self.cache.save({
+            'key': prefix,
+            'validator': validator,
+            'listed': time.time(),
+            'objects': dict((k, to_entry(v)) for k, v in objects.items()),
+            'prefixes': list(prefixes),
+        })
+
+    def top_level(self, validator, only_dirs=None, exclude_dirs=None, skip=()):
+        """ (objects at the top level, prefixes to list) """
+        if only_dirs:
+            return {}, [x.strip('/') + '/' for x in only_dirs]
+
+        state = self.cached('', validator)
+        if state:
+            objects = dict((k, from_entry(k, v)) for k, v in state['objects'].items())
+            prefixes = state['prefixes']
+            self.stats['cached'] += 1
+        else:
+            objects, prefixes, pages = self.list_prefix('', '/')
+            self.store('', validator, objects, prefixes)
+            self.stats['listed'] += 1
+            self.stats['requests'] += pages
+        excluded = set(x.strip('/') for x in exclude_dirs or ())
+        return objects, [x for x in prefixes if x.strip('/') not in excluded and x not in skip]
+
+    def list(self, only_dirs=None, exclude_dirs=None, skip=(), use_cache=True):
+        """
+        {key: listed object} below the top level prefixes selected by
+        only_dirs/exclude_dirs; skip: top level prefixes ('.backup/') never listed
+        """
+        start = time.time()
+        self.stats = {'listed': 0, 'cached': 0, 'requests': 0}
+        validator = self.validator() if use_cache else None
+        objects, prefixes = self.top_level(validator, only_dirs, exclude_dirs, skip)
+
+        stale = []
+        for prefix in prefixes:
+            state = self.cached(prefix, validator)
+            if state:
+                objects.update((k, from_entry(k, v)) for k, v in state['objects'].items())
+                self.stats['cached'] += 1
+            else:
+                stale.append(prefix)
+
+        def listed(prefix, result, error):
+            if error is not None:
+                raise error
+            objects.update(result[0])
+            self.store(prefix, validator, result[0])
+            self.stats['listed'] += 1
+            self.stats['requests'] += result[2]
+
+        run_bounded(self.list_prefix, stale, self.workers, listed)
+        self.stats['elapsed'] = round(time.time() - start, 2)
+        log.info('Listed %d objects of %s: %d prefixes listed, %d revalidated, %d requests in %.2fs' % (
+            len(objects), self.bucket_name, self.stats['listed'], self.stats['cached'], self.stats['requests'],
+            self.stats['elapsed']))
+        return objects
+
+    def invalidate(self, keys):
+        """ drop the cached prefixes of keys about to be written, before the write """
+        if self.cache is None:
+            return
+        prefixes = set(x.split('/')[0] + '/' if '/' in x else '' for x in keys) - self.invalidated
+        if not prefixes:
+            return
+        root = self.cache.load('')
+        if root and not prefixes <= set(root['prefixes']):
+            # a new top level prefix or object
+            prefixes.add('')
+        for prefix in prefixes:
+            self.cache.remove(prefix)
+        self.invalidated.update(prefixes)
+
+    def stamp(self, old, new):
+        """
+        After our own writes moved the validator from ETag `old` to `new`:
+        the prefixes left in the cache weren't written, they stay valid.
+        """
+        self.invalidated = set()
+        if self.cache is None:
+            return
+        for state in list(self.cache.states()):
+            if old is None or new is None or state.get('validator') != old:
+                self.cache.remove(state['key'])
+            else:
+                state['validator'] = new
+                self.cache.save(state)
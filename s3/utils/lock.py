@@ -0,0 +1,217 @@
+import errno
+import fcntl
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+
+class LockBusy(Exception):
+    def __init__(self, msg, owner=None):
+        self.msg = msg
+        self.owner = owner
+
+    def __str__(self):
+        return self.msg
+
+
+class LeaseLock(object):
+    """
+    Lock file holding a lease: {token, pid, hostname, acquired, renewed}.
+
+    The file is created with O_EXCL, so only one process can hold it. While
+    it is held a heartbeat thread renews the lease every `heartbeat` seconds.
+    A lease which wasn't renewed for `lease` seconds, or whose pid is gone
+    on this host, is stale and broken by the next acquire. Breaking and
+    releasing happen under flock on a side file, so a stale lease is never
+    confused with the fresh one which replaced it.
+    """
+
+    def __init__(self, path, lease=60, heartbeat=None):
+        self.path = path
+        self.guard_path = path + '.guard'
+        self.lease = lease
+        self.heartbeat = heartbeat or lease / 3.0
+        self.hostname = socket.gethostname()
+        self.token = None
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+        return False
+
+    @property
+    def held(self):
+        return self.token is not None
+
+    def read(self):
+        """ lease of the current holder, None if unlocked """
+        try:
+            with open(self.path) as f:
+                content = f.read()
+            mtime = os.stat(self.path).st_mtime
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            return json.loads(content)
+        except ValueError:
+            # empty lock of the old layout or a torn write: it only has its mtime
+            return {'token': None, 'pid': None, 'hostname': None, 'acquired': mtime, 'renewed': mtime}
+
+    def is_stale(self, owner, now=None):
+        now = now or time.time()
+        if owner['renewed'] + self.lease < now:
+            return True
+        if owner['hostname'] == self.hostname and owner['pid'] and not pid_alive(owner['pid']):
+            return True
+        return False
+
+    def is_locked(self):
+        owner = self.read()
+        return owner is not None and not self.is_stale(owner)
+
+    def acquire(self, timeout=0, poll=1.0):
+        """
+        Take the lock. timeout=0 fails at once, None waits forever,
+        otherwise waits up to timeout seconds. Raises LockBusy.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            owner = self.try_acquire()
+            if owner is None:
+                return self
+            if deadline is not None and time.time() >= deadline:
+                raise LockBusy('%s is held by pid %s on %s since %s' % (
+                    self.path, owner['pid'], owner['hostname'],
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(owner['acquired']))), owner)
+            time.sleep(poll if deadline is None else max(0, min(poll, deadline - time.time())))
+
+    def try_acquire(self):
+        """ None once acquired, else the lease of the holder """
+        dir_name = os.path.dirname(self.path)
+        if dir_name and not os.path.isdir(dir_name):
+            try:
+                os.makedirs(dir_name)
+            except OSError as e:
+                if not os.path.isdir(dir_name):
+                    raise
+
+        token = uuid.uuid4().hex
+        now = time.time()
+        lease = {'token': token, 'pid': os.getpid(), 'hostname': self.hostname, 'acquired': now, 'renewed': now}
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            owner = self.break_stale()
+            if owner is None:
+                return self.try_acquire()
+            return owner
+
+        try:
+            os.write(fd, json.dumps(lease).encode('utf-8'))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.token = token
+        self.lost = False
+        self.start_heartbeat()
+        return None
+
+    def break_stale(self):
+        """ remove a stale lease, None if the lock is free now, else the live lease """
+        with self.guard():
+            owner = self.read()
+            if owner is None:
+                return None
+            if not self.is_stale(owner):
+                return owner
+            log.warning('Breaking stale lock %s of pid %s on %s' % (self.path, owner['pid'], owner['hostname']))
+            os.remove(self.path)
+            return None
+
+    def renew(self):
+        with self.guard():
+            owner = self.read()
+            if owner is None or owner['token'] != self.token:
+                return False
+            owner['renewed'] = time.time()
+            tmp_path = '%s.%s' % (self.path, self.token)
+            with open(tmp_path, 'w') as f:
+                f.write(json.dumps(owner))
+            os.rename(tmp_path, self.path)
+            return True
+
+    def start_heartbeat(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.beat, name='lease-%s' % os.path.basename(self.path))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def beat(self):
+        while not self._stop.wait(self.heartbeat):
+            try:
+                if not self.renew():
+                    self.lost = True
+                    log.error('Lost lock %s: the lease was broken by another run' % self.path)
+                    return
+            except (IOError, OSError) as e:
+                log.warning('Renewing lock %s failed: %s' % (self.path, e))
+
+    def release(self):
+        if self.token is None:
+            return
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        with self.guard():
+            owner = self.read()
+            if owner is not None and owner['token'] == self.token:
+                os.remove(self.path)
+        self.token = None
+
+    def guard(self):
+        return FileGuard(self.guard_path)
+
+
+class FileGuard(object):
+    """ exclusive flock on a side file, held for a few file operations """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+        return False
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM: alive, owned by someone else
+        return e.errno == errno.EPERM
+    return True
@@ -2,59 +2,35 @@ import json
 import os
 
 import requests
-from pyramid.renderers import render
 
 from s3 import projects
-from s3.utils import FileUtils
+from s3.utils.reports import ReportAggregator, write_record
 
 
-def write_report(request, report_dir, name, values):
-    utils = FileUtils()
-    result = render('s3:templates/mail_report.pt', values, request=request)
-    utils.file_create(report_dir, name, result, True)
+def write_report(report_dir, name, values):
+    write_record(report_dir, name, values)
 
 
-def send_report(request, paths):
-    utils = FileUtils()
-    files = []
-    for dir_path in paths:
-        files = files + utils.scan_dir(dir_path, [], [])
-
-    contents = []
-    for file in files:
-        content = utils.file_open(file, True)
-        if content:
-            os.remove(file)
-            contents.append(content)
+def aggregator(paths):
+    return ReportAggregator(paths, len(projects.projects) - 1)
 
-    if len(contents) > 0:
-        content = ' '.join(contents)
-        result = render('s3:templates/mail_base.pt', {}, request=request)
-        result = result.replace('{project_count}', str(len(projects.projects) - 1))
-        result = result.replace('{edited_count}', str(len(contents)))
-        result = result.replace('{content}', content)
-        send_mail(request, 'Backup report', result)
 
+def send_report(request, paths):
+    reports = aggregator(paths)
+    # claimed records are sent again if the mail fails
+    files = reports.claim(reports.files())
+    if len(files) > 0:
+        send_mail(request, 'Backup report', ''.join(reports.html(files)))
+        for file in files:
+            os.remove(file)
 
-def view_reports(request, paths):
-    utils = FileUtils()
-    files = []
-    for dir_path in paths:
-        files = files + utils.scan_dir(dir_path, [], [])
-
-    contents = []
-    for file in files:
-        content = utils.file_open(file, True)
-        if content:
-            contents.append(content)
 
-    if len(contents) > 0:
-        content = ' '.join(contents)
-        result = render('s3:templates/mail_base.pt', {}, request=request)
-        result = result.replace('{project_count}', str(len(projects.projects) - 1))
-        result = result.replace('{edited_count}', str(len(contents)))
-        result = result.replace('{content}', content)
-        return result
+def view_reports(request, paths, format='html'):
+    """ pending reports as a stream of text chunks, html or json """
+    reports = aggregator(paths)
+    files = list(reports.files())
+    if len(files) > 0:
+        return reports.json(files) if format == 'json' else reports.html(files)
 
 
 def send_mail(request, subject, html):
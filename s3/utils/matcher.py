@@ -0,0 +1,44 @@
+class PrefixTrie(object):
+    """
+    Character trie over directory rules, compiled once per scan. Rules keep the
+    plain str.startswith semantics of exclude_dirs/only_dirs.
+    """
+
+    def __init__(self, prefixes=None):
+        self.root = {}
+        self.size = 0
+        for prefix in prefixes or []:
+            self.add(prefix)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, prefix):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        if None not in node:
+            node[None] = True
+            self.size += 1
+
+    def matches(self, path):
+        """ some rule is a prefix of path """
+        node = self.root
+        if None in node:
+            return True
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def leads_to(self, path):
+        """ path is a prefix of some rule, so a rule may match below it """
+        node = self.root
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                return False
+        return True
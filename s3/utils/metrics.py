@@ -0,0 +1,235 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the latency histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# phases take from milliseconds (diff of a small tree) to hours (first hash of a large one)
+PHASE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# name: (type, help), every metric has to be declared here
+METRICS = {
+    'backup_phase_seconds': (HISTOGRAM, 'Duration of a backup phase'),
+    'backup_phase_last_seconds': (GAUGE, 'Duration of the last run of a backup phase'),
+    'backup_files_scanned_total': (COUNTER, 'Files found by the home_dir walk'),
+    'backup_files_hashed_total': (COUNTER, 'Files hashed because they are new or changed'),
+    'backup_files_total': (COUNTER, 'Files transferred'),
+    'backup_bytes_total': (COUNTER, 'Bytes transferred'),
+    'backup_errors_total': (COUNTER, 'Failed transfers and runs'),
+    'backup_transfer_seconds': (HISTOGRAM, 'Transfer latency of one file'),
+    'backup_runs_total': (COUNTER, 'Finished backup jobs'),
+    'backup_jobs': (GAUGE, 'Jobs in the job store'),
+    'backup_throttle_bytes_per_sec': (GAUGE, 'Measured transfer rate'),
+    'backup_throttle_requests_per_sec': (GAUGE, 'Measured S3 request rate'),
+    'backup_throttle_requests_total': (COUNTER, 'S3 requests'),
+    'backup_throttle_slowdowns_total': (COUNTER, 'SlowDown/503 answers from S3'),
+    'backup_throttle_retries_total': (COUNTER, 'Requests retried after a SlowDown'),
+    'backup_throttle_seconds_total': (COUNTER, 'Seconds spent in SlowDown backoff'),
+}
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in items)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield '%s_bucket%s %d' % (name, format_labels(labels, ('le', format_value(float(bound)))), cumulative)
+        yield '%s_bucket%s %d' % (name, format_labels(labels, ('le', '+Inf')), self.count)
+        yield '%s_sum%s %s' % (name, format_labels(labels), format_value(round(self.sum, 6)))
+        yield '%s_count%s %d' % (name, format_labels(labels), self.count)
+
+
+class Registry(object):
+    """ thread safe counters, gauges and histograms of the process, labeled by project """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def check(self, name, kind):
+        if METRICS.get(name, (None,))[0] != kind:
+            raise ValueError('%s is not a declared %s' % (name, kind))
+
+    def inc(self, name, amount=1, **labels):
+        self.check(name, COUNTER)
+        key = (name, label_key(labels))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        self.check(name, GAUGE)
+        with self.lock:
+            self.values[(name, label_key(labels))] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        self.check(name, HISTOGRAM)
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def get(self, name, **labels):
+        with self.lock:
+            return self.values.get((name, label_key(labels)))
+
+    def clear(self):
+        with self.lock:
+            self.values = {}
+
+    def render(self, extra=None):
+        """
+        Text exposition format. extra: {(name, label items): value} of
+        values owned by someone else (throttles, the job store).
+        """
+        with self.lock:
+            values = dict((k, v) for k, v in self.values.items() if not isinstance(v, Histogram))
+            histograms = [(k, v.buckets, list(v.counts), v.sum, v.count)
+                          for k, v in self.values.items() if isinstance(v, Histogram)]
+        values.update(extra or {})
+
+        grouped = {}
+        for (name, labels), value in values.items():
+            grouped.setdefault(name, []).append((labels, value))
+        for (name, labels), buckets, counts, total, count in histograms:
+            histogram = Histogram(buckets)
+            histogram.counts, histogram.sum, histogram.count = counts, total, count
+            grouped.setdefault(name, []).append((labels, histogram))
+
+        lines = []
+        for name in sorted(grouped):
+            kind, text = METRICS[name]
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in sorted(grouped[name], key=lambda x: x[0]):
+                if isinstance(value, Histogram):
+                    lines.extend(value.lines(name, labels))
+                else:
+                    lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class Metrics(object):
+    """ the registry seen from one project: every value is labeled project="<name>" """
+
+    def __init__(self, project, registry=registry):
+        self.project = project
+        self.registry = registry
+
+    def inc(self, name, amount=1, **labels):
+        self.registry.inc(name, amount, project=self.project, **labels)
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        self.registry.observe(name, value, buckets, project=self.project, **labels)
+
+    @contextmanager
+    def phase(self, name):
+        """ time the block as phase `name`, failed blocks are timed too """
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.registry.observe('backup_phase_seconds', elapsed, PHASE_BUCKETS, project=self.project, phase=name)
+            self.registry.set('backup_phase_last_seconds', elapsed, project=self.project, phase=name)
+
+    def timed(self, items, name, counter=None):
+        """
+        Generator over items timing only the time spent producing them, for
+        walks consumed lazily by the hashing pool. Counts the items in `counter`.
+        """
+        elapsed = 0
+        count = 0
+        iterator = iter(items)
+        try:
+            while True:
+                start = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.time() - start
+                count += 1
+                yield item
+        finally:
+            self.registry.observe('backup_phase_seconds', elapsed, PHASE_BUCKETS, project=self.project, phase=name)
+            self.registry.set('backup_phase_last_seconds', elapsed, project=self.project, phase=name)
+            if counter:
+                self.inc(counter, count)
+
+    def transfer(self, direction, size, elapsed=None, error=None):
+        """ one finished upload or download """
+        if error is not None:
+            self.inc('backup_errors_total', direction=direction)
+            return
+        self.inc('backup_files_total', direction=direction)
+        self.inc('backup_bytes_total', size or 0, direction=direction)
+        if elapsed is not None:
+            self.observe('backup_transfer_seconds', elapsed, direction=direction)
+
+
+def throttle_values(throttles, names=None):
+    """ registry extras of throttle_metrics(), keys mapped to project names by `names` """
+    values = {}
+    fields = (
+        ('backup_throttle_bytes_per_sec', 'bytes_per_sec'),
+        ('backup_throttle_requests_per_sec', 'requests_per_sec'),
+        ('backup_throttle_requests_total', 'total_requests'),
+        ('backup_throttle_slowdowns_total', 'slowdowns'),
+        ('backup_throttle_retries_total', 'retries'),
+        ('backup_throttle_seconds_total', 'throttled_seconds'),
+    )
+    for key, metrics in throttles.items():
+        labels = (('project', (names or {}).get(key, key)),)
+        for name, field in fields:
+            values[(name, labels)] = metrics[field]
+    return values
+
+
+def job_values(counts):
+    """ registry extras of JobStore.counts() """
+    return dict((('backup_jobs', (('project', project), ('status', status))), count)
+                for (project, status), count in counts.items())
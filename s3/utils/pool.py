@@ -0,0 +1,30 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def run_bounded(func, items, workers, callback=None):
+    """
+    Run func(item) for every item on a pool of `workers` threads, keeping at
+    most 2 * workers items queued (items may come from a generator).
+    callback(item, result, error) runs in the calling thread.
+    """
+    pending = {}
+
+    def collect(futures):
+        for future in futures:
+            item = pending.pop(future)
+            error = future.exception()
+            if callback:
+                callback(item, future.result() if error is None else None, error)
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for item in items:
+            if len(pending) >= workers * 2:
+                done, not_done = wait(list(pending), return_when=FIRST_COMPLETED)
+                collect(done)
+            pending[executor.submit(func, item)] = item
+        while pending:
+            done, not_done = wait(list(pending), return_when=FIRST_COMPLETED)
+            collect(done)
+    finally:
+        executor.shutdown(wait=True)
@@ -0,0 +1,124 @@
+import io
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates')
+
+# one JSON line per project run
+RECORD_SUFFIX = '.jsonl'
+# record files claimed by a report being sent, sent again if that failed
+CLAIMED_SUFFIX = '.sending'
+# where the records go in the rendered mail_base.pt
+CONTENT_MARKER = '<!--s3-report-content-->'
+
+# compiled templates, loaded once per process
+_templates = {}
+
+
+def get_template(name):
+    template = _templates.get(name)
+    if template is None:
+        from chameleon import PageTemplateFile
+        template = _templates[name] = PageTemplateFile(os.path.join(TEMPLATES_DIR, name))
+    return template
+
+
+def write_record(report_dir, name, values):
+    """ append the values of one run of project `name` to its record file """
+    if not os.path.isdir(report_dir):
+        try:
+            os.makedirs(report_dir)
+        except OSError as e:
+            if not os.path.isdir(report_dir):
+                raise
+    record = dict(values, time=int(time.time()))
+    # a single short write: concurrent runs append whole lines
+    with io.open(os.path.join(report_dir, name + RECORD_SUFFIX), 'a', encoding='utf-8') as f:
+        f.write(u'%s\n' % json.dumps(record, sort_keys=True))
+
+
+class ReportAggregator(object):
+    """
+    The run records of all report dirs, read lazily and rendered as one
+    stream of chunks, HTML through the compiled mail templates or JSON.
+    Files which aren't records are HTML fragments of older versions and
+    are passed through as they are.
+    """
+
+    def __init__(self, paths, project_count=0):
+        self.paths = sorted(paths)
+        self.project_count = project_count
+
+    def files(self):
+        """ report files of every dir, listed without opening them """
+        for dir_path in self.paths:
+            try:
+                names = sorted(os.listdir(dir_path))
+            except OSError as e:
+                continue
+            for name in names:
+                path = os.path.join(dir_path, name)
+                if not name.startswith('.') and os.path.isfile(path):
+                    yield path
+
+    def claim(self, files):
+        """ move files out of the way of new runs, returns the claimed paths """
+        claimed = []
+        for path in files:
+            if path.endswith(CLAIMED_SUFFIX):
+                claimed.append(path)
+                continue
+            try:
+                os.rename(path, path + CLAIMED_SUFFIX)
+            except OSError as e:
+                continue
+            claimed.append(path + CLAIMED_SUFFIX)
+        return claimed
+
+    def records(self, files=None):
+        for path in self.files() if files is None else files:
+            try:
+                f = io.open(path, 'r', encoding='utf-8')
+            except (IOError, OSError) as e:
+                continue
+            with f:
+                if not path.endswith(RECORD_SUFFIX) and not path.endswith(RECORD_SUFFIX + CLAIMED_SUFFIX):
+                    content = f.read()
+                    if content:
+                        yield {'html': content}
+                    continue
+                for line in f:
+                    if not line.endswith('\n'):
+                        # still being written
+                        break
+                    try:
+                        yield json.loads(line)
+                    except ValueError as e:
+                        log.warning('Skipped a broken report record in %s' % path)
+
+    def summary(self, files):
+        return {'project_count': self.project_count, 'edited_count': len(files)}
+
+    def html(self, files=None):
+        """ the report mail as a stream of chunks """
+        files = list(self.files()) if files is None else files
+        values = self.summary(files)
+        values['content'] = CONTENT_MARKER
+        head, tail = get_template('mail_base.pt')(**values).split(CONTENT_MARKER, 1)
+        yield head
+        report = get_template('mail_report.pt')
+        for record in self.records(files):
+            yield record['html'] if 'html' in record else report(**record)
+        yield tail
+
+    def json(self, files=None):
+        """ {"project_count", "edited_count", "records": [...]} as a stream of chunks """
+        files = list(self.files()) if files is None else files
+        yield '{%s, "records": [' % json.dumps(self.summary(files), sort_keys=True)[1:-1]
+        for i, record in enumerate(self.records(files)):
+            yield (', ' if i else '') + json.dumps(record, sort_keys=True)
+        yield ']}'
@@ -0,0 +1,283 @@
+import calendar
+import hashlib
+import json
+import logging
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+from s3.utils.pool import run_bounded
+
+log = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# S3 limit of parts per multipart upload
+MAX_PARTS = 10000
+
+
+def state_name(key):
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def stat_key(st):
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return st.st_size, mtime_ns
+
+
+def error_code(error):
+    return str((getattr(error, 'response', None) or {}).get('Error', {}).get('Code', ''))
+
+
+class CheckpointStore(object):
+    """ one small JSON file per transfer under `path`, replaced atomically on every save """
+
+    def __init__(self, path):
+        self.path = path
+
+    def file(self, key):
+        return os.path.join(self.path, state_name(key) + '.json')
+
+    def load(self, key):
+        try:
+            with open(self.file(key)) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            return None
+        return state if state.get('key') == key else None
+
+    def save(self, state):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if not os.path.isdir(self.path):
+                    raise
+        path = self.file(state['key'])
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(path + '.tmp', path)
+
+    def remove(self, key):
+        try:
+            os.remove(self.file(key))
+        except OSError as e:
+            pass
+
+    def states(self):
+        if not os.path.isdir(self.path):
+            return
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.path, name)) as f:
+                    yield json.load(f)
+            except (IOError, OSError, ValueError) as e:
+                continue
+
+
+class ResumableUploader(object):
+    """
+    Multipart upload which checkpoints its upload id and the ETag of every
+    finished part, so an interrupted push resumes at the first missing part.
+    """
+
+    def __init__(self, client, bucket_name, settings, checkpoints, throttle, callback=None):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.settings = settings
+        self.checkpoints = checkpoints
+        self.throttle = throttle
+        # byte callback (throttle, budget), called before a part is sent
+        self.callback = callback or throttle.consume_bytes
+
+    def part_size(self, size):
+        return max(self.settings['multipart_chunksize'], -(-size // MAX_PARTS))
+
+    def remote_parts(self, state):
+        """ {part number: etag} S3 holds for the upload, None if it is gone """
+        parts = {}
+        try:
+            paginator = self.client.get_paginator('list_parts')
+            for page in paginator.paginate(Bucket=self.bucket_name, Key=state['key'], UploadId=state['upload_id']):
+                self.throttle.request()
+                for part in page.get('Parts') or []:
+                    parts[str(part['PartNumber'])] = part['ETag']
+        except ClientError as e:
+            if error_code(e) in ('NoSuchUpload', '404'):
+                return None
+            raise
+        return parts
+
+    def resume(self, key, path, size, mtime_ns, part_size):
+        state = self.checkpoints.load(key)
+        if state and (state['path'], state['size'], state['mtime_ns'], state['part_size']) == \
+                (path, size, mtime_ns, part_size):
+            parts = self.remote_parts(state)
+            if parts is not None:
+                # S3 is the authority, a part may have finished after the last checkpoint
+                state['parts'] = parts
+                log.info('Resuming upload of %s at %d of %d parts' % (
+                    key, len(state['parts']), -(-size // part_size)))
+                return state
+        if state:
+            # the file changed or the upload expired
+            self.abort(state)
+
+        upload_id = self.throttle.call(self.client.create_multipart_upload,
+                                       Bucket=self.bucket_name, Key=key)['UploadId']
+        state = {
+            'key': key,
+            'path': path,
+            'size': size,
+            'mtime_ns': mtime_ns,
+            'part_size': part_size,
+            'upload_id': upload_id,
+            'parts': {},
+            'created': time.time(),
+        }
+        self.checkpoints.save(state)
+        return state
+
+    def upload(self, path, key):
+        size, mtime_ns = stat_key(os.stat(path))
+        part_size = self.part_size(size)
+        state = self.resume(key, path, size, mtime_ns, part_size)
+        numbers = [x for x in range(1, max(1, -(-size // part_size)) + 1) if str(x) not in state['parts']]
+
+        def send(number):
+            with open(path, 'rb') as f:
+                f.seek((number - 1) * part_size)
+                data = f.read(part_size)
+            self.callback(len(data))
+            response = self.throttle.call(self.client.upload_part, Bucket=self.bucket_name, Key=key,
+                                          UploadId=state['upload_id'], PartNumber=number, Body=data)
+            return response['ETag']
+
+        errors = []
+
+        def finished(number, etag, error):
+            # calling thread only: no lock around the checkpoint
+            if error is not None:
+                errors.append(error)
+                return
+            state['parts'][str(number)] = etag
+            self.checkpoints.save(state)
+
+        run_bounded(send, numbers, self.settings['multipart_concurrency'], finished)
+        if errors:
+            # the checkpoint keeps the finished parts for the next run
+            raise errors[0]
+
+        self.throttle.call(self.client.complete_multipart_upload, Bucket=self.bucket_name, Key=key,
+                           UploadId=state['upload_id'], MultipartUpload={'Parts': [
+                               {'PartNumber': int(k), 'ETag': v}
+                               for k, v in sorted(state['parts'].items(), key=lambda x: int(x[0]))]})
+        self.checkpoints.remove(key)
+        return size
+
+    def abort(self, state):
+        try:
+            self.throttle.call(self.client.abort_multipart_upload, Bucket=self.bucket_name, Key=state['key'],
+                               UploadId=state['upload_id'])
+        except ClientError as e:
+            if error_code(e) not in ('NoSuchUpload', '404'):
+                raise
+        current = self.checkpoints.load(state['key'])
+        if current and current['upload_id'] == state['upload_id']:
+            self.checkpoints.remove(state['key'])
+
+    def abort_stale(self, ttl):
+        """ AbortMultipartUpload for uploads older than ttl seconds, returns their count """
+        deadline = time.time() - ttl
+        count = 0
+        for state in list(self.checkpoints.states()):
+            if state.get('created', 0) < deadline:
+                self.abort(state)
+                count += 1
+
+        # uploads whose checkpoint was lost
+        paginator = self.client.get_paginator('list_multipart_uploads')
+        for page in paginator.paginate(Bucket=self.bucket_name):
+            self.throttle.request()
+            for upload in page.get('Uploads') or []:
+                initiated = upload.get('Initiated')
+                if initiated is not None and calendar.timegm(initiated.utctimetuple()) < deadline:
+                    self.abort({'key': upload['Key'], 'upload_id': upload['UploadId']})
+                    count += 1
+        if count:
+            log.info('Aborted %d stale multipart uploads in %s' % (count, self.bucket_name))
+        return count
+
+
+class ResumableDownloader(object):
+    """
+    Ranged GET into a partial file kept between runs: <tmp>/.s3part_<sha1(key)>
+    with a .json sidecar holding the ETag. A later run continues at the
+    partial file's size, If-Match guards against the object having changed.
+    """
+
+    def __init__(self, client, bucket_name, throttle, read_size=1 * MB):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.throttle = throttle
+        self.read_size = read_size
+
+    def partial_path(self, tmp_dir, key):
+        return os.path.join(tmp_dir, '.s3part_' + state_name(key))
+
+    def download(self, key, tmp_dir, etag=None):
+        """ fetch key into its partial file, returns the complete partial file path """
+        path = self.partial_path(tmp_dir, key)
+        meta_path = path + '.json'
+        offset = 0
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta.get('key') == key and (etag is None or meta.get('etag') == etag):
+                etag = meta['etag']
+                offset = os.path.getsize(path)
+        except (IOError, OSError, ValueError) as e:
+            pass
+
+        params = {'Bucket': self.bucket_name, 'Key': key}
+        if offset:
+            params['Range'] = 'bytes=%d-' % offset
+            params['IfMatch'] = etag
+            log.info('Resuming download of %s at %d bytes' % (key, offset))
+        try:
+            response = self.throttle.call(self.client.get_object, **params)
+        except ClientError as e:
+            code = error_code(e)
+            if offset and code in ('PreconditionFailed', '412'):
+                # changed since the partial download, start over
+                self.clear(path)
+                return self.download(key, tmp_dir)
+            if offset and code in ('InvalidRange', '416'):
+                # the partial file is already complete
+                return path
+            raise
+
+        if not offset:
+            with open(meta_path + '.tmp', 'w') as f:
+                json.dump({'key': key, 'etag': response.get('ETag')}, f)
+            os.rename(meta_path + '.tmp', meta_path)
+
+        body = response['Body']
+        with open(path, 'ab' if offset else 'wb') as f:
+            while True:
+                chunk = body.read(self.read_size)
+                if not chunk:
+                    break
+                self.throttle.consume_bytes(len(chunk))
+                f.write(chunk)
+        return path
+
+    def clear(self, path):
+        for name in (path, path + '.json'):
+            if os.path.exists(name):
+                os.remove(name)
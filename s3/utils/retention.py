@@ -0,0 +1,238 @@
+import calendar
+import datetime
+import gzip
+import logging
+import os
+import shutil
+import time
+from collections import namedtuple
+
+from s3.utils import FileUtils
+from s3.utils.throttle import Throttle
+
+log = logging.getLogger(__name__)
+
+# per project (history) and per database (dumps) overrides live under 'retention'
+DEFAULT_RETENTION = {
+    # grandfather-father-son: newest copy of each of the last N days, M weeks and K months
+    'daily': 7,
+    'weekly': 4,
+    'monthly': 12,
+    # kept copies older than this many days leave the server for S3, None keeps them local
+    'local_days': 14,
+    'storage_class': 'STANDARD_IA',
+    # history days older than this are merged into one <date>.gz file
+    'compact_after': 2,
+}
+
+# S3 bills deleted objects of these classes up to their minimum storage duration,
+# archived copies are never deleted earlier
+MIN_STORAGE_DAYS = {
+    'STANDARD': 0,
+    'STANDARD_IA': 30,
+    'ONEZONE_IA': 30,
+    'INTELLIGENT_TIERING': 0,
+    'GLACIER_IR': 90,
+    'GLACIER': 90,
+    'DEEP_ARCHIVE': 180,
+}
+
+HISTORY_FORMAT = '%d_%m_%Y'
+DUMP_FORMAT = '%m_%d_%Y___%H_%M_%S'
+
+# name: top level entry under the base dir (or archive prefix), paths: its files
+Artifact = namedtuple('Artifact', 'name date paths')
+
+
+def retention_settings(settings=None):
+    result = dict(DEFAULT_RETENTION)
+    result.update(settings or {})
+    if result['storage_class'] not in MIN_STORAGE_DAYS:
+        raise ValueError('Unknown storage class %s' % result['storage_class'])
+    return result
+
+
+def parse_date(name, date_format):
+    """ date of an artifact name, extensions ignored; None for foreign entries """
+    try:
+        return datetime.datetime.strptime(name.split('.')[0], date_format)
+    except ValueError:
+        return None
+
+
+def select(artifacts, daily=0, weekly=0, monthly=0):
+    """ names kept by the grandfather-father-son policy """
+    artifacts = list(artifacts)
+    dates = sorted(set(x.date for x in artifacts), reverse=True)
+    kept = set()
+    for count, period in ((daily, lambda d: d.date()),
+                          (weekly, lambda d: d.isocalendar()[:2]),
+                          (monthly, lambda d: (d.year, d.month))):
+        seen = set()
+        for date in dates:
+            if len(seen) >= count:
+                break
+            key = period(date)
+            if key not in seen:
+                # newest copy of the period
+                seen.add(key)
+                kept.add(date)
+    # a history day and its compacted .gz share the date
+    return set(x.name for x in artifacts if x.date in kept)
+
+
+def compact_history(history_dir, older_than_days, now=None):
+    """
+    Merge the .local_* files of every history/<date>/ directory older than
+    `older_than_days` into history/<date>.gz (unique names, sorted).
+    """
+    if not os.path.isdir(history_dir):
+        return 0
+    now = now or datetime.datetime.now()
+    count = 0
+    for name in sorted(os.listdir(history_dir)):
+        path = os.path.join(history_dir, name)
+        date = parse_date(name, HISTORY_FORMAT)
+        if date is None or not os.path.isdir(path) or (now - date).days < older_than_days:
+            continue
+
+        target = path + '.gz'
+        names = set()
+        if os.path.exists(target):
+            # an earlier run was interrupted after writing the archive
+            with gzip.open(target, 'rb') as f:
+                names.update(x for x in f.read().decode('utf-8').split('\n') if x)
+        for file_name in os.listdir(path):
+            with open(os.path.join(path, file_name), 'rb') as f:
+                names.update(x for x in f.read().decode('utf-8').split('\n') if x)
+
+        with gzip.open(target + '.part', 'wb') as f:
+            f.write('\n'.join(sorted(names)).encode('utf-8'))
+        os.rename(target + '.part', target)
+        shutil.rmtree(path)
+        count += 1
+    return count
+
+
+class RetentionEngine(FileUtils):
+    """
+    Applies a retention policy to the dated entries of one directory
+    (history days, dump runs) and of their archive under an S3 prefix.
+    Kept copies older than local_days are uploaded with the configured
+    storage class and removed locally; copies outside the policy are
+    removed locally and, once past the minimum storage duration of their
+    class, from the archive.
+    """
+
+    def __init__(self, base_dir, date_format, settings=None, client=None, bucket_name=None, prefix='',
+                 throttle=None, now=None):
+        self.base_dir = base_dir
+        self.date_format = date_format
+        self.settings = retention_settings(settings)
+        self.client = client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.throttle = throttle or Throttle()
+        self.now = now or datetime.datetime.now()
+
+    def local_artifacts(self):
+        artifacts = []
+        if not os.path.isdir(self.base_dir):
+            return artifacts
+        for name in os.listdir(self.base_dir):
+            date = parse_date(name, self.date_format)
+            path = os.path.join(self.base_dir, name)
+            if date is None or name.endswith('.part'):
+                continue
+            if os.path.isdir(path):
+                paths = [x for x, entry in self.walk_files(path, None, None)]
+            else:
+                paths = [path]
+            artifacts.append(Artifact(name, date, paths))
+        return artifacts
+
+    def remote_artifacts(self):
+        """ {name: Artifact} of the archive, paths are (key, storage class, last modified) """
+        grouped = {}
+        if not self.client:
+            return grouped
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.prefix):
+            self.throttle.request()
+            for item in page.get('Contents') or []:
+                name = item['Key'][len(self.prefix):].split('/')[0]
+                date = parse_date(name, self.date_format)
+                if date is None:
+                    continue
+                artifact = grouped.setdefault(name, Artifact(name, date, []))
+                artifact.paths.append((item['Key'], item.get('StorageClass', 'STANDARD'), item.get('LastModified')))
+        return grouped
+
+    def upload(self, artifact):
+        for path in artifact.paths:
+            key = self.prefix + os.path.relpath(path, self.base_dir).replace(os.sep, '/')
+            self.throttle.call(self.client.upload_file, path, self.bucket_name, key,
+                               ExtraArgs={'StorageClass': self.settings['storage_class']})
+
+    def remove_local(self, artifact):
+        path = os.path.join(self.base_dir, artifact.name)
+        freed = sum(os.path.getsize(x) for x in artifact.paths if os.path.exists(x))
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        return freed
+
+    def deletable(self, path):
+        """ the archived object is past the minimum storage duration of its class """
+        key, storage_class, last_modified = path
+        if last_modified is None:
+            return False
+        age = time.time() - calendar.timegm(last_modified.utctimetuple())
+        return age >= MIN_STORAGE_DAYS.get(storage_class, 0) * 86400
+
+    def delete_remote(self, keys):
+        for i in range(0, len(keys), 1000):
+            self.throttle.call(self.client.delete_objects, Bucket=self.bucket_name, Delete={
+                'Objects': [{'Key': x} for x in keys[i:i + 1000]],
+                'Quiet': True,
+            })
+
+    def run(self):
+        settings = self.settings
+        stats = {'kept': 0, 'pruned': 0, 'uploaded': 0, 'archived_pruned': 0, 'deferred': 0, 'bytes_freed': 0}
+
+        local = self.local_artifacts()
+        remote = self.remote_artifacts()
+        names = dict((x.name, x) for x in remote.values())
+        names.update((x.name, x) for x in local)
+        kept = select(names.values(), settings['daily'], settings['weekly'], settings['monthly'])
+        stats['kept'] = len(kept)
+
+        for artifact in local:
+            if artifact.name not in kept:
+                stats['bytes_freed'] += self.remove_local(artifact)
+                stats['pruned'] += 1
+            elif self.client and settings['local_days'] is not None and \
+                    (self.now - artifact.date).days >= settings['local_days']:
+                if artifact.name not in remote:
+                    self.upload(artifact)
+                    stats['uploaded'] += 1
+                stats['bytes_freed'] += self.remove_local(artifact)
+
+        expired = []
+        for artifact in remote.values():
+            if artifact.name in kept:
+                continue
+            if all(self.deletable(x) for x in artifact.paths):
+                expired.extend(x[0] for x in artifact.paths)
+                stats['archived_pruned'] += 1
+            else:
+                stats['deferred'] += 1
+        if expired:
+            self.delete_remote(expired)
+
+        log.info('Retention of %s: %d kept, %d pruned, %d archived to %s, %d archived copies pruned (%d deferred)' % (
+            self.base_dir, stats['kept'], stats['pruned'], stats['uploaded'], settings['storage_class'],
+            stats['archived_pruned'], stats['deferred']))
+        return stats
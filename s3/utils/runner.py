@@ -0,0 +1,209 @@
+import logging
+import os
+
+from s3.projects import projects, databases
+from s3.utils.backup import BackupManager
+from s3.utils.backup import LocalBackup
+from s3.utils.backup import S3Backup
+from s3.utils.compress import CompressionStage
+from s3.utils.retention import RetentionEngine, compact_history, retention_settings, HISTORY_FORMAT, DUMP_FORMAT
+from s3.utils.lock import LockBusy
+from s3.utils.metrics import Metrics
+from s3.utils.mailer import write_report
+
+log = logging.getLogger(__name__)
+
+
+class BackupLocked(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class BackupRun(object):
+    """ one /backup/{project}/{command} run, outside of any request """
+
+    commands = {
+        'pull': lambda m, p: m.pull(),
+        'push': lambda m, p: m.push(),
+        'init': lambda m, p: m.init(),
+        'rebase_digest': lambda m, p: m.rebase_digest(),
+        'verify': lambda m, p: m.verify(p.get('verify')),
+    }
+    # commands which only read the bucket: nothing to apply or report
+    read_only = ('verify',)
+
+    def __init__(self, project_name, command_name, request=None, progress=None, budget=None):
+        self.project_name = project_name
+        self.project = projects.get(project_name)
+        self.command_name = command_name
+        self.request = request
+        self.progress = progress
+        self.budget = budget
+        # phase timers and transfer counters, labeled with the project name
+        self.metrics = Metrics(project_name)
+
+        self.local = None
+        self.s3 = None
+        self.manager = None
+        self.result = None
+
+        # Worker
+        self.job = LocalBackup(
+            ConfigDir=self.project.get('config_dir'),
+            HomeDir=self.project.get('home_dir'))
+
+    def prepare(self):
+        """ lock, scan, fetch the S3 index and run the command; apply() unlocks """
+        # Lock job, before any scanning
+        try:
+            self.job.lock(self.project.get('lock_timeout', 0))
+        except LockBusy as e:
+            raise BackupLocked('%s is locked by another run: %s' % (self.project_name, e))
+
+        try:
+            self.__prepare()
+        except BaseException:
+            self.job.unlock()
+            raise
+
+    def __prepare(self):
+        project = self.project
+
+        # Local cache
+        self.local = LocalBackup(
+            HomeDir=project.get('home_dir'),
+            ConfigDir=project.get('config_dir'),
+            ExcludeDirs=project.get('exclude_dirs'),
+            OnlyDirs=project.get('only_dirs'),
+            Hashing=project.get('hashing'),
+            Budget=self.budget,
+            Metrics=self.metrics)
+        self.local.sync()
+
+        # S3 backup
+        self.s3 = S3Backup(
+            S3Bucket=project.get('bucket'),
+            HomeDir=project.get('home_dir'),
+            ConfigDir=project.get('config_dir'),
+            ExcludeDirs=project.get('exclude_dirs'),
+            OnlyDirs=project.get('only_dirs'),
+            Transfer=project.get('transfer'),
+            Dedup=project.get('dedup', False),
+            DeleteGrace=project.get('delete_grace'),
+            Budget=self.budget,
+            Throttle=project.get('throttle'),
+            Metrics=self.metrics,
+            Hashing=project.get('hashing'))
+        self.s3.sync()
+
+        self.manager = BackupManager()
+        self.manager.slave = self.local
+        self.manager.master = self.s3
+        self.manager.progress = self.progress
+
+        self.result = self.commands[self.command_name](self.manager, project)
+
+    def apply(self):
+        try:
+            if self.job.lease.lost:
+                raise BackupLocked('%s lost its lock while scanning' % self.project_name)
+            if self.command_name in self.read_only:
+                return self.result
+            # Apply changes
+            result = self.manager.apply()
+            if result:
+                self.report(result)
+        finally:
+            # Unlock job
+            self.job.unlock()
+        return result
+
+    def report(self, result):
+        # send_mail(request, '%s backup success' % project.get('name'), result)
+        write_report(self.job.reports_dir, self.project.get('name'), {
+            'count': result['count'],
+            'size': result['size'],
+            'date': result['date'],
+            'project': self.project.get('name'),
+            'rehashed': self.local.stats.get('rehashed', 0),
+            'reused': self.local.stats.get('reused', 0),
+            'files_per_sec': result['files_per_sec'],
+            'mb_per_sec': result['mb_per_sec'],
+            'bytes_saved': result['bytes_saved'],
+            'dedup_ratio': result['dedup_ratio'],
+            'added': result['changes'].get('added', 0),
+            'modified': result['changes'].get('modified', 0),
+            'deleted': result['deleted'],
+            'diff_elapsed': result['diff_elapsed']
+        })
+
+    def run(self):
+        self.prepare()
+        return self.apply()
+
+
+def compress_project(project_name, progress=None):
+    """ /zip_sql/{project}: compress the *.sql files of home_dir """
+    project = projects.get(project_name)
+    home_dir = project['home_dir']
+
+    if not os.path.exists(home_dir):
+        os.makedirs(home_dir)
+
+    stage = CompressionStage(project.get('compress'))
+    return stage.run(stage.find(home_dir), progress)
+
+
+def retain_project(project_name, progress=None):
+    """ /retention/{project}: rotate the push history and the database dumps """
+    result = {}
+    project = projects.get(project_name)
+    if project:
+        settings = retention_settings(project.get('retention'))
+        s3 = S3Backup(
+            S3Bucket=project.get('bucket'),
+            HomeDir=project.get('home_dir'),
+            ConfigDir=project.get('config_dir'),
+            Transfer=project.get('transfer'),
+            Throttle=project.get('throttle'),
+            Metrics=Metrics(project_name))
+        # history is written by push
+        s3.lock(project.get('lock_timeout', 0))
+        try:
+            result['compacted'] = compact_history(s3.history_dir, settings['compact_after'])
+            result['history'] = RetentionEngine(
+                s3.history_dir, HISTORY_FORMAT, settings, s3.client, s3.bucket.name, s3.archive_prefix + 'history/',
+                s3.throttle).run()
+        finally:
+            s3.unlock()
+
+    database = databases.get(project_name)
+    if database:
+        client = None
+        if database.get('bucket'):
+            import boto3
+            client = boto3.client('s3')
+        # dumps streamed to S3 are rotated under their prefix, local ones in backup_path
+        result['dumps'] = RetentionEngine(
+            database.get('backup_path'), DUMP_FORMAT, database.get('retention'), client,
+            database.get('bucket'), database.get('prefix', '')).run()
+    return result
+
+
+# jobs which aren't backup commands
+tasks = {
+    'zip_sql': compress_project,
+    'retention': retain_project,
+}
+
+
+def run_job(job_id, project_name, command_name, progress=None):
+    """ JobScheduler runner """
+    log.info('Job %s: %s/%s' % (job_id, project_name, command_name))
+    if command_name in tasks:
+        return tasks[command_name](project_name, progress)
+    result = BackupRun(project_name, command_name, progress=progress).run()
+    return result or {}
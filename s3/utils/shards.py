@@ -0,0 +1,313 @@
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+from s3.utils.pool import run_bounded
+from s3.utils.resumable import error_code
+
+log = logging.getLogger(__name__)
+
+# replaced shards stay readable this long for runs which fetched the previous manifest
+GARBAGE_TTL = 3600
+
+
+def shard_content(lines):
+    """ canonical (sorted, unique) shard text and its sha1 """
+    data = '\n'.join(sorted(set(x for x in lines if x))).encode('utf-8')
+    return data, hashlib.sha1(data).hexdigest()
+
+
+def compress(data):
+    buf = io.BytesIO()
+    # mtime 0: the same shard always compresses to the same bytes
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def decompress(data):
+    with gzip.GzipFile(fileobj=io.BytesIO(data), mode='rb') as f:
+        return f.read()
+
+
+def write_atomic(path, data):
+    dir_name = os.path.dirname(path)
+    if not os.path.isdir(dir_name):
+        try:
+            os.makedirs(dir_name)
+        except OSError as e:
+            if not os.path.isdir(dir_name):
+                raise
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.rename(path + '.tmp', path)
+
+
+class ShardedIndex(object):
+    """
+    The S3 index as gzipped shards keyed by the first `width` hex chars of
+    the path hash (files) or content hash (digests), under immutable keys
+    <prefix>.d/<table>/<shard>.<sha1>.gz. The manifest <prefix>.json maps
+    every shard to its key and checksum; uploading it is the commit point,
+    so a reader sees either the old or the new index, never a mix.
+
+    sync() downloads only the shards whose checksum differs from the local
+    copy, commit() uploads only the shards touched by the changes.
+    """
+
+    def __init__(self, client, bucket_name, throttle, prefix, local_dir, legacy=None, width=2, workers=8):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.throttle = throttle
+        self.manifest_key = prefix + '.json'
+        self.shards_prefix = prefix + '.d/'
+        self.local_dir = local_dir
+        # {table: key} of the single object indexes written before sharding
+        self.legacy_keys = legacy or {}
+        self.width = width
+        self.workers = workers
+        self.manifest = None
+        # {table: lines} read from the legacy objects while the bucket has no manifest
+        self.legacy = None
+        self.stats = {}
+
+    def shard(self, line):
+        # index names and digests start with the 2 char dir hash
+        width = self.manifest['width'] if self.manifest else self.width
+        return line[2:2 + width] or '_'
+
+    def local_path(self, name):
+        return os.path.join(self.local_dir, name)
+
+    def get(self, key):
+        """ object body, None if the key doesn't exist """
+        try:
+            response = self.throttle.call(self.client.get_object, Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if error_code(e) in ('404', 'NoSuchKey'):
+                return None
+            raise
+        return response['Body'].read()
+
+    def put(self, key, data, content_type='application/octet-stream'):
+        self.throttle.call(self.client.put_object, Bucket=self.bucket_name, Key=key, Body=data,
+                           ContentType=content_type)
+        self.throttle.consume_bytes(len(data))
+
+    def load_local(self):
+        try:
+            with open(self.local_path('manifest.json')) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            return {'shards': {}}
+
+    def sync(self):
+        """ bring the local shards up to date with the bucket """
+        start = time.time()
+        self.stats = {'downloaded': 0, 'reused': 0, 'bytes': 0}
+        data = self.get(self.manifest_key)
+        if data is None:
+            self.manifest = None
+            self.legacy = self.download_legacy()
+            return self.stats
+        remote = json.loads(data.decode('utf-8'))
+        local = self.load_local()
+
+        stale = []
+        for name, meta in remote['shards'].items():
+            if local['shards'].get(name, {}).get('sha1') == meta['sha1'] and os.path.exists(self.local_path(name)):
+                self.stats['reused'] += 1
+            else:
+                stale.append(name)
+
+        def fetch(name):
+            meta = remote['shards'][name]
+            data = self.get(meta['key'])
+            if data is None:
+                raise IOError('Shard %s of %s is missing' % (meta['key'], self.bucket_name))
+            content = decompress(data)
+            if hashlib.sha1(content).hexdigest() != meta['sha1']:
+                raise IOError('Shard %s of %s is corrupt' % (meta['key'], self.bucket_name))
+            write_atomic(self.local_path(name), content)
+            return len(data)
+
+        errors = []
+
+        def fetched(name, size, error):
+            if error is not None:
+                errors.append(error)
+                return
+            self.stats['downloaded'] += 1
+            self.stats['bytes'] += size
+
+        run_bounded(fetch, stale, self.workers, fetched)
+        if errors:
+            # the local manifest still describes the shards we had, the next sync retries
+            raise errors[0]
+
+        for name in local['shards']:
+            if name not in remote['shards'] and os.path.exists(self.local_path(name)):
+                os.remove(self.local_path(name))
+        write_atomic(self.local_path('manifest.json'), data)
+        self.manifest = remote
+        self.legacy = None
+        log.info('S3 index of %s: %d of %d shards downloaded (%d bytes) in %.2fs' % (
+            self.bucket_name, self.stats['downloaded'], len(remote['shards']), self.stats['bytes'],
+            time.time() - start))
+        return self.stats
+
+    def download_legacy(self):
+        legacy = {}
+        for table, key in self.legacy_keys.items():
+            data = self.get(key)
+            if data is not None:
+                legacy[table] = [x for x in data.decode('utf-8').split('\n') if x]
+        return legacy
+
+    def read_shard(self, name):
+        try:
+            with open(self.local_path(name), 'rb') as f:
+                data = f.read()
+        except (IOError, OSError) as e:
+            return []
+        return [x for x in data.decode('utf-8').split('\n') if x]
+
+    def lines(self, table):
+        """ all entries of a table, shard by shard """
+        if self.manifest is None:
+            for line in (self.legacy or {}).get(table, []):
+                yield line
+            return
+        for name in sorted(self.manifest['shards']):
+            if name.startswith(table + '/'):
+                for line in self.read_shard(name):
+                    yield line
+
+    def count(self, table):
+        """ number of entries of a table, from the manifest """
+        if self.manifest is None:
+            return len((self.legacy or {}).get(table, []))
+        return sum(v['count'] for k, v in self.manifest['shards'].items() if k.startswith(table + '/'))
+
+    def meta(self):
+        """ values stored with the manifest, empty for legacy indexes """
+        return (self.manifest or {}).get('meta', {})
+
+    def commit(self, changes, meta=None, replace=()):
+        """
+        changes: {table: (added lines, removed lines)}. Uploads the touched
+        shards, then the manifest; the local copy follows once both succeeded.
+        A legacy index is resharded as a whole, the tables in `replace` start
+        over from the added lines. meta: values updated in the manifest.
+        """
+        manifest = self.manifest or {'version': 1, 'width': self.width, 'shards': {}, 'garbage': []}
+        new_meta = dict(manifest.get('meta', {}))
+        new_meta.update(meta or {})
+
+        touched = {}
+        for table, (added, removed) in changes.items():
+            for line in added:
+                if line:
+                    touched.setdefault(table + '/' + self.shard(line), (set(), set()))[0].add(line)
+            for line in removed:
+                if line:
+                    touched.setdefault(table + '/' + self.shard(line), (set(), set()))[1].add(line)
+        base = {}
+        for name in manifest['shards']:
+            if name.split('/')[0] in replace:
+                base[name] = []
+                touched.setdefault(name, (set(), set()))
+        for table, lines in (self.legacy or {}).items():
+            if table in replace:
+                continue
+            for line in lines:
+                name = table + '/' + self.shard(line)
+                base.setdefault(name, []).append(line)
+                touched.setdefault(name, (set(), set()))
+
+        contents = {}
+        for name, (added, removed) in touched.items():
+            if name in base:
+                lines = set(base[name])
+            elif name.split('/')[0] in replace:
+                lines = set()
+            else:
+                lines = set(self.read_shard(name))
+            content, sha1 = shard_content((lines | added) - removed)
+            if manifest['shards'].get(name, {}).get('sha1') != sha1:
+                contents[name] = (content, sha1)
+
+        if not contents and new_meta == manifest.get('meta', {}):
+            return 0
+
+        def upload(name):
+            content, sha1 = contents[name]
+            key = '%s%s.%s.gz' % (self.shards_prefix, name, sha1[:16])
+            data = compress(content)
+            self.put(key, data)
+            return key, len(content), len(content.split(b'\n'))
+
+        shards = dict(manifest['shards'])
+        replaced = []
+        errors = []
+
+        def uploaded(name, result, error):
+            if error is not None:
+                errors.append(error)
+                return
+            if name in shards:
+                replaced.append(shards.pop(name)['key'])
+            if result is not None:
+                key, size, count = result
+                shards[name] = {'key': key, 'sha1': contents[name][1], 'size': size, 'count': count}
+
+        # emptied shards are only dropped from the manifest, never uploaded
+        for name in [x for x in contents if not contents[x][0]]:
+            uploaded(name, None, None)
+        run_bounded(upload, sorted(x for x in contents if contents[x][0]), self.workers, uploaded)
+        if errors:
+            # nothing references the new shards yet, the manifest is unchanged
+            raise errors[0]
+
+        now = time.time()
+        # shard keys are content addressed: a shard back to an earlier content reuses its key,
+        # a key replaced again is kept for another GARBAGE_TTL
+        live = set(v['key'] for v in shards.values())
+        replaced = set(replaced) - live
+        garbage = [x for x in manifest.get('garbage', []) if x[0] not in live and x[0] not in replaced]
+        expired = [x[0] for x in garbage if now - x[1] >= GARBAGE_TTL]
+        new = {
+            'version': 1,
+            'width': manifest['width'],
+            'updated': now,
+            'shards': shards,
+            'meta': new_meta,
+            'garbage': [x for x in garbage if now - x[1] < GARBAGE_TTL] + [[x, now] for x in sorted(replaced)],
+        }
+        data = json.dumps(new, sort_keys=True).encode('utf-8')
+        self.put(self.manifest_key, data, 'application/json')
+
+        for name, (content, sha1) in contents.items():
+            if content:
+                write_atomic(self.local_path(name), content)
+            elif os.path.exists(self.local_path(name)):
+                os.remove(self.local_path(name))
+        write_atomic(self.local_path('manifest.json'), data)
+        self.manifest = new
+        self.legacy = None
+
+        if expired:
+            try:
+                for i in range(0, len(expired), 1000):
+                    self.throttle.call(self.client.delete_objects, Bucket=self.bucket_name, Delete={
+                        'Objects': [{'Key': x} for x in expired[i:i + 1000]], 'Quiet': True})
+            except Exception as e:
+                log.warning('Cleanup of replaced index shards of %s failed: %s' % (self.bucket_name, e))
+        log.info('S3 index of %s: %d shards uploaded' % (self.bucket_name, len(contents)))
+        return len(contents)
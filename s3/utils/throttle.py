@@ -0,0 +1,316 @@
+import logging
+import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError
+
+log = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# error codes S3 answers with when a prefix gets more requests than it can take
+SLOWDOWN_CODES = ('SlowDown', 'ServiceUnavailable', '503', 'RequestLimitExceeded', 'Throttling')
+
+# per project overrides live in projects.py under 'throttle'
+DEFAULT_THROTTLE = {
+    # limits outside of any window, None is unlimited
+    'bytes_per_sec': None,
+    'requests_per_sec': None,
+    # [{'days': [0, 1, 2, 3, 4], 'hours': [8, 20], 'bytes_per_sec': ..., 'requests_per_sec': ...}]
+    # days 0 = monday, hours [start, end) local time, end < start wraps midnight
+    'windows': [],
+    # SlowDown/503 retries, sleeping a random 0..min(backoff_max, backoff_base * 2^attempt)
+    'max_attempts': 5,
+    'backoff_base': 0.5,
+    'backoff_max': 30,
+    # seconds without a SlowDown before the adaptive request cap is doubled
+    'recover': 30,
+}
+
+throttles = {}
+throttles_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket: `rate` tokens per second, at most `burst`
+    (default one second worth) saved up. A rate of None or 0 never blocks.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            if rate == self.rate:
+                return
+            self.rate = rate
+            self.burst = burst or rate
+            self.tokens = min(self.burst, self.tokens if self.tokens is not None else self.burst) if rate else None
+            self.updated = time.time()
+
+    def consume(self, amount=1):
+        """ take `amount` tokens, sleeping until they are available """
+        with self.lock:
+            if not self.rate:
+                return 0
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # the debt is paid by sleeping, later callers queue up behind it
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class Budget(object):
+    """
+    Resources shared by every project of one process: a hashing pool of
+    `hash_workers` threads, at most `upload_workers` uploads in flight and
+    `bandwidth` upload bytes per second. None means unlimited.
+    """
+
+    def __init__(self, hash_workers=None, upload_workers=None, bandwidth=None):
+        self.hash_workers = hash_workers
+        self.upload_workers = upload_workers
+        self.uploads = threading.BoundedSemaphore(upload_workers) if upload_workers else None
+        self.bandwidth = TokenBucket(bandwidth)
+        self.lock = threading.Lock()
+        self._hash_pool = None
+
+    @property
+    def hash_pool(self):
+        with self.lock:
+            if self._hash_pool is None:
+                self._hash_pool = ThreadPool(self.hash_workers)
+            return self._hash_pool
+
+    def upload_slot(self):
+        return self.uploads or Unlimited()
+
+    def close(self):
+        with self.lock:
+            if self._hash_pool is not None:
+                self._hash_pool.close()
+                self._hash_pool.join()
+                self._hash_pool = None
+
+
+class Unlimited(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class RateMeter(object):
+    """ bytes and requests over the last `window` seconds, in one second slots """
+
+    def __init__(self, window=10):
+        self.window = window
+        self.slots = {}
+        self.total_bytes = 0
+        self.total_requests = 0
+        self.lock = threading.Lock()
+
+    def add(self, amount=0, requests=0):
+        now = int(time.time())
+        with self.lock:
+            slot = self.slots.setdefault(now, [0, 0])
+            slot[0] += amount
+            slot[1] += requests
+            self.total_bytes += amount
+            self.total_requests += requests
+            if len(self.slots) > self.window * 2:
+                for key in [x for x in self.slots if x <= now - self.window]:
+                    del self.slots[key]
+
+    def rate(self):
+        """ (bytes/s, requests/s) over the complete slots of the window """
+        now = int(time.time())
+        with self.lock:
+            slots = [v for k, v in self.slots.items() if now - self.window <= k < now]
+        return (sum(x[0] for x in slots) / float(self.window),
+                sum(x[1] for x in slots) / float(self.window))
+
+
+def throttle_settings(settings=None):
+    result = dict(DEFAULT_THROTTLE)
+    result.update(settings or {})
+    return result
+
+
+def in_window(window, now):
+    local = time.localtime(now)
+    if 'days' in window and local.tm_wday not in window['days']:
+        return False
+    if 'hours' in window:
+        start, end = window['hours']
+        if start <= end:
+            return start <= local.tm_hour < end
+        return local.tm_hour >= start or local.tm_hour < end
+    return True
+
+
+def client_error(error):
+    """ the ClientError of an error, upload_file wraps it in an S3UploadFailedError """
+    if isinstance(error, S3UploadFailedError):
+        return getattr(error, '__cause__', None) or getattr(error, '__context__', None)
+    return error
+
+
+def is_slowdown(error):
+    if isinstance(error, S3UploadFailedError) and not client_error(error):
+        # python 2 doesn't chain exceptions, only the message tells the code
+        return any('(%s)' % x in str(error) for x in SLOWDOWN_CODES)
+    error = client_error(error)
+    if not isinstance(error, ClientError):
+        return False
+    response = getattr(error, 'response', None) or {}
+    code = str(response.get('Error', {}).get('Code', ''))
+    status = str(response.get('ResponseMetadata', {}).get('HTTPStatusCode', ''))
+    return code in SLOWDOWN_CODES or status == '503'
+
+
+class Throttle(object):
+    """
+    Bytes/s and requests/s limits of one project, shared by all of its
+    transfer workers. Limits follow the time windows of the settings;
+    SlowDown answers halve an adaptive request cap, which doubles back
+    after `recover` quiet seconds (AIMD).
+    """
+
+    def __init__(self, settings=None):
+        self.settings = throttle_settings(settings)
+        self.bytes = TokenBucket()
+        self.requests = TokenBucket()
+        self.meter = RateMeter()
+        self.lock = threading.Lock()
+        self.cap = None
+        self.slowdowns = 0
+        self.retries = 0
+        self.waited = 0.0
+        self.last_slowdown = 0
+        self.refreshed = 0
+        self.refresh()
+
+    def limits(self, now=None):
+        """ (bytes/s, requests/s) of the settings at `now` """
+        now = now or time.time()
+        for window in self.settings['windows']:
+            if in_window(window, now):
+                return window.get('bytes_per_sec'), window.get('requests_per_sec')
+        return self.settings['bytes_per_sec'], self.settings['requests_per_sec']
+
+    def refresh(self, now=None):
+        now = now or time.time()
+        with self.lock:
+            self.refreshed = now
+            bytes_per_sec, requests_per_sec = self.limits(now)
+            if self.cap is not None and now - self.last_slowdown >= self.settings['recover']:
+                self.cap *= 2
+                self.last_slowdown = now
+                measured = self.meter.rate()[1]
+                # lifted once it is above the configured limit or far above the actual rate
+                if (requests_per_sec and self.cap >= requests_per_sec) or \
+                        (not requests_per_sec and self.cap > measured * 2 + 1):
+                    self.cap = None
+            if self.cap is not None:
+                requests_per_sec = min(requests_per_sec or self.cap, self.cap)
+        self.bytes.set_rate(bytes_per_sec)
+        self.requests.set_rate(requests_per_sec)
+
+    def update(self, settings):
+        self.settings = throttle_settings(settings)
+        self.refresh()
+
+    def maybe_refresh(self):
+        if time.time() - self.refreshed >= 1:
+            self.refresh()
+
+    def consume_bytes(self, amount):
+        """ boto3 transfer Callback, runs in the transfer threads """
+        if amount <= 0:
+            # s3transfer reports negative amounts when it rewinds a retried part
+            return
+        self.maybe_refresh()
+        self.meter.add(amount)
+        self.waited += self.bytes.consume(amount)
+
+    def request(self, count=1):
+        self.maybe_refresh()
+        self.meter.add(requests=count)
+        self.waited += self.requests.consume(count)
+
+    def slow_down(self):
+        now = time.time()
+        with self.lock:
+            self.slowdowns += 1
+            current = self.requests.rate or self.meter.rate()[1] or 10
+            self.cap = max(1.0, current / 2.0)
+            self.last_slowdown = now
+        log.warning('S3 SlowDown, request rate capped at %.1f/s' % self.cap)
+        self.refresh(now)
+
+    def backoff(self, attempt):
+        delay = random.uniform(0, min(self.settings['backoff_max'], self.settings['backoff_base'] * 2 ** attempt))
+        time.sleep(delay)
+        return delay
+
+    def call(self, func, *args, **kwargs):
+        """ func(*args, **kwargs), retried with jittered backoff on SlowDown/503 """
+        requests = kwargs.pop('requests', 1)
+        attempt = 0
+        while True:
+            self.request(requests)
+            try:
+                return func(*args, **kwargs)
+            except (ClientError, S3UploadFailedError) as e:
+                attempt += 1
+                if not is_slowdown(e) or attempt >= self.settings['max_attempts']:
+                    raise
+                self.slow_down()
+                self.retries += 1
+                self.waited += self.backoff(attempt)
+
+    def metrics(self):
+        bytes_per_sec, requests_per_sec = self.meter.rate()
+        return {
+            'bytes_per_sec': round(bytes_per_sec, 2),
+            'requests_per_sec': round(requests_per_sec, 2),
+            'bytes_limit': self.bytes.rate,
+            'requests_limit': self.requests.rate,
+            'total_bytes': self.meter.total_bytes,
+            'total_requests': self.meter.total_requests,
+            'slowdowns': self.slowdowns,
+            'retries': self.retries,
+            'throttled_seconds': round(self.waited, 2),
+        }
+
+
+def get_throttle(key, settings=None):
+    """ the process wide Throttle of a project, concurrent runs share its buckets """
+    with throttles_lock:
+        throttle = throttles.get(key)
+        if throttle is None:
+            throttle = throttles[key] = Throttle(settings)
+            return throttle
+    if throttle_settings(settings) != throttle.settings:
+        throttle.update(settings)
+    return throttle
+
+
+def throttle_metrics():
+    with throttles_lock:
+        items = list(throttles.items())
+    return dict((key, throttle.metrics()) for key, throttle in items)
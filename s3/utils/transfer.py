@@ -0,0 +1,247 @@
+import logging
+import os
+import tempfile
+import time
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+from s3.utils.metrics import Metrics
+from s3.utils.pool import run_bounded
+from s3.utils.resumable import CheckpointStore, ResumableDownloader, ResumableUploader
+from s3.utils.throttle import Throttle, Unlimited
+
+log = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# per project overrides live in projects.py under 'transfer'
+DEFAULT_TRANSFER = {
+    'workers': 8,
+    'multipart_threshold': 8 * MB,
+    'multipart_chunksize': 8 * MB,
+    'multipart_concurrency': 4,
+    # interrupted multipart uploads are resumed, and aborted once older than this
+    'multipart_ttl': 7 * 24 * 3600,
+    # S3 compatible server (moto, minio) instead of AWS, e.g. http://127.0.0.1:5000
+    'endpoint_url': None,
+    # top level prefixes listed at once
+    'list_workers': 8,
+    # seconds a cached prefix listing is trusted while the S3 index is unchanged,
+    # None until the index changes, 0 disables the listing cache
+    'list_cache_ttl': 24 * 3600,
+    # hex chars of the path hash per S3 index shard: 2 is 256 shards, only used for new indexes
+    'index_shard_chars': 2,
+}
+
+
+def transfer_settings(settings=None):
+    result = dict(DEFAULT_TRANSFER)
+    result.update(settings or {})
+    return result
+
+
+def client_config(settings):
+    # every worker may run multipart_concurrency part uploads at once
+    return Config(max_pool_connections=settings['workers'] * settings['multipart_concurrency'])
+
+
+def transfer_config(settings):
+    return TransferConfig(
+        multipart_threshold=settings['multipart_threshold'],
+        multipart_chunksize=settings['multipart_chunksize'],
+        max_concurrency=settings['multipart_concurrency'])
+
+
+def request_count(settings, size):
+    """ S3 requests of one transfer: one, or one per part above the multipart threshold """
+    if size < settings['multipart_threshold']:
+        return 1
+    return -(-size // settings['multipart_chunksize'])
+
+
+def byte_callback(throttle, budget=None):
+    """ boto3 transfer Callback feeding the project throttle and the shared budget """
+    if not budget:
+        return throttle.consume_bytes
+
+    def callback(amount):
+        throttle.consume_bytes(amount)
+        if amount > 0:
+            budget.bandwidth.consume(amount)
+    return callback
+
+
+class UploadEngine(object):
+    """
+    Bounded-concurrency uploader. Items are dicts with at least 'path' and 'key';
+    the callback runs in the calling thread once per finished item, so the
+    caller's bookkeeping needs no locking.
+    """
+
+    def __init__(self, client, bucket_name, settings=None, budget=None, throttle=None, state_dir=None,
+                 metrics=None):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.settings = transfer_settings(settings)
+        self.config = transfer_config(self.settings)
+        # upload slots and bandwidth shared with other projects
+        self.budget = budget
+        # limits of the project, shared with its downloads
+        self.throttle = throttle or Throttle()
+        self.callback = byte_callback(self.throttle, budget)
+        self.metrics = metrics or Metrics(bucket_name)
+        # large files go through checkpointed multipart uploads
+        self.resumable = None
+        if state_dir:
+            self.resumable = ResumableUploader(client, bucket_name, self.settings, CheckpointStore(state_dir),
+                                               self.throttle, self.callback)
+
+    def abort_stale(self):
+        if self.resumable:
+            return self.resumable.abort_stale(self.settings['multipart_ttl'])
+        return 0
+
+    def upload(self, item):
+        size = os.stat(item['path']).st_size
+        with self.budget.upload_slot() if self.budget else Unlimited():
+            # latency of the transfer itself, not of the wait for a slot
+            start = time.time()
+            if self.resumable and size >= self.settings['multipart_threshold']:
+                self.resumable.upload(item['path'], item['key'])
+            else:
+                # the callback runs in the transfer threads for every chunk sent
+                self.throttle.call(self.client.upload_file, item['path'], self.bucket_name, item['key'],
+                                   Config=self.config, Callback=self.callback,
+                                   requests=request_count(self.settings, size))
+            item['elapsed'] = time.time() - start
+        return size
+
+    def run(self, items, callback=None):
+        stats = {'count': 0, 'bytes': 0, 'errors': 0}
+        start = time.time()
+
+        def finished(item, size, error):
+            if error is None:
+                item['size'] = size
+                stats['count'] += 1
+                stats['bytes'] += size
+            else:
+                stats['errors'] += 1
+                log.warning('Upload of %s failed: %s' % (item['path'], error))
+            self.metrics.transfer('upload', size, item.get('elapsed'), error)
+            if callback:
+                callback(item, error)
+
+        run_bounded(self.upload, items, self.settings['workers'], finished)
+
+        stats['elapsed'] = time.time() - start
+        return throughput(stats)
+
+
+class DownloadEngine(object):
+    """
+    Bounded-concurrency downloader. Items are dicts with 'key' and 'path'; every
+    object is written to a temp file and renamed into place, so a failed run
+    never leaves a half-written file in the destination tree.
+    """
+
+    def __init__(self, client, bucket_name, settings=None, tmp_dir=None, throttle=None, metrics=None):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.settings = transfer_settings(settings)
+        self.config = transfer_config(self.settings)
+        self.tmp_dir = tmp_dir
+        self.throttle = throttle or Throttle()
+        self.metrics = metrics or Metrics(bucket_name)
+        # large objects are fetched with resumable ranged GETs into tmp_dir
+        self.resumable = ResumableDownloader(client, bucket_name, self.throttle)
+
+        # mkstemp creates 0600 files, give them the permissions a plain open() would
+        umask = os.umask(0)
+        os.umask(umask)
+        self.mode = 0o666 & ~umask
+
+    def clear_tmp(self):
+        """ drop temp files left by a killed run, partial downloads only once expired """
+        if self.tmp_dir and os.path.isdir(self.tmp_dir):
+            deadline = time.time() - self.settings['multipart_ttl']
+            for name in os.listdir(self.tmp_dir):
+                path = os.path.join(self.tmp_dir, name)
+                if name.startswith('.s3tmp_'):
+                    os.remove(path)
+                elif name.startswith('.s3part_') and os.path.getmtime(path) < deadline:
+                    os.remove(path)
+
+    def temp_dir(self, dir_name):
+        # rename is only atomic within one filesystem
+        if self.tmp_dir and os.path.isdir(self.tmp_dir) and \
+                os.stat(self.tmp_dir).st_dev == os.stat(dir_name).st_dev:
+            return self.tmp_dir
+        return dir_name
+
+    def download(self, item):
+        start = time.time()
+        size = self.fetch(item)
+        item['elapsed'] = time.time() - start
+        return size
+
+    def fetch(self, item):
+        dir_name = os.path.dirname(item['path'])
+        try:
+            os.makedirs(dir_name)
+        except OSError as e:
+            if not os.path.isdir(dir_name):
+                raise
+
+        tmp_dir = self.temp_dir(dir_name)
+        if tmp_dir == self.tmp_dir and item.get('size', 0) >= self.settings['multipart_threshold']:
+            # kept on failure, the next run continues where this one stopped
+            partial = self.resumable.download(item['key'], tmp_dir, item.get('etag'))
+            os.chmod(partial, self.mode)
+            os.rename(partial, item['path'])
+            self.resumable.clear(partial)
+            return item['size']
+
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, prefix='.s3tmp_')
+        os.close(fd)
+        try:
+            self.throttle.call(self.client.download_file, self.bucket_name, item['key'], tmp_path,
+                               Config=self.config, Callback=self.throttle.consume_bytes,
+                               requests=request_count(self.settings, item.get('size', 0)))
+            os.chmod(tmp_path, self.mode)
+            os.rename(tmp_path, item['path'])
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return item.get('size', 0)
+
+    def run(self, items, callback=None):
+        stats = {'count': 0, 'bytes': 0, 'errors': 0}
+        start = time.time()
+        self.clear_tmp()
+        if self.tmp_dir and not os.path.isdir(self.tmp_dir):
+            os.makedirs(self.tmp_dir)
+
+        def finished(item, size, error):
+            if error is None:
+                stats['count'] += 1
+                stats['bytes'] += size
+            else:
+                stats['errors'] += 1
+                log.warning('Download of %s failed: %s' % (item['key'], error))
+            self.metrics.transfer('download', size, item.get('elapsed'), error)
+            if callback:
+                callback(item, error)
+
+        run_bounded(self.download, items, self.settings['workers'], finished)
+
+        stats['elapsed'] = time.time() - start
+        return throughput(stats)
+
+
+def throughput(stats):
+    elapsed = stats.get('elapsed') or 0
+    stats['files_per_sec'] = round(stats['count'] / elapsed, 2) if elapsed > 0 else 0
+    stats['mb_per_sec'] = round(stats['bytes'] / float(MB) / elapsed, 2) if elapsed > 0 else 0
+    return stats
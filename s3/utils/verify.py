@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+import random
+import time
+
+from s3.utils import FileUtils
+from s3.utils.hashing import new_hash
+from s3.utils.listing import BucketLister
+from s3.utils.pool import run_bounded
+
+log = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# per project overrides live in projects.py under 'verify'
+DEFAULT_VERIFY = {
+    # percent of the matching objects downloaded and rehashed, 0 only compares listings
+    'sample': 0,
+    # top level prefixes listed and objects rehashed at once
+    'workers': 8,
+    # entries per drift list in the report, counts are always complete
+    'max_items': 1000,
+}
+
+MISSING = 'missing'
+SIZE_MISMATCH = 'size_mismatch'
+ETAG_MISMATCH = 'etag_mismatch'
+UNINDEXED = 'unindexed'
+DEEP_MISMATCH = 'deep_mismatch'
+DRIFT = (MISSING, SIZE_MISMATCH, ETAG_MISMATCH, UNINDEXED, DEEP_MISMATCH)
+
+
+def verify_settings(settings=None):
+    result = dict(DEFAULT_VERIFY)
+    result.update(settings or {})
+    return result
+
+
+class Verifier(FileUtils):
+    """
+    Audits the bucket against the local index without downloading content:
+    every object the S3 index (or the dedup manifest) claims must be listed
+    with the indexed size and, for single part md5 uploads, an ETag equal to
+    the digest. Objects nobody claims are reported as unindexed. A sampled
+    deep verify downloads and rehashes a share of the matching objects.
+    """
+
+    def __init__(self, master, slave, settings=None):
+        self.master = master
+        self.slave = slave
+        self.settings = verify_settings(settings)
+        self.client = master.client
+        self.bucket_name = master.bucket.name
+        self.throttle = master.throttle
+        self.algorithm = slave.hasher.algorithm
+        # an audit never trusts the listing cache
+        self.lister = BucketLister(self.client, self.bucket_name, self.throttle, self.settings['workers'])
+
+    def expected(self):
+        """
+        {object key: (size or None, digest or None)} the indexes claim, the
+        keys of files deleted locally, and counts of what can't be checked.
+        A None digest means the file changed since it was uploaded.
+        """
+        home_dir = self.master.home_dir
+        expected = {}
+        counts = {'pending': 0, 'changed': 0, 'unresolved': 0}
+        known = set()
+
+        rows = {}
+        for name, path, dir_hash, digest, size in self.slave.get_index_stat_entries():
+            rows[name] = (self.get_relative_path(home_dir, path), dir_hash + digest, size)
+        deleted = set()
+        for name, path, deleted_at in self.slave.get_tombstones():
+            # still in the bucket until the delete grace period ends
+            known.add(self.get_relative_path(home_dir, path))
+            deleted.add(name)
+        counts['deleted_locally'] = len(deleted)
+
+        if self.master.dedup:
+            by_key = dict((key, (digest[2:], size)) for key, digest, size in rows.values())
+            for key, digest in self.master.get_manifest().items():
+                local = by_key.get(key)
+                size = local[1] if local and local[0] == digest else None
+                expected[self.master.blob_key(digest)] = (size, digest)
+                known.add(key)
+            # unreferenced blobs stay until the delete grace period ends
+            known.update(self.master.blob_key(x) for x in self.master.read_orphaned_blobs())
+            counts['pending'] = len([x for x in by_key if x not in known])
+            return expected, known, counts
+
+        indexed = set(self.master.get_index_files())
+        digests = set(self.master.get_index_digests())
+        for name, (key, digest, size) in rows.items():
+            if name not in indexed:
+                counts['pending'] += 1
+                continue
+            if digest not in digests:
+                counts['changed'] += 1
+                expected[key] = (None, None)
+            else:
+                expected[key] = (size, digest[2:])
+        # in the S3 index but neither local nor tombstoned: their key is unknown
+        counts['unresolved'] = len([x for x in indexed if x and x not in rows and x not in deleted])
+        return expected, known, counts
+
+    def deep_verify(self, candidates):
+        """ download and rehash (key, digest) pairs, returns the keys that differ """
+        mismatches = []
+        errors = []
+
+        def rehash(item):
+            key, digest = item
+            response = self.throttle.call(self.client.get_object, Bucket=self.bucket_name, Key=key)
+            content = new_hash(self.algorithm)
+            body = response['Body']
+            while True:
+                chunk = body.read(1 * MB)
+                if not chunk:
+                    break
+                self.throttle.consume_bytes(len(chunk))
+                content.update(chunk)
+            return content.hexdigest()
+
+        def finished(item, result, error):
+            if error is not None:
+                errors.append(item[0])
+                log.warning('Deep verify of %s failed: %s' % (item[0], error))
+            elif result != item[1]:
+                mismatches.append({'key': item[0], 'expected': item[1], 'actual': result})
+
+        run_bounded(rehash, candidates, self.settings['workers'], finished)
+        return mismatches, errors
+
+    def run(self):
+        start = time.time()
+        expected, known, counts = self.expected()
+        listed = self.lister.list()
+        list_elapsed = time.time() - start
+
+        drift = dict((x, []) for x in DRIFT)
+        matching = []
+        for key, (size, digest) in expected.items():
+            obj = listed.get(key)
+            if obj is None:
+                drift[MISSING].append(key)
+                continue
+            if digest is None:
+                continue
+            if size is not None and obj['Size'] != size:
+                drift[SIZE_MISMATCH].append({'key': key, 'expected': size, 'actual': obj['Size']})
+                continue
+            etag = (obj.get('ETag') or '').strip('"')
+            if self.algorithm == 'md5' and etag and '-' not in etag and etag != digest:
+                # single part uploads: the ETag is the MD5 of the content
+                drift[ETAG_MISMATCH].append({'key': key, 'expected': digest, 'actual': etag})
+            else:
+                matching.append((key, digest))
+
+        for key in listed:
+            if key not in expected and key not in known and self.master.is_backup_key(key):
+                drift[UNINDEXED].append(key)
+
+        sampled = 0
+        deep_errors = []
+        if self.settings['sample'] > 0 and matching:
+            count = max(1, int(len(matching) * self.settings['sample'] / 100.0))
+            sample = random.sample(matching, min(count, len(matching)))
+            sampled = len(sample)
+            drift[DEEP_MISMATCH], deep_errors = self.deep_verify(sample)
+
+        counts.update(dict((x, len(drift[x])) for x in DRIFT))
+        counts.update({'listed': len(listed), 'expected': len(expected), 'matching': len(matching),
+                       'sampled': sampled, 'deep_errors': len(deep_errors)})
+        report = {
+            'bucket': self.bucket_name,
+            'home_dir': self.master.home_dir,
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'algorithm': self.algorithm,
+            'dedup': bool(self.master.dedup),
+            'ok': not any(drift[x] for x in DRIFT) and not deep_errors,
+            'counts': counts,
+            'drift': dict((x, sorted(drift[x], key=lambda v: v['key'] if isinstance(v, dict) else v)
+                           [:self.settings['max_items']]) for x in DRIFT),
+            'list_elapsed': round(list_elapsed, 2),
+            'elapsed': round(time.time() - start, 2),
+        }
+        log.info('Verify %s: %s, %s in %.2fs' % (
+            self.bucket_name, 'ok' if report['ok'] else 'drift',
+            ', '.join('%d %s' % (counts[x], x) for x in DRIFT), report['elapsed']))
+        return report
+
+    def write(self, report, dir_name):
+        """ report as <dir_name>/verify_<date>.json """
+        if not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        path = os.path.join(dir_name, 'verify_%s.json' % time.strftime('%Y_%m_%d___%H_%M_%S'))
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        return path
@@ -1,18 +1,15 @@
-import fnmatch
-import os
-import time
-import zipfile
-from os.path import basename
 
-from pyramid.httpexceptions import HTTPError
+from pyramid.httpexceptions import HTTPError, HTTPNotFound
+from pyramid.response import Response
 from pyramid.view import view_config
 
 from s3.projects import projects, report_dirs, databases
-from s3.utils.backup import BackupManager
-from s3.utils.backup import LocalBackup
-from s3.utils.backup import S3Backup
-from s3.utils.mailer import send_report, write_report, view_reports
+from s3.utils import FileUtils
+from s3.utils.dump import dump_database
+from s3.utils.mailer import send_report, view_reports
+from s3.utils.metrics import registry, throttle_values, job_values
 from s3.utils.response import ResponseObject
+from s3.utils.throttle import throttle_metrics
 
 
 @view_config(route_name='backup', renderer='json')
@@ -31,69 +28,32 @@ def main_view(request):
     if not command_name:
         return
 
-    home_dir = project.get('home_dir')
-    bucket = project.get('bucket')
-    config_dir = project.get('config_dir')
-    exclude_dirs = project.get('exclude_dirs')
-    only_dirs = project.get('only_dirs')
+    # the backup runs on the job scheduler, not in this request
+    job_id = request.registry.jobs.submit(project_name, command_name)
 
-    # Worker
-    job = LocalBackup(
-        ConfigDir=config_dir,
-        HomeDir=home_dir)
+    return ResponseObject({
+        'message': 'OK',
+        'job': job_id
+    })
 
-    if job.is_lock():
-        return
 
-    # Local cache
-    local = LocalBackup(
-        HomeDir=home_dir,
-        ConfigDir=config_dir,
-        ExcludeDirs=exclude_dirs,
-        OnlyDirs=only_dirs)
-    local.sync()
-
-    # S3 backup
-    s3 = S3Backup(
-        S3Bucket=bucket,
-        HomeDir=home_dir,
-        ConfigDir=config_dir,
-        ExcludeDirs=exclude_dirs,
-        OnlyDirs=only_dirs)
-    s3.sync()
-
-    manager = BackupManager()
-    manager.slave = local
-    manager.master = s3
-
-    commands = {
-        'pull': lambda m: m.pull(),
-        'push': lambda m: m.push(),
-        'init': lambda m: m.init(),
-        'rebase_digest': lambda m: m.rebase_digest(),
-    }
-    commands[command_name](manager)
-
-    # Lock job
-    job.lock()
-
-    # Apply changes
-    result = manager.apply()
-
-    if result:
-        # send_mail(request, '%s backup success' % project.get('name'), result)
-        write_report(request, job.reports_dir, project.get('name'), {
-            'count': result['count'],
-            'size': result['size'],
-            'date': result['date'],
-            'project': project.get('name')
-        })
-
-    # Unlock job
-    job.unlock()
+@view_config(route_name='jobs', renderer='json')
+def jobs_view(request):
+    return ResponseObject({
+        'message': 'OK',
+        'jobs': request.registry.jobs.store.list(request.params.get('status'))
+    })
+
+
+@view_config(route_name='job', renderer='json')
+def job_view(request):
+    job = request.registry.jobs.store.get(request.matchdict['job_id'])
+    if not job:
+        raise HTTPNotFound()
 
     return ResponseObject({
-        'message': 'OK'
+        'message': 'OK',
+        'job': job
     })
 
 
@@ -104,7 +64,15 @@ def report_view(request):
 
 @view_config(route_name='reports', renderer='json')
 def reports_view(request):
-    print(view_reports(request, report_dirs))
+    # /reports?format=json for dashboards
+    format = 'json' if request.params.get('format') == 'json' else 'html'
+    chunks = view_reports(request, report_dirs, format)
+    if chunks is None:
+        return
+    return Response(
+        app_iter=(x.encode('utf-8') for x in chunks),
+        content_type='application/json' if format == 'json' else 'text/html',
+        charset='utf-8')
 
 
 @view_config(route_name='dump', renderer='json')
@@ -118,37 +86,13 @@ def dump_view(request):
 
     project = databases.get(project_name)
 
-    # Getting current datetime to create seprate backup folder like "12012013-071334".
-    DATETIME = time.strftime('%m_%d_%Y___%H_%M_%S')
-
-    TODAYBACKUPPATH = project.get('backup_path') + DATETIME
-
-    # Checking if backup folder already exists or not. If not exists will create it.
-    # print("creating backup folder")
-
-    if not os.path.exists(TODAYBACKUPPATH):
-        os.makedirs(TODAYBACKUPPATH)
-
-    db = project.get('db_name')
-    path = TODAYBACKUPPATH + "/" + db
-    dumpcmd = "mysqldump" \
-              " -u " + project.get('db_user') + \
-              " -p" + project.get('db_user_password') + \
-              " " + db + \
-              " > " + path + ".sql"
-    os.system(dumpcmd)
+    # mysqldump | gzip straight into <backup_path>/<date>/<db>.sql.gz (or S3)
+    results = dump_database(project)
 
-    try:
-        import zlib
-        mode = zipfile.ZIP_DEFLATED
-    except:
-        mode = zipfile.ZIP_STORED
-
-    zf = zipfile.ZipFile(path + '.zip', 'w', mode)
-    zf.write(path + ".sql")
-    zf.close()
-
-    os.remove(path + ".sql")
+    return ResponseObject({
+        'message': 'OK' if all(x['status'] == 'ok' for x in results) else 'FAILED',
+        'dumps': results
+    })
 
 
 @view_config(route_name='zip_sql', renderer='json')
@@ -160,31 +104,28 @@ def zip_view(request):
     if not project_name:
         return
 
-    project = projects.get(project_name)
-    home_dir = project['home_dir']
+    # compression runs on the job scheduler, not in this request
+    job_id = request.registry.jobs.submit(project_name, 'zip_sql')
+
+    return ResponseObject({
+        'message': 'OK',
+        'job': job_id
+    })
 
-    if not os.path.exists(home_dir):
-        os.makedirs(home_dir)
 
-    matches = []
-    for root, dirnames, filenames in os.walk(home_dir):
-        for filename in fnmatch.filter(filenames, '*.sql'):
-            matches.append(os.path.join(root, filename))
+@view_config(route_name='retention', renderer='json')
+def retention_view(request):
+    project_name = request.matchdict['project']
 
-    try:
-        import zlib
-        mode = zipfile.ZIP_DEFLATED
-    except:
-        mode = zipfile.ZIP_STORED
+    # if project or database exists
+    if project_name not in projects and project_name not in databases:
+        return
 
-    for path in matches:
-        zf = zipfile.ZipFile(path + '.zip', 'w', mode)
-        zf.write(path, basename(path))
-        zf.close()
-        os.remove(path)
+    job_id = request.registry.jobs.submit(project_name, 'retention')
 
     return ResponseObject({
-        'message': 'OK'
+        'message': 'OK',
+        'job': job_id
     })
 
 
@@ -197,6 +138,16 @@ def status_view(request):
     })
 
 
+@view_config(route_name='metrics')
+def metrics_view(request):
+    # throttles are keyed by the hash of home_dir
+    utils = FileUtils()
+    names = dict((utils.generate_hash(x['home_dir']), name) for name, x in projects.items())
+    extra = throttle_values(throttle_metrics(), names)
+    extra.update(job_values(request.registry.jobs.store.counts()))
+    return Response(registry.render(extra), content_type='text/plain', charset='utf-8')
+
+
 @view_config(context=HTTPError, renderer='json')
 def error_view(exc, request):
     return ResponseObject({
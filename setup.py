@@ -31,5 +31,8 @@ setup(name='s3',
       entry_points="""\
       [paste.app_factory]
       main = s3:main
+      [console_scripts]
+      s3_backup_fleet = s3.scripts.backup_fleet:main
+      s3_backup_bench = s3.scripts.backup_bench:main
       """,
       )